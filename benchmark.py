@@ -0,0 +1,241 @@
+import json
+import multiprocessing
+import os
+import platform
+import sys
+from datetime import datetime
+
+# Fixed difficulty so every run probes the same templates to the same solutions, set before util reads them.
+os.environ.setdefault('DIFFICULTY_FUDGE', '4')
+os.environ.setdefault('DIFFICULTY_START', '486604799')
+
+import compact
+import database
+import mining
+import parameter_util as putil
+import util
+from probe_exceptions import StarLogIncompatibleException
+
+BENCHMARK_FORMAT = 1
+BENCHMARK_NONCES = int(os.getenv('BENCHMARK_NONCES', '500000'))
+BENCHMARK_TEMPLATES = int(os.getenv('BENCHMARK_TEMPLATES', '4'))
+BENCHMARK_TIME = 1500000000
+# No digest is less than an empty target, so the engines hash every nonce they're given.
+UNREACHABLE_TARGET = '\x00' * 32
+
+
+def get_templates(count):
+    """Gets the star log templates probed for the time to solution benchmark.
+
+    Args:
+        count (int): Number of templates.
+
+    Returns:
+        list: StarLogs with every header field except the nonce, identical from run to run.
+    """
+    results = []
+    for i in range(0, count):
+        results.append({
+            'version': 0,
+            'previous_hash': util.sha256('benchmark previous %s' % i),
+            'difficulty': util.difficultyStart(),
+            'events_hash': util.sha256('benchmark events %s' % i),
+            'meta_hash': util.sha256('benchmark meta %s' % i),
+            'time': BENCHMARK_TIME + i
+        })
+    return results
+
+
+def get_seconds(started):
+    return max((datetime.now() - started).total_seconds(), 0.000001)
+
+
+def hash_unreachable(engine, nonce_start, nonce_end):
+    """Hashes a range of nonces against a target no digest meets.
+
+    Returns:
+        float: Seconds taken.
+    """
+    hash_nonces = mining.get_engine(engine)
+    log_prefix = util.concat_star_log_header(get_templates(1)[0], False)
+    started = datetime.now()
+    hash_nonces(log_prefix, nonce_start, nonce_end, UNREACHABLE_TARGET)
+    return get_seconds(started)
+
+
+def hash_unreachable_worker(args):
+    return hash_unreachable(*args)
+
+
+def benchmark_hash_rate(engine, nonces):
+    return nonces / hash_unreachable(engine, 0, nonces)
+
+
+def benchmark_solutions(engine, templates):
+    """Probes each template until its difficulty is met.
+
+    Returns:
+        list: The nonce, hash, tries and seconds taken for each template.
+    """
+    results = []
+    for index, template in enumerate(templates):
+        started = datetime.now()
+        nonce, _, found_hash = mining.search_nonces(template, 0, util.MAXIMUM_NONCE, lambda tries: True, engine)
+        results.append({
+            'template': index,
+            'nonce': nonce,
+            'hash': found_hash,
+            'tries': nonce + 1,
+            'seconds': get_seconds(started)
+        })
+    return results
+
+
+def benchmark_scaling(engine, nonces, max_processes):
+    """Hashes the same number of nonces in every process, for each process count up to the maximum.
+
+    Efficiency is the combined hash rate relative to a single process's rate multiplied by the process count.
+
+    Returns:
+        list: The processes, hashes per second and efficiency of each process count.
+    """
+    results = []
+    single_rate = None
+    for processes in range(1, max_processes + 1):
+        pool = multiprocessing.Pool(processes)
+        try:
+            ranges = [(engine, i * nonces, (i + 1) * nonces) for i in range(0, processes)]
+            started = datetime.now()
+            pool.map(hash_unreachable_worker, ranges)
+            rate = (processes * nonces) / get_seconds(started)
+        finally:
+            pool.terminate()
+            pool.join()
+        single_rate = rate if single_rate is None else single_rate
+        results.append({
+            'processes': processes,
+            'hashes_per_second': rate,
+            'efficiency': rate / (single_rate * processes)
+        })
+    return results
+
+
+def get_read_rate(decode, records):
+    started = datetime.now()
+    for record in records:
+        decode(record)
+    return len(records) / get_seconds(started)
+
+
+def benchmark_storage(location):
+    """Compares the size and read speed of a database's star logs as json and as compact records.
+
+    Args:
+        location (str): Path of the database to read the star logs from, it is left unchanged.
+
+    Returns:
+        dict: The bytes and reads per second of each format, and how many star logs could only be stored as json.
+    """
+    database.database_location = location
+    with database.transaction() as cursor:
+        star_logs = [database.decode_star_log_record(entry[0]) for entry in cursor.execute('SELECT json FROM star_logs').fetchall()]
+    json_records = [json.dumps(star_log) for star_log in star_logs]
+    compact_records = []
+    for star_log in star_logs:
+        try:
+            compact_records.append(compact.encode_star_log(star_log))
+        except StarLogIncompatibleException:
+            pass
+    return {
+        'star_logs': len(star_logs),
+        'incompatible': len(star_logs) - len(compact_records),
+        'json': {
+            'bytes': sum(len(record) for record in json_records),
+            'reads_per_second': get_read_rate(json.loads, json_records)
+        },
+        'compact': {
+            'bytes': sum(len(record) for record in compact_records),
+            'reads_per_second': get_read_rate(compact.decode_star_log, compact_records),
+            'header_reads_per_second': get_read_rate(lambda record: compact.decode_star_log(record, False), compact_records)
+        }
+    }
+
+
+def run(engines, nonces=BENCHMARK_NONCES, template_count=BENCHMARK_TEMPLATES, max_processes=None, storage_location=None):
+    """Benchmarks each mining engine.
+
+    Args:
+        engines (list): Names of the engines to benchmark.
+        nonces (int): Nonces hashed per process when measuring hash rates.
+        template_count (int): Number of templates to find solutions for.
+        max_processes (int): Largest process count to measure scaling with, the cpu count if None.
+        storage_location (str): Database to benchmark star log storage with, storage isn't benchmarked if None.
+
+    Returns:
+        dict: Results in the format described by BENCHMARK_FORMAT.
+    """
+    max_processes = multiprocessing.cpu_count() if max_processes is None else max_processes
+    templates = get_templates(template_count)
+    results = {
+        'format': BENCHMARK_FORMAT,
+        'started': util.get_time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'settings': {
+            'difficulty_fudge': util.difficultyFudge(),
+            'difficulty_start': util.difficultyStart(),
+            'nonces': nonces,
+            'templates': template_count,
+            'max_processes': max_processes
+        },
+        'engines': {}
+    }
+    if storage_location is not None:
+        print >> sys.stderr, 'Benchmarking storage...'
+        results['storage'] = benchmark_storage(storage_location)
+    for engine in engines:
+        print >> sys.stderr, 'Benchmarking %s...' % engine
+        solutions = benchmark_solutions(engine, templates)
+        results['engines'][engine] = {
+            'hashes_per_second': benchmark_hash_rate(engine, nonces),
+            'solutions': solutions,
+            'seconds_to_solution': sum(solution['seconds'] for solution in solutions) / max(len(solutions), 1),
+            'scaling': benchmark_scaling(engine, nonces, max_processes)
+        }
+    return results
+
+
+def format_results(results):
+    return json.dumps(results, sort_keys=True, indent=4, separators=(',', ': '))
+
+
+def main(params=None):
+    """Runs the benchmarks and writes the results as json.
+
+    Options are "-e" a comma separated list of engines, "-n" nonces hashed per process, "-t" number of templates,
+    "-j" maximum number of processes, "-d" a database to benchmark star log storage with and "-o" a file to write to
+    instead of stdout. An empty list of engines skips benchmarking mining.
+    """
+    engines = [engine for engine in putil.retrieve_value(params, '-e', ','.join(sorted(mining.ENGINES.keys()))).split(',') if engine]
+    for engine in engines:
+        if engine not in mining.ENGINES:
+            raise ValueError('Unrecognized probing engine %s' % engine)
+    nonces = int(putil.retrieve_value(params, '-n', BENCHMARK_NONCES))
+    template_count = int(putil.retrieve_value(params, '-t', BENCHMARK_TEMPLATES))
+    max_processes = putil.retrieve_value(params, '-j', None)
+    max_processes = None if max_processes is None else int(max_processes)
+    storage_location = putil.retrieve_value(params, '-d', None)
+    output = putil.retrieve_value(params, '-o', None)
+
+    contents = format_results(run(engines, nonces, template_count, max_processes, storage_location))
+    if output is None:
+        print contents
+    else:
+        with open(output, 'w') as output_file:
+            output_file.write(contents + '\n')
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    main(sys.argv[1:])
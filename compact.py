@@ -0,0 +1,272 @@
+import base64
+import binascii
+import struct
+
+import util
+from probe_exceptions import StarLogIncompatibleException
+
+# Compact records start with their format version, which can never start a json record.
+COMPACT_VERSION = 1
+COMPACT_MARKER = chr(COMPACT_VERSION)
+
+# Hashes, version, difficulty, nonce, time, height, whether the log header is stored, and the meta and events lengths.
+HEADER = struct.Struct('>32s32s32s32siqqqq?II')
+# Hash, fleet hash, type, index, input and output counts, and the fleet key and signature encodings and lengths.
+EVENT = struct.Struct('>32s32sBiiiBIBI')
+# Index and key.
+EVENT_INPUT = struct.Struct('>i32s')
+# Index, type, fleet hash, key, whether the star system is set, star system and count.
+EVENT_OUTPUT = struct.Struct('>iB32s32s?32sq')
+
+STAR_LOG_FIELDS = frozenset(['hash', 'previous_hash', 'events_hash', 'meta_hash', 'version', 'difficulty', 'nonce', 'time', 'height', 'meta', 'events'])
+EVENT_FIELDS = frozenset(['hash', 'fleet_hash', 'type', 'index', 'inputs', 'outputs', 'fleet_key', 'signature'])
+EVENT_INPUT_FIELDS = frozenset(['index', 'key'])
+EVENT_OUTPUT_FIELDS = frozenset(['index', 'type', 'fleet_hash', 'key', 'star_system', 'count'])
+
+# Text is stored as utf-8 unless it can be stored as the bytes it encodes.
+TEXT_ENCODING = 0
+HEX_ENCODING = 1
+BASE64_ENCODING = 2
+
+EMPTY_HASH = '\x00' * 32
+EVENT_TYPE_IDS = dict((name, index) for index, name in enumerate(util.EVENT_TYPES))
+
+
+def is_compact(record):
+    return isinstance(record, buffer) or (isinstance(record, str) and record[:1] == COMPACT_MARKER)
+
+
+def is_integer(value):
+    # Booleans are integers too, but they'd come back as numbers.
+    return type(value) in (int, long)
+
+
+def check_fields(value, fields):
+    if not isinstance(value, dict) or frozenset(value.keys()) != fields:
+        raise StarLogIncompatibleException('unexpected fields %s' % (sorted(value.keys()) if isinstance(value, dict) else value))
+
+
+def check_integers(*values):
+    for value in values:
+        if not is_integer(value):
+            raise StarLogIncompatibleException('%s is not an integer' % value)
+
+
+def pack_hash(sha):
+    if not isinstance(sha, basestring) or len(sha) != 64 or sha != sha.lower():
+        raise StarLogIncompatibleException('%s is not a sha256 hash' % sha)
+    try:
+        return binascii.unhexlify(sha)
+    except (TypeError, UnicodeEncodeError):
+        raise StarLogIncompatibleException('%s is not a sha256 hash' % sha)
+
+
+def unpack_hash(packed):
+    return unicode(binascii.hexlify(packed))
+
+
+def pack_text(text):
+    """Packs text as the bytes it encodes if it's hex or base64 that encodes back to the same text, otherwise as utf-8.
+
+    Returns:
+        tuple: The encoding and packed bytes.
+    """
+    if not isinstance(text, basestring):
+        raise StarLogIncompatibleException('%s is not text' % text)
+    try:
+        text.encode('ascii')
+    except UnicodeError:
+        return TEXT_ENCODING, text.encode('utf-8')
+    if len(text) % 2 == 0 and text == text.lower():
+        try:
+            return HEX_ENCODING, binascii.unhexlify(text)
+        except TypeError:
+            pass
+    try:
+        packed = base64.b64decode(text)
+        if base64.b64encode(packed) == text:
+            return BASE64_ENCODING, packed
+    except TypeError:
+        pass
+    return TEXT_ENCODING, text.encode('utf-8')
+
+
+def unpack_text(encoding, packed):
+    if encoding == HEX_ENCODING:
+        return unicode(binascii.hexlify(packed))
+    if encoding == BASE64_ENCODING:
+        return unicode(base64.b64encode(packed))
+    return packed.decode('utf-8')
+
+
+def pack_event_type(name):
+    if name not in EVENT_TYPE_IDS:
+        raise StarLogIncompatibleException('unrecognized event of type %s' % name)
+    return EVENT_TYPE_IDS[name]
+
+
+def encode_star_log(star_log):
+    """Encodes a star log as a compact record.
+
+    Hashes are stored as their bytes and integers packed at fixed widths. The log header is left out, since it's
+    calculated from the other fields, and the events are stored in a segment after the header that decode_star_log
+    can skip.
+
+    Args:
+        star_log (dict): Json data for the star log.
+
+    Returns:
+        str: The compact record.
+
+    Raises:
+        StarLogIncompatibleException: If the star log has fields or values a compact record can't store exactly.
+    """
+    has_log_header = 'log_header' in star_log
+    check_fields(dict((key, value) for key, value in star_log.items() if key != 'log_header'), STAR_LOG_FIELDS)
+    check_integers(star_log['version'], star_log['difficulty'], star_log['nonce'], star_log['time'], star_log['height'])
+    if has_log_header and star_log['log_header'] != util.concat_star_log_header(star_log):
+        raise StarLogIncompatibleException('log header does not match the star log')
+    if not isinstance(star_log['meta'], basestring) or not isinstance(star_log['events'], list):
+        raise StarLogIncompatibleException('star log has an unexpected meta or events value')
+    meta = star_log['meta'].encode('utf-8')
+    events = encode_events(star_log['events'])
+    try:
+        header = HEADER.pack(
+            pack_hash(star_log['hash']),
+            pack_hash(star_log['previous_hash']),
+            pack_hash(star_log['events_hash']),
+            pack_hash(star_log['meta_hash']),
+            star_log['version'],
+            star_log['difficulty'],
+            star_log['nonce'],
+            star_log['time'],
+            star_log['height'],
+            has_log_header,
+            len(meta),
+            len(events)
+        )
+    except struct.error as error:
+        raise StarLogIncompatibleException(str(error))
+    record = COMPACT_MARKER + header + meta + events
+    # Anything the checks above missed still comes back different, and it's far cheaper to find out now than on read.
+    if decode_star_log(record) != star_log:
+        raise StarLogIncompatibleException('star log does not survive being compacted')
+    return record
+
+
+def encode_events(events):
+    segments = []
+    for event in events:
+        check_fields(event, EVENT_FIELDS)
+        check_integers(event['index'])
+        if not isinstance(event['inputs'], list) or not isinstance(event['outputs'], list):
+            raise StarLogIncompatibleException('event has unexpected inputs or outputs')
+        fleet_key_encoding, fleet_key = pack_text(event['fleet_key'])
+        signature_encoding, signature = pack_text(event['signature'])
+        try:
+            segments.append(EVENT.pack(
+                pack_hash(event['hash']),
+                pack_hash(event['fleet_hash']),
+                pack_event_type(event['type']),
+                event['index'],
+                len(event['inputs']),
+                len(event['outputs']),
+                fleet_key_encoding,
+                len(fleet_key),
+                signature_encoding,
+                len(signature)
+            ))
+            segments.append(fleet_key)
+            segments.append(signature)
+            for event_input in event['inputs']:
+                check_fields(event_input, EVENT_INPUT_FIELDS)
+                check_integers(event_input['index'])
+                segments.append(EVENT_INPUT.pack(event_input['index'], pack_hash(event_input['key'])))
+            for event_output in event['outputs']:
+                check_fields(event_output, EVENT_OUTPUT_FIELDS)
+                check_integers(event_output['index'], event_output['count'])
+                star_system = event_output['star_system']
+                segments.append(EVENT_OUTPUT.pack(
+                    event_output['index'],
+                    pack_event_type(event_output['type']),
+                    pack_hash(event_output['fleet_hash']),
+                    pack_hash(event_output['key']),
+                    star_system is not None,
+                    EMPTY_HASH if star_system is None else pack_hash(star_system),
+                    event_output['count']
+                ))
+        except struct.error as error:
+            raise StarLogIncompatibleException(str(error))
+    return ''.join(segments)
+
+
+def decode_star_log(record, events=True):
+    """Decodes a compact record into the same star log that was encoded.
+
+    Args:
+        record (str): The compact record.
+        events (bool): Decode the events segment, if False the star log is returned without its events.
+
+    Returns:
+        dict: Json data for the star log.
+    """
+    record = str(record)
+    header_end = 1 + HEADER.size
+    sha, previous_hash, events_hash, meta_hash, version, difficulty, nonce, time, height, has_log_header, meta_length, events_length = HEADER.unpack_from(record, 1)
+    star_log = {
+        'hash': unpack_hash(sha),
+        'previous_hash': unpack_hash(previous_hash),
+        'events_hash': unpack_hash(events_hash),
+        'meta_hash': unpack_hash(meta_hash),
+        'version': version,
+        'difficulty': difficulty,
+        'nonce': nonce,
+        'time': time,
+        'height': height,
+        'meta': record[header_end:header_end + meta_length].decode('utf-8')
+    }
+    if has_log_header:
+        star_log['log_header'] = unicode(util.concat_star_log_header(star_log))
+    if events:
+        events_start = header_end + meta_length
+        star_log['events'] = decode_events(record, events_start, events_start + events_length)
+    return star_log
+
+
+def decode_events(record, offset, end):
+    results = []
+    while offset < end:
+        sha, fleet_hash, event_type, index, input_count, output_count, fleet_key_encoding, fleet_key_length, signature_encoding, signature_length = EVENT.unpack_from(record, offset)
+        offset += EVENT.size
+        fleet_key = unpack_text(fleet_key_encoding, record[offset:offset + fleet_key_length])
+        offset += fleet_key_length
+        signature = unpack_text(signature_encoding, record[offset:offset + signature_length])
+        offset += signature_length
+        inputs = []
+        for _ in range(0, input_count):
+            input_index, key = EVENT_INPUT.unpack_from(record, offset)
+            offset += EVENT_INPUT.size
+            inputs.append({'index': input_index, 'key': unpack_hash(key)})
+        outputs = []
+        for _ in range(0, output_count):
+            output_index, output_type, output_fleet_hash, key, has_star_system, star_system, count = EVENT_OUTPUT.unpack_from(record, offset)
+            offset += EVENT_OUTPUT.size
+            outputs.append({
+                'index': output_index,
+                'type': unicode(util.EVENT_TYPES[output_type]),
+                'fleet_hash': unpack_hash(output_fleet_hash),
+                'key': unpack_hash(key),
+                'star_system': unpack_hash(star_system) if has_star_system else None,
+                'count': count
+            })
+        results.append({
+            'hash': unpack_hash(sha),
+            'fleet_hash': unpack_hash(fleet_hash),
+            'type': unicode(util.EVENT_TYPES[event_type]),
+            'index': index,
+            'inputs': inputs,
+            'outputs': outputs,
+            'fleet_key': fleet_key,
+            'signature': signature
+        })
+    return results
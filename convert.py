@@ -0,0 +1,35 @@
+import os
+import sys
+
+import database
+import parameter_util as putil
+
+
+def get_star_log_bytes():
+    with database.transaction() as cursor:
+        return cursor.execute('SELECT COALESCE(SUM(LENGTH(json)), 0) FROM star_logs').fetchone()[0]
+
+
+def main(params=None):
+    """Converts the star logs of an existing database to another storage format.
+
+    Options are "-f" the format, either "compact" or "json", and "-d" the database to convert instead of the one next
+    to the probe. The database is migrated to the current schema first, and vacuumed afterwards so the space saved is
+    returned to the file system.
+    """
+    record_format = putil.retrieve_value(params, '-f', 'compact')
+    database.database_location = putil.retrieve_value(params, '-d', database.database_location)
+    if not os.path.isfile(database.database_location):
+        raise ValueError('No database at %s' % database.database_location)
+
+    database.initialize()
+    star_log_bytes = get_star_log_bytes()
+    file_bytes = os.path.getsize(database.database_location)
+    converted = database.convert_star_logs(record_format)
+    database.get_connection().execute('VACUUM')
+    database.get_connection().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    print 'Converted %s starlogs to %s, starlogs went from %s to %s bytes and the database from %s to %s bytes' % (converted, record_format, star_log_bytes, get_star_log_bytes(), file_bytes, os.path.getsize(database.database_location))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
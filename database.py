@@ -1,10 +1,17 @@
 import json
 import sqlite3
 import sys
-from os import getenv
-from os.path import dirname as directory_name, join as join_paths
-
+import threading
+from contextlib import contextmanager
+from itertools import groupby
+from os import getenv, getpid, remove as remove_file
+from os.path import dirname as directory_name, isfile as is_file, join as join_paths
+from zipfile import BadZipfile
+
+import compact
+import hash_index
 import util
+from probe_exceptions import StarLogIncompatibleException
 
 database_file_name = 'local.db'
 
@@ -17,68 +24,303 @@ else:
 
 database_location = join_paths(application_path, database_file_name)
 
+connections = threading.local()
+
 
 def command_history_limit():
     return int(getenv('COMMAND_HISTORY', '100'))
 
 
-def begin():
-    connection = sqlite3.connect(database_location)
-    cursor = connection.cursor()
-    return connection, cursor
+def unspent_checkpoint_interval():
+    return int(getenv('UNSPENT_CHECKPOINT_INTERVAL', '1000'))
 
 
-def initialize(rebuild=False):
-    connection, cursor = begin()
+def chain_page_size():
+    return int(getenv('CHAIN_PAGE_SIZE', '1000'))
+
+
+def cache_size():
+    return int(getenv('DATABASE_CACHE_KB', '16384'))
+
+
+def star_log_format():
+    return getenv('STAR_LOG_FORMAT', 'json')
+
+
+def star_log_cache_size():
+    return int(getenv('STAR_LOG_CACHE_BYTES', '33554432'))
+
+
+def hash_index_persist():
+    return int(getenv('HASH_INDEX_PERSIST', '1')) == 1
+
+
+def hash_index_location(hashes):
+    return '%s.%s' % (database_location, hashes['extension'])
+
+
+# Decoded star logs by hash, sized by the length of their records. Only ever handed out as copies, since callers edit them.
+star_logs = util.LruCache(star_log_cache_size())
+# Indices of the stored star log and fleet hashes, each built the first time a fragment is matched. The rowid and data
+# version are what the index was last caught up to, so hashes stored by other connections can be found.
+star_log_hashes = {
+    'table': 'star_logs',
+    'column': 'hash',
+    'extension': 'hashes',
+    'index': None,
+    'rowid': 0,
+    'data_version': None
+}
+fleet_hashes = {
+    'table': 'fleets',
+    'column': 'fleet_hash',
+    'extension': 'fleets',
+    'index': None,
+    'rowid': 0,
+    'data_version': None
+}
+
+
+def get_connection():
+    """Gets this thread's connection to the database, opening it if this thread doesn't have one yet.
+
+    Connections are kept open for the life of their thread, and aren't shared with processes forked after opening them.
+
+    Returns:
+        sqlite3.Connection: The connection, in autocommit mode since transactions are handled by transaction.
+    """
+    if getattr(connections, 'connection', None) is not None:
+        if connections.pid == getpid() and connections.location == database_location:
+            return connections.connection
+        if connections.pid == getpid():
+            connections.connection.close()
+    connection = sqlite3.connect(database_location, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    # Normal is durable in WAL mode except for the last transactions before a power loss, which sync would restore.
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute('PRAGMA cache_size=-%s' % cache_size())
+    connections.connection = connection
+    connections.pid = getpid()
+    connections.location = database_location
+    connections.depth = 0
+    return connection
+
+
+def close():
+    """Closes this thread's connection, if it has one open."""
+    if getattr(connections, 'connection', None) is not None and connections.pid == getpid():
+        connections.connection.close()
+    connections.connection = None
+
+
+@contextmanager
+def transaction(write=False):
+    """Runs the block in a transaction on this thread's connection, committing if it completes and rolling back if it
+    raises.
+
+    Transactions started inside another transaction join it, so they're committed or rolled back with the outermost.
+
+    Args:
+        write (bool): Take the write lock when the transaction begins. A transaction that reads before writing fails
+            immediately if another connection commits in between, rather than waiting on the busy timeout.
+
+    Yields:
+        sqlite3.Cursor: Cursor to run queries in the transaction with.
+    """
+    cursor = get_connection().cursor()
+    if connections.depth == 0:
+        cursor.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+    connections.depth += 1
     try:
+        yield cursor
+    except:
+        connections.depth -= 1
+        if connections.depth == 0:
+            cursor.execute('ROLLBACK')
+        raise
+    connections.depth -= 1
+    if connections.depth == 0:
+        cursor.execute('COMMIT')
+
+
+# Tables derived entirely from the star logs, dropped and rebuilt along with them.
+STAR_LOG_TABLES = [
+    'star_logs',
+    'events',
+    'event_inputs',
+    'event_outputs',
+    'unspent_states',
+    'unspent_outputs',
+    'star_log_ancestors',
+    'star_log_tips',
+    'fleets',
+    'fleet_star_logs'
+]
+
+
+def create_tables(cursor):
+    # The json column holds compact records too, see encode_star_log_record.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS star_logs (hash, previous_hash, height, time, json)''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS accounts (active, name, private_key, public_key)''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS command_history (command, time, session_order)''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS persistent (meta_content)''')
+
+
+def create_star_log_indices(cursor):
+    # Older databases could have stored a star log more than once, only the first copy is kept.
+    cursor.execute('DELETE FROM star_logs WHERE rowid NOT IN (SELECT MIN(rowid) FROM star_logs GROUP BY hash)')
+    cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS star_logs_hash ON star_logs (hash)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS star_logs_previous_hash ON star_logs (previous_hash)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS star_logs_height ON star_logs (height)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS star_logs_time ON star_logs (time)''')
+
+
+def create_event_key_tables(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS event_inputs (key, star_log_hash, height)''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS event_outputs (key, star_log_hash, height)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS event_inputs_key ON event_inputs (key)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS event_outputs_key ON event_outputs (key)''')
+
+
+def create_verified_signature_table(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS verified_signatures (fleet_key, signature, hash)''')
+    cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS verified_signatures_hash ON verified_signatures (hash, signature, fleet_key)''')
+
+
+def create_event_tables(cursor):
+    # Replaces the key only event tables, filling them again from the star logs.
+    cursor.execute('''DROP TABLE IF EXISTS event_inputs''')
+    cursor.execute('''DROP TABLE IF EXISTS event_outputs''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS events (hash, star_log_hash, height, event_index, type, fleet_hash, fleet_key, signature)''')
+    cursor.execute('''CREATE TABLE event_inputs (key, star_log_hash, height, event_hash, input_index)''')
+    cursor.execute('''CREATE TABLE event_outputs (key, star_log_hash, height, event_hash, output_index, type, fleet_hash, star_system, count)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS events_star_log_hash ON events (star_log_hash)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS events_hash ON events (hash)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS event_inputs_key ON event_inputs (key)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS event_inputs_star_log_hash ON event_inputs (star_log_hash)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS event_outputs_key ON event_outputs (key)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS event_outputs_star_log_hash ON event_outputs (star_log_hash)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS event_outputs_fleet_hash ON event_outputs (fleet_hash)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS event_outputs_star_system ON event_outputs (star_system)''')
+    cursor.execute('DELETE FROM events')
+    insert_events(cursor, [decode_star_log_record(entry[0]) for entry in cursor.execute('SELECT json FROM star_logs ORDER BY height').fetchall()])
+
+
+def create_unspent_tables(cursor):
+    cursor.execute('''DROP TABLE IF EXISTS unspent_states''')
+    cursor.execute('''DROP TABLE IF EXISTS unspent_outputs''')
+    cursor.execute('''CREATE TABLE unspent_states (star_log_hash, state_id)''')
+    cursor.execute('''CREATE TABLE unspent_outputs (state_id, key, height, star_log_hash, event_index, output_index, type, fleet_hash, star_system, count)''')
+    cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS unspent_states_star_log_hash ON unspent_states (star_log_hash)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS unspent_states_state_id ON unspent_states (state_id)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS unspent_outputs_key ON unspent_outputs (state_id, key)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS unspent_outputs_star_system ON unspent_outputs (state_id, star_system)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS unspent_outputs_fleet_hash ON unspent_outputs (state_id, fleet_hash)''')
+    star_logs = cursor.execute('SELECT hash, previous_hash FROM star_logs ORDER BY height').fetchall()
+    insert_unspent_outputs(cursor, [{'hash': entry[0], 'previous_hash': entry[1]} for entry in star_logs])
+
+
+def create_star_log_ancestor_table(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS star_log_ancestors (hash, level, ancestor_hash, ancestor_height)''')
+    cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS star_log_ancestors_hash ON star_log_ancestors (hash, level)''')
+    cursor.execute('DELETE FROM star_log_ancestors')
+    star_logs = cursor.execute('SELECT hash, previous_hash, height FROM star_logs ORDER BY height').fetchall()
+    insert_star_log_ancestors(cursor, [{'hash': entry[0], 'previous_hash': entry[1], 'height': entry[2]} for entry in star_logs])
+
+
+def create_star_log_tip_table(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS star_log_tips (hash, height)''')
+    cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS star_log_tips_hash ON star_log_tips (hash)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS star_log_tips_height ON star_log_tips (height)''')
+    cursor.execute('DELETE FROM star_log_tips')
+    cursor.execute('INSERT INTO star_log_tips SELECT hash, height FROM star_logs WHERE hash NOT IN (SELECT previous_hash FROM star_logs)')
+
+
+def create_fleet_tables(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS fleets (fleet_hash, first_height, last_height)''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS fleet_star_logs (fleet_hash, star_log_hash, height, star_system)''')
+    cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS fleets_fleet_hash ON fleets (fleet_hash)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS fleet_star_logs_fleet_hash ON fleet_star_logs (fleet_hash, height)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS fleet_star_logs_star_log_hash ON fleet_star_logs (star_log_hash)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS fleet_star_logs_height ON fleet_star_logs (height)''')
+    cursor.execute('DELETE FROM fleets')
+    cursor.execute('DELETE FROM fleet_star_logs')
+    # Rows are inserted in the order of each fleet's first output in a star log, the same order insert_fleets uses.
+    cursor.execute('''INSERT INTO fleet_star_logs SELECT fleet_hash, star_log_hash, height, COALESCE(star_system, star_log_hash) FROM event_outputs
+                      GROUP BY star_log_hash, fleet_hash, COALESCE(star_system, star_log_hash) ORDER BY height, MIN(rowid)''')
+    cursor.execute('INSERT INTO fleets SELECT fleet_hash, MIN(height), MAX(height) FROM fleet_star_logs GROUP BY fleet_hash')
+
+
+# Each migration upgrades the schema by one version, the version of a database is stored in its user_version. Since a
+# rebuild drops the star log tables and runs every migration again, migrations must leave existing tables untouched.
+MIGRATIONS = [
+    create_tables,
+    create_star_log_indices,
+    create_event_key_tables,
+    create_verified_signature_table,
+    create_event_tables,
+    create_unspent_tables,
+    create_star_log_ancestor_table,
+    create_star_log_tip_table,
+    create_fleet_tables
+]
+
+
+def get_schema_version(cursor):
+    return cursor.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(cursor):
+    """Runs every migration newer than the database's schema version.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the transaction to migrate in.
+    """
+    for version in range(get_schema_version(cursor), len(MIGRATIONS)):
+        MIGRATIONS[version](cursor)
+        cursor.execute('PRAGMA user_version = %s' % (version + 1))
+
+
+def initialize(rebuild=False):
+    with transaction(write=True) as cursor:
         if rebuild:
-            cursor.execute('''DROP TABLE IF EXISTS star_logs''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS star_logs (hash, previous_hash, height, time, json)''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS accounts (active, name, private_key, public_key)''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS command_history (command, time, session_order)''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS persistent (meta_content)''')
-        connection.commit()
-    finally:
-        connection.close()
+            for table in STAR_LOG_TABLES:
+                cursor.execute('DROP TABLE IF EXISTS %s' % table)
+            cursor.execute('PRAGMA user_version = 0')
+            star_logs.clear()
+            for hashes in [star_log_hashes, fleet_hashes]:
+                hashes['index'] = None
+                if is_file(hash_index_location(hashes)):
+                    remove_file(hash_index_location(hashes))
+        migrate(cursor)
 
 
 def get_command(index):
-    connection, cursor = begin()
-    try:
+    with transaction() as cursor:
         result = cursor.execute('SELECT command FROM command_history ORDER BY time DESC, session_order DESC LIMIT 1 OFFSET ?', (index,)).fetchone()
         if result:
             return result[0]
         else:
             return None
-    finally:
-        connection.close()
 
 
 def add_command(command, time, order):
     if command is None or get_command(0) == command:
         return
-    connection, cursor = begin()
-    try:
+    with transaction(write=True) as cursor:
         cursor.execute('INSERT INTO command_history VALUES (?, ?, ?)', (command, time, order))
         if command_history_limit() <= count_commands():
             delete_start = cursor.execute('SELECT time FROM command_history ORDER BY time DESC, session_order DESC LIMIT 1 OFFSET ?', (command_history_limit(),)).fetchone()[0]
             cursor.execute('DELETE FROM command_history WHERE time <= ?', (delete_start,))
-        connection.commit()
-    finally:
-        connection.close()
 
 
 def count_commands():
-    connection, cursor = begin()
-    try:
+    with transaction() as cursor:
         return cursor.execute('SELECT COUNT(*) FROM command_history').fetchone()[0]
-    finally:
-        connection.close()
 
 
 def get_account(name=None):
-    connection, cursor = begin()
-    try:
+    with transaction() as cursor:
         if name:
             result = cursor.execute('SELECT * FROM accounts WHERE name=?', (name,)).fetchone()
         else:
@@ -91,13 +333,10 @@ def get_account(name=None):
                 'public_key': result[3]
             }
         return None
-    finally:
-        connection.close()
 
 
 def get_accounts():
-    connection, cursor = begin()
-    try:
+    with transaction() as cursor:
         results = []
         fetched = cursor.execute('SELECT * FROM accounts').fetchall()
         if fetched:
@@ -109,8 +348,6 @@ def get_accounts():
                     'public_key': account[3]
                 })
         return results
-    finally:
-        connection.close()
 
 
 def any_account(name):
@@ -118,183 +355,698 @@ def any_account(name):
 
 
 def add_account(account_json):
-    connection, cursor = begin()
-    try:
+    with transaction(write=True) as cursor:
         if cursor.execute('SELECT * FROM accounts WHERE name=?', (account_json['name'],)).fetchone():
             return
 
         cursor.execute('INSERT INTO accounts VALUES (?, ?, ?, ?)', (0, account_json['name'], account_json['private_key'], account_json['public_key']))
-        connection.commit()
-    finally:
-        connection.close()
 
 
 def set_account_active(name):
-    connection, cursor = begin()
-    try:
+    with transaction(write=True) as cursor:
         cursor.execute('UPDATE accounts SET active=0')
         cursor.execute('UPDATE accounts SET active=1 WHERE name=?', (name,))
-        connection.commit()
-    finally:
-        connection.close()
 
 
 def drop_account(name):
-    connection, cursor = begin()
-    try:
+    with transaction(write=True) as cursor:
         cursor.execute('DELETE FROM accounts WHERE name=?', (name,))
-        connection.commit()
-    finally:
-        connection.close()
 
 
 def drop_accounts():
-    connection, cursor = begin()
-    try:
+    with transaction(write=True) as cursor:
         cursor.execute('DELETE FROM accounts')
-        connection.commit()
-    finally:
-        connection.close()
+
+
+def encode_star_log_record(star_log, record_format=None):
+    """Encodes a star log for the json column of the star logs table.
+
+    Args:
+        star_log (dict): Json data for the star log.
+        record_format (str): Either "json" or "compact", the STAR_LOG_FORMAT if None. Star logs a compact record can't
+            store exactly are stored as json.
+
+    Returns:
+        The json text, or a buffer of the compact record.
+    """
+    if (star_log_format() if record_format is None else record_format) == 'compact':
+        try:
+            return buffer(compact.encode_star_log(star_log))
+        except StarLogIncompatibleException:
+            pass
+    return json.dumps(star_log)
+
+
+def decode_star_log_record(record, events=True):
+    """Decodes a star log stored in either format.
+
+    Args:
+        record: The json text or compact record.
+        events (bool): Include the events, compact records are only decoded up to them if False.
+
+    Returns:
+        dict: Json data for the star log.
+    """
+    if compact.is_compact(record):
+        return compact.decode_star_log(record, events)
+    star_log = json.loads(record)
+    if not events:
+        del star_log['events']
+    return star_log
+
+
+def convert_star_logs(record_format):
+    """Rewrites every stored star log in the given format.
+
+    Args:
+        record_format (str): Either "json" or "compact".
+
+    Returns:
+        int: The number of star logs rewritten.
+    """
+    if record_format not in ['json', 'compact']:
+        raise ValueError('Unrecognized star log format %s' % record_format)
+    converted = 0
+    with transaction(write=True) as cursor:
+        last_rowid = -1
+        while True:
+            page = cursor.execute('SELECT rowid, json FROM star_logs WHERE rowid > ? ORDER BY rowid LIMIT ?', (last_rowid, chain_page_size())).fetchall()
+            if not page:
+                break
+            last_rowid = page[-1][0]
+            values = []
+            for rowid, record in page:
+                converted_record = encode_star_log_record(decode_star_log_record(record), record_format)
+                if compact.is_compact(converted_record) != compact.is_compact(record):
+                    values.append((converted_record, rowid))
+            cursor.executemany('UPDATE star_logs SET json=? WHERE rowid=?', values)
+            converted += len(values)
+    star_logs.clear()
+    return converted
 
 
 def add_star_log(star_log_json):
-    connection, cursor = begin()
-    try:
-        if cursor.execute('SELECT * FROM star_logs WHERE hash=?', (star_log_json['hash'],)).fetchone():
-            return
+    add_star_logs([star_log_json])
+
+
+def add_star_logs(star_logs_json):
+    """Adds star logs and indexes them in a single transaction, skipping any that are already stored.
+
+    Args:
+        star_logs_json (list): StarLogs to add, in any order.
+
+    Returns:
+        int: The number of star logs added.
+    """
+    added = dict((star_log_json['hash'], star_log_json) for star_log_json in star_logs_json)
+    with transaction(write=True) as cursor:
+        hashes = list(added.keys())
+        for i in range(0, len(hashes), 500):
+            page = hashes[i:i + 500]
+            for entry in cursor.execute('SELECT hash FROM star_logs WHERE hash IN (%s)' % ', '.join('?' * len(page)), page).fetchall():
+                del added[entry[0]]
+        # Parents are added before their children, since indexing a star log can depend on its parent's indices.
+        star_logs_json = sorted(added.values(), key=lambda star_log: star_log['height'])
+        values = [(star_log['hash'], star_log['previous_hash'], star_log['height'], star_log['time'], encode_star_log_record(star_log)) for star_log in star_logs_json]
+        cursor.executemany('INSERT OR IGNORE INTO star_logs VALUES (?, ?, ?, ?, ?)', values)
+        index_star_logs(cursor, star_logs_json)
+        add_to_hash_index(cursor, star_log_hashes, [star_log['hash'] for star_log in star_logs_json])
+    return len(star_logs_json)
+
+
+def index_star_logs(cursor, star_logs_json):
+    """Fills every table derived from star logs with the newly added star logs.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the transaction the star logs are being added with.
+        star_logs_json (list): StarLogs being added, ordered by height.
+    """
+    insert_events(cursor, star_logs_json)
+    insert_unspent_outputs(cursor, star_logs_json)
+    insert_star_log_ancestors(cursor, star_logs_json)
+    insert_star_log_tips(cursor, star_logs_json)
+    insert_fleets(cursor, star_logs_json)
+
+
+def insert_events(cursor, star_logs_json):
+    """Adds every event in the star logs, and their inputs and outputs, to the event tables.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the transaction the star logs are being added with.
+        star_logs_json (list): StarLogs being added.
+    """
+    events = []
+    inputs = []
+    outputs = []
+    for star_log_json in star_logs_json:
+        star_log_hash = star_log_json['hash']
+        height = star_log_json['height']
+        for event in star_log_json['events']:
+            events.append((event['hash'], star_log_hash, height, event['index'], event['type'], event['fleet_hash'], event['fleet_key'], event['signature']))
+            for event_input in event['inputs']:
+                inputs.append((event_input['key'], star_log_hash, height, event['hash'], event_input['index']))
+            for event_output in event['outputs']:
+                outputs.append((event_output['key'], star_log_hash, height, event['hash'], event_output['index'], event_output['type'], event_output['fleet_hash'], event_output['star_system'], event_output['count']))
+    cursor.executemany('INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?)', events)
+    cursor.executemany('INSERT INTO event_inputs VALUES (?, ?, ?, ?, ?)', inputs)
+    cursor.executemany('INSERT INTO event_outputs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', outputs)
+
+
+def insert_fleets(cursor, star_logs_json):
+    """Registers the fleets with outputs in the star logs, and the systems each star log gave them ships in.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the transaction the star logs are being added with.
+        star_logs_json (list): StarLogs being added.
+    """
+    fleet_star_logs = []
+    fleet_heights = []
+    for star_log_json in star_logs_json:
+        star_log_hash = star_log_json['hash']
+        height = star_log_json['height']
+        found = set()
+        for event in star_log_json['events']:
+            for event_output in event['outputs']:
+                star_system = star_log_hash if event_output['star_system'] is None else event_output['star_system']
+                if (event_output['fleet_hash'], star_system) in found:
+                    continue
+                found.add((event_output['fleet_hash'], star_system))
+                fleet_star_logs.append((event_output['fleet_hash'], star_log_hash, height, star_system))
+        for fleet_hash in set(fleet for fleet, _ in found):
+            fleet_heights.append((height, height, fleet_hash))
+    cursor.executemany('INSERT INTO fleet_star_logs VALUES (?, ?, ?, ?)', fleet_star_logs)
+    cursor.executemany('INSERT OR IGNORE INTO fleets VALUES (?, ?, ?)', [(fleet_hash, first, last) for first, last, fleet_hash in fleet_heights])
+    cursor.executemany('UPDATE fleets SET first_height=MIN(first_height, ?), last_height=MAX(last_height, ?) WHERE fleet_hash=?', fleet_heights)
+    add_to_hash_index(cursor, fleet_hashes, list(set(fleet_hash for _, _, fleet_hash in fleet_heights)))
+
+
+def remove_fleets(cursor, system_hash):
+    """Removes a star log's fleet registrations, and the fleets only it registered.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the transaction the star log is being removed with.
+        system_hash (str): Hash of the star log being removed.
+    """
+    fleet_hashes = [entry[0] for entry in cursor.execute('SELECT DISTINCT fleet_hash FROM fleet_star_logs WHERE star_log_hash=?', (system_hash,)).fetchall()]
+    cursor.execute('DELETE FROM fleet_star_logs WHERE star_log_hash=?', (system_hash,))
+    for fleet_hash in fleet_hashes:
+        first, last = cursor.execute('SELECT MIN(height), MAX(height) FROM fleet_star_logs WHERE fleet_hash=?', (fleet_hash,)).fetchone()
+        if first is None:
+            cursor.execute('DELETE FROM fleets WHERE fleet_hash=?', (fleet_hash,))
+            if fleet_hashes['index'] is not None:
+                fleet_hashes['index'].remove(fleet_hash)
+        else:
+            cursor.execute('UPDATE fleets SET first_height=?, last_height=? WHERE fleet_hash=?', (first, last, fleet_hash))
+
+
+def insert_star_log_ancestors(cursor, star_logs_json):
+    """Adds skip pointers from each star log to its ancestors 1, 2, 4, 8... star logs below it.
+
+    Each pointer is found from the pointers of the ancestor one level down, so a star log whose ancestors are missing
+    only gets the pointers that could be found.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the transaction the star logs are being added with.
+        star_logs_json (list): StarLogs being added, ordered by height.
+    """
+    for star_log_json in star_logs_json:
+        if star_log_json['height'] == 0:
+            continue
+        ancestor = (star_log_json['previous_hash'], star_log_json['height'] - 1)
+        level = 0
+        while ancestor is not None:
+            cursor.execute('INSERT OR REPLACE INTO star_log_ancestors VALUES (?, ?, ?, ?)', (star_log_json['hash'], level, ancestor[0], ancestor[1]))
+            ancestor = cursor.execute('SELECT ancestor_hash, ancestor_height FROM star_log_ancestors WHERE hash=? AND level=?', (ancestor[0], level)).fetchone()
+            level += 1
+
+
+def insert_star_log_tips(cursor, star_logs_json):
+    """Replaces the parent of each star log with the star log in the table of tips, unless it already has children.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the transaction the star logs are being added with.
+        star_logs_json (list): StarLogs being added, ordered by height.
+    """
+    for star_log_json in star_logs_json:
+        cursor.execute('DELETE FROM star_log_tips WHERE hash=?', (star_log_json['previous_hash'],))
+        if cursor.execute('SELECT 1 FROM star_logs WHERE previous_hash=?', (star_log_json['hash'],)).fetchone() is None:
+            cursor.execute('INSERT OR IGNORE INTO star_log_tips VALUES (?, ?)', (star_log_json['hash'], star_log_json['height']))
+
+
+def get_ancestor_hash(cursor, system_hash, height):
+    """Finds the ancestor of a star log at a height by following skip pointers.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the current transaction.
+        system_hash (str): Hash of the star log to start from.
+        height (int): Height of the ancestor, the star log itself is returned if it's at this height.
+
+    Returns:
+        str: Hash of the ancestor, or None if the star log or the ancestor isn't stored.
+    """
+    entry = cursor.execute('SELECT height FROM star_logs WHERE hash=?', (system_hash,)).fetchone()
+    if entry is None or height < 0 or entry[0] < height:
+        return None
+    current_height = entry[0]
+    while height < current_height:
+        # The longest jump that doesn't pass the height, each jump at least halves the remaining distance.
+        entry = cursor.execute('SELECT ancestor_hash, ancestor_height FROM star_log_ancestors WHERE hash=? AND ancestor_height >= ? ORDER BY level DESC LIMIT 1', (system_hash, height)).fetchone()
+        if entry is None:
+            return None
+        system_hash, current_height = entry
+    if cursor.execute('SELECT 1 FROM star_logs WHERE hash=?', (system_hash,)).fetchone() is None:
+        return None
+    return system_hash
+
+
+def is_star_log_ancestor(ancestor_hash, system_hash):
+    """Checks if a star log is on the chain ending at another, counting a star log as its own ancestor.
+
+    Args:
+        ancestor_hash (str): Hash of the possible ancestor.
+        system_hash (str): Hash of the possible descendant.
+
+    Returns:
+        bool: True if the ancestor is on the descendant's chain.
+    """
+    with transaction() as cursor:
+        entry = cursor.execute('SELECT height FROM star_logs WHERE hash=?', (ancestor_hash,)).fetchone()
+        return entry is not None and get_ancestor_hash(cursor, system_hash, entry[0]) == ancestor_hash
+
+
+# Unspent outputs are stored as states, each shared by the star logs in unspent_states. Only tips and star logs at
+# checkpoint heights keep a state, a tip's state is handed down to its child when it's extended so adding a star log
+# only applies its own events. The state of any other star log is rebuilt from its nearest ancestor with one.
+UNSPENT_OUTPUT_COLUMNS = 'key, height, star_log_hash, event_index, output_index, type, fleet_hash, star_system, count'
+
+
+def is_unspent_checkpoint(height):
+    return height % unspent_checkpoint_interval() == 0
+
+
+def get_unspent_state_id(cursor, star_log_hash):
+    entry = cursor.execute('SELECT state_id FROM unspent_states WHERE star_log_hash=?', (star_log_hash,)).fetchone()
+    return None if entry is None else entry[0]
+
+
+def get_unspent_changes(cursor, star_log_hash):
+    """Gets the outputs spent and created by the ship events of a star log.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the current transaction.
+        star_log_hash (str): Hash of the star log, its events must already be in the event tables.
+
+    Returns:
+        tuple: The set of spent keys, and a list of created outputs with the columns in UNSPENT_OUTPUT_COLUMNS.
+    """
+    ship_types = ', '.join('?' * len(util.SHIP_EVENT_TYPES))
+    spent = cursor.execute(
+        'SELECT event_inputs.key FROM event_inputs JOIN events ON events.hash = event_inputs.event_hash AND events.star_log_hash = event_inputs.star_log_hash WHERE event_inputs.star_log_hash=? AND events.type IN (%s)' % ship_types,
+        [star_log_hash] + util.SHIP_EVENT_TYPES
+    ).fetchall()
+    # Outputs without a star system are in the system of the star log they were added in.
+    created = cursor.execute(
+        'SELECT event_outputs.key, event_outputs.height, event_outputs.star_log_hash, events.event_index, event_outputs.output_index, event_outputs.type, event_outputs.fleet_hash, COALESCE(event_outputs.star_system, event_outputs.star_log_hash), event_outputs.count FROM event_outputs JOIN events ON events.hash = event_outputs.event_hash AND events.star_log_hash = event_outputs.star_log_hash WHERE event_outputs.star_log_hash=? AND events.type IN (%s) AND event_outputs.type IN (%s)' % (ship_types, ship_types),
+        [star_log_hash] + util.SHIP_EVENT_TYPES + util.SHIP_EVENT_TYPES
+    ).fetchall()
+    return set(entry[0] for entry in spent), created
+
+
+def get_unspent_rows(cursor, star_log_hash):
+    """Rebuilds the unspent outputs of a star log from its nearest ancestor with a state.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the current transaction.
+        star_log_hash (str): Hash of the star log.
+
+    Returns:
+        dict: Unspent outputs by key, with the columns in UNSPENT_OUTPUT_COLUMNS, or None if an ancestor is missing.
+    """
+    path = []
+    state_id = get_unspent_state_id(cursor, star_log_hash)
+    if state_id is None and not util.is_genesis_star_log(star_log_hash):
+        previous_hash = None
+        for current_hash, previous_hash in iterate_chain(star_log_hash, ['hash', 'previous_hash']):
+            state_id = get_unspent_state_id(cursor, current_hash)
+            if state_id is not None:
+                break
+            path.append(current_hash)
+        if state_id is None and (previous_hash is None or not util.is_genesis_star_log(previous_hash)):
+            return None
+    results = {}
+    if state_id is not None:
+        for entry in cursor.execute('SELECT %s FROM unspent_outputs WHERE state_id=?' % UNSPENT_OUTPUT_COLUMNS, (state_id,)).fetchall():
+            results[entry[0]] = entry
+    for star_log_hash in reversed(path):
+        spent, created = get_unspent_changes(cursor, star_log_hash)
+        for key in spent:
+            results.pop(key, None)
+        for entry in created:
+            results[entry[0]] = entry
+    return results
+
+
+def add_unspent_state(cursor, star_log_hash, rows):
+    state_id = cursor.execute('SELECT COALESCE(MAX(state_id), 0) + 1 FROM unspent_states').fetchone()[0]
+    cursor.execute('INSERT INTO unspent_states VALUES (?, ?)', (star_log_hash, state_id))
+    cursor.executemany('INSERT INTO unspent_outputs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [(state_id,) + tuple(row) for row in rows])
+    return state_id
+
+
+def insert_unspent_outputs(cursor, star_logs_json):
+    """Adds the unspent outputs state of each star log, derived from its parent's state.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the transaction the star logs are being added with.
+        star_logs_json (list): StarLogs being added, ordered by height, their events must already be in the event tables.
+    """
+    for star_log_json in star_logs_json:
+        star_log_hash = star_log_json['hash']
+        previous_hash = star_log_json['previous_hash']
+        parent_state_id = get_unspent_state_id(cursor, previous_hash)
+        if parent_state_id is None:
+            parent_rows = get_unspent_rows(cursor, previous_hash)
+            if parent_rows is None:
+                # Until an orphan's ancestors are added its state is unknown, so it's rebuilt whenever it's needed.
+                continue
+            state_id = add_unspent_state(cursor, star_log_hash, parent_rows.values())
+        elif not is_unspent_checkpoint(cursor.execute('SELECT height FROM star_logs WHERE hash=?', (previous_hash,)).fetchone()[0]):
+            # The parent was a tip, so nothing else needs its state.
+            cursor.execute('UPDATE unspent_states SET star_log_hash=? WHERE star_log_hash=?', (star_log_hash, previous_hash))
+            state_id = parent_state_id
+        else:
+            state_id = add_unspent_state(cursor, star_log_hash, [])
+            cursor.execute('INSERT INTO unspent_outputs SELECT ?, %s FROM unspent_outputs WHERE state_id=?' % UNSPENT_OUTPUT_COLUMNS, (state_id, parent_state_id))
+        spent, created = get_unspent_changes(cursor, star_log_hash)
+        cursor.executemany('DELETE FROM unspent_outputs WHERE state_id=? AND key=?', [(state_id, key) for key in spent])
+        cursor.executemany('INSERT INTO unspent_outputs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [(state_id,) + tuple(row) for row in created])
+
+
+def remove_unspent_state(cursor, system_hash, previous_hash):
+    """Removes the unspent outputs state of a star log being removed, giving its parent a state if it's a tip again.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the transaction the star log is being removed with.
+        system_hash (str): Hash of the star log, which must already be removed from the other tables.
+        previous_hash (str): Hash of the star log's parent.
+    """
+    state_id = get_unspent_state_id(cursor, system_hash)
+    if state_id is not None:
+        cursor.execute('DELETE FROM unspent_states WHERE star_log_hash=?', (system_hash,))
+        cursor.execute('DELETE FROM unspent_outputs WHERE state_id=?', (state_id,))
+    if get_unspent_state_id(cursor, previous_hash) is not None:
+        return
+    if cursor.execute('SELECT 1 FROM star_logs WHERE previous_hash=?', (previous_hash,)).fetchone():
+        return
+    parent_rows = get_unspent_rows(cursor, previous_hash)
+    if parent_rows is not None and cursor.execute('SELECT 1 FROM star_logs WHERE hash=?', (previous_hash,)).fetchone():
+        add_unspent_state(cursor, previous_hash, parent_rows.values())
+
+
+def remove_star_log(system_hash):
+    with transaction(write=True) as cursor:
+        parent = cursor.execute('SELECT previous_hash FROM star_logs WHERE hash=?', (system_hash,)).fetchone()
+        cursor.execute('DELETE FROM star_logs WHERE hash=?', (system_hash,))
+        cursor.execute('DELETE FROM events WHERE star_log_hash=?', (system_hash,))
+        cursor.execute('DELETE FROM event_inputs WHERE star_log_hash=?', (system_hash,))
+        cursor.execute('DELETE FROM event_outputs WHERE star_log_hash=?', (system_hash,))
+        cursor.execute('DELETE FROM star_log_ancestors WHERE hash=?', (system_hash,))
+        cursor.execute('DELETE FROM star_log_tips WHERE hash=?', (system_hash,))
+        remove_fleets(cursor, system_hash)
+        star_logs.remove(system_hash)
+        if star_log_hashes['index'] is not None:
+            star_log_hashes['index'].remove(system_hash)
+        if parent is not None:
+            remove_unspent_state(cursor, system_hash, parent[0])
+            previous = cursor.execute('SELECT height FROM star_logs WHERE hash=?', (parent[0],)).fetchone()
+            if previous is not None and cursor.execute('SELECT 1 FROM star_logs WHERE previous_hash=?', (parent[0],)).fetchone() is None:
+                cursor.execute('INSERT OR IGNORE INTO star_log_tips VALUES (?, ?)', (parent[0], previous[0]))
+
+
+def load_star_log(system_hash, star_log_json):
+    """Decodes a star log, reusing the decoded star log if it was loaded recently.
+
+    Args:
+        system_hash (str): Hash of the star log.
+        star_log_json: Json of the star log, as stored.
 
-        values = (star_log_json['hash'], star_log_json['previous_hash'], star_log_json['height'], star_log_json['time'], json.dumps(star_log_json))
-        cursor.execute('INSERT INTO star_logs VALUES (?, ?, ?, ?, ?)', values)
-        connection.commit()
-    finally:
-        connection.close()
+    Returns:
+        dict: A copy of the decoded star log that the caller is free to change.
+    """
+    star_log = star_logs.get(system_hash)
+    return decode_star_log(system_hash, star_log_json) if star_log is None else util.copy_star_log(star_log)
+
+
+def decode_star_log(system_hash, star_log_json):
+    star_log = decode_star_log_record(star_log_json)
+    star_logs.put(system_hash, star_log, len(star_log_json))
+    return util.copy_star_log(star_log)
+
+
+def get_star_log_cache_statistics():
+    return star_logs.get_statistics()
 
 
 def get_star_log_latest():
-    connection, cursor = begin()
-    try:
-        result = cursor.execute('SELECT json FROM star_logs ORDER BY time DESC').fetchone()
-        return None if result is None else json.loads(result[0])
-    finally:
-        connection.close()
+    with transaction() as cursor:
+        result = cursor.execute('SELECT hash, json FROM star_logs ORDER BY time DESC').fetchone()
+        return None if result is None else load_star_log(result[0], result[1])
 
 
 def get_star_log_children(system_hash):
-    connection, cursor = begin()
-    try:
+    with transaction() as cursor:
         results = []
-        children = cursor.execute('SELECT json FROM star_logs WHERE previous_hash=?', (system_hash,)).fetchall()
+        children = cursor.execute('SELECT hash, json FROM star_logs WHERE previous_hash=?', (system_hash,)).fetchall()
         for child in children:
-            results.append(json.loads(child[0]))
+            results.append(load_star_log(child[0], child[1]))
         return results
-    finally:
-        connection.close()
 
 
 def get_star_log_highest(system_hash=None):
-    connection, cursor = begin()
-    try:
+    with transaction() as cursor:
         if system_hash:
-            target_system = get_star_log(system_hash)
+            target_system = get_star_log_header(system_hash)
             if target_system is None:
                 return None
-            checked = []
-            highest_child = None
-            results = cursor.execute('SELECT hash, previous_hash, height, json FROM star_logs WHERE height > ? ORDER BY height DESC', (target_system['height'],)).fetchall()
-            for entry in results:
-                if entry[0] in checked:
-                    continue
-                checked.append(entry[0])
-                previous_hash = entry[1]
-                while previous_hash != system_hash:
-                    current_parent = get_star_log(previous_hash)
-                    if current_parent['hash'] in checked:
-                        break
-                    checked.append(current_parent['hash'])
-                    if current_parent['height'] <= target_system['height']:
-                        break
-                    previous_hash = current_parent['previous_hash']
-                if previous_hash == system_hash:
-                    highest_child = json.loads(entry[3])
-                    break
-            return target_system if highest_child is None else highest_child
+            # The highest descendant can't have children, so it's the highest tip the target is an ancestor of. Tips at
+            # the same height resolve to the first one seen.
+            tips = cursor.execute('''SELECT star_log_tips.hash FROM star_log_tips JOIN star_logs ON star_logs.hash = star_log_tips.hash
+                                     WHERE star_log_tips.height > ? ORDER BY star_log_tips.height DESC, star_logs.rowid''', (target_system['height'],)).fetchall()
+            for entry in tips:
+                if get_ancestor_hash(cursor, entry[0], target_system['height']) == system_hash:
+                    return get_star_log(entry[0])
+            return get_star_log(system_hash)
         else:
-            result = cursor.execute('SELECT json FROM star_logs ORDER BY height DESC').fetchone()
-            return None if result is None else json.loads(result[0])
-    finally:
-        connection.close()
+            # Forks at the same height resolve to the first one seen.
+            result = cursor.execute('SELECT hash, json FROM star_logs ORDER BY height DESC, rowid LIMIT 1').fetchone()
+            return None if result is None else load_star_log(result[0], result[1])
 
 
 def get_star_log(system_hash):
-    connection, cursor = begin()
-    try:
+    star_log = star_logs.get(system_hash)
+    if star_log is not None:
+        return util.copy_star_log(star_log)
+    with transaction() as cursor:
         result = cursor.execute('SELECT json FROM star_logs WHERE hash=?', (system_hash,)).fetchone()
-        return None if result is None else json.loads(result[0])
-    finally:
-        connection.close()
+        return None if result is None else decode_star_log(system_hash, result[0])
+
+
+def get_star_log_header(system_hash):
+    """Gets a star log without its events, which compact records can skip decoding.
+
+    Args:
+        system_hash (str): Hash of the star log.
+
+    Returns:
+        dict: Json data for the star log, without the events field.
+    """
+    star_log = star_logs.get(system_hash)
+    if star_log is not None:
+        star_log = dict(star_log)
+        del star_log['events']
+        return star_log
+    with transaction() as cursor:
+        result = cursor.execute('SELECT json FROM star_logs WHERE hash=?', (system_hash,)).fetchone()
+        return None if result is None else decode_star_log_record(result[0], False)
 
 
 def get_star_log_at_height(system_hash, height):
-    connection, cursor = begin()
-    try:
+    with transaction() as cursor:
         db_result = cursor.execute('SELECT height, hash, previous_hash, json FROM star_logs WHERE hash=?', (system_hash,)).fetchone()
         if db_result is None:
             return None
         relative_height = db_result[0]
         if relative_height == height:
-            return json.loads(db_result[3])
-        decreasing = height < relative_height
+            return load_star_log(db_result[1], db_result[3])
+        if height < relative_height:
+            ancestor_hash = get_ancestor_hash(cursor, system_hash, height)
+            return None if ancestor_hash is None else get_star_log(ancestor_hash)
         while db_result is not None and db_result[0] != height:
-            if decreasing:
-                if db_result[0] == 0:
-                    return None
-                db_result = cursor.execute('SELECT height, hash, previous_hash, json FROM star_logs WHERE hash=?', (db_result[2],)).fetchone()
-            else:
-                db_result = cursor.execute('SELECT height, hash, previous_hash, json FROM star_logs WHERE previous_hash=?', (db_result[1],)).fetchone()
-        return None if db_result is None else json.loads(db_result[3])
-    finally:
-        connection.close()
+            db_result = cursor.execute('SELECT height, hash, previous_hash, json FROM star_logs WHERE previous_hash=?', (db_result[1],)).fetchone()
+        return None if db_result is None else load_star_log(db_result[1], db_result[3])
 
 
 def get_star_logs_at_height(height, limit):
-    connection, cursor = begin()
-    try:
-        db_results = cursor.execute('SELECT json FROM star_logs WHERE height=? LIMIT ?', (height, limit)).fetchall()
+    with transaction() as cursor:
+        db_results = cursor.execute('SELECT hash, json FROM star_logs WHERE height=? LIMIT ?', (height, limit)).fetchall()
         results = []
         for result in db_results:
-            results.append(json.loads(result[0]))
+            results.append(load_star_log(result[0], result[1]))
         return results
-    finally:
-        connection.close()
 
 
 def get_star_log_hashes(system_hash=None, from_highest=False):
-    connection, cursor = begin()
-    try:
+    with transaction() as cursor:
         if from_highest:
             system_hash = get_star_log_highest()['hash']
 
         if system_hash:
             last_hash = system_hash if from_highest else get_star_log_highest(system_hash)['hash']
-            results = []
-            while not util.is_genesis_star_log(last_hash):
-                results.append(last_hash)
-                last_hash = get_star_log(last_hash)['previous_hash']
-            return results
+            return [entry[0] for entry in iterate_chain(last_hash, ['hash'])]
         else:
             fetched = cursor.execute('SELECT hash FROM star_logs').fetchall()
             results = []
             for entry in fetched:
                 results.append(entry[0])
             return results
-    finally:
-        connection.close()
+
+
+def match_star_log_hash(query):
+    """Gets the hash of the star log a fragment is found earliest in, the same as natural_match over every stored hash
+    in the order they were stored.
+
+    Args:
+        query (str): Fragment of a star log hash.
+
+    Returns:
+        str: The hash, or None if no stored star log contains the fragment.
+    """
+    index = get_hash_index(star_log_hashes)
+    while True:
+        result = index.match(query)
+        # Anything removed by another connection since the index caught up is dropped as it's found.
+        if result is None or get_star_log_header(result) is not None:
+            return result
+        index.remove(result)
+
+
+def get_hash_index(hashes):
+    """Gets the index of the hashes stored in a table, loading or building it if this process hasn't yet.
+
+    The index is caught up with hashes other connections stored since it last was, and is rebuilt and persisted when
+    enough have been.
+
+    Args:
+        hashes (dict): State of the index, star_log_hashes or fleet_hashes.
+
+    Returns:
+        hash_index.HashIndex: The index.
+    """
+    with transaction() as cursor:
+        index = hashes['index']
+        data_version = cursor.execute('PRAGMA data_version').fetchone()[0]
+        if index is None:
+            index = load_hash_index(cursor, hashes)
+        elif data_version != hashes['data_version']:
+            for entry in cursor.execute('SELECT %s, rowid FROM %s WHERE rowid > ?' % (hashes['column'], hashes['table']), (hashes['rowid'],)).fetchall():
+                index.add(entry[0], entry[1])
+            # Rowids are reused after the last row is removed, which only a count can tell.
+            if cursor.execute('SELECT COUNT(*) FROM %s' % hashes['table']).fetchone()[0] != len(index):
+                update_hash_index(cursor, hashes, index)
+        if index.is_stale():
+            index.rebuild()
+            save_hash_index(hashes, index)
+        hashes['index'] = index
+        hashes['rowid'] = cursor.execute('SELECT COALESCE(MAX(rowid), 0) FROM %s' % hashes['table']).fetchone()[0]
+        hashes['data_version'] = data_version
+        return index
+
+
+def load_hash_index(cursor, hashes):
+    if hash_index_persist() and is_file(hash_index_location(hashes)):
+        try:
+            index = hash_index.HashIndex.load(hash_index_location(hashes))
+            update_hash_index(cursor, hashes, index)
+            return index
+        except (BadZipfile, IOError, KeyError, ValueError):
+            # An unreadable index is just built again.
+            pass
+    index = hash_index.HashIndex(cursor.execute('SELECT %s, rowid FROM %s' % (hashes['column'], hashes['table'])).fetchall())
+    save_hash_index(hashes, index)
+    return index
+
+
+def update_hash_index(cursor, hashes, index):
+    stored = dict(cursor.execute('SELECT %s, rowid FROM %s' % (hashes['column'], hashes['table'])).fetchall())
+    indexed = dict(index.get_entries())
+    for value, rowid in stored.items():
+        if indexed.get(value) != rowid:
+            index.add(value, rowid)
+    for value in set(indexed) - set(stored):
+        index.remove(value)
+
+
+def add_to_hash_index(cursor, hashes, values):
+    """Adds newly stored hashes to an index, if this process has loaded it.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the transaction the hashes are being stored with.
+        hashes (dict): State of the index, star_log_hashes or fleet_hashes.
+        values (list): The stored hashes.
+    """
+    if hashes['index'] is None:
+        return
+    for i in range(0, len(values), 500):
+        page = values[i:i + 500]
+        for entry in cursor.execute('SELECT %s, rowid FROM %s WHERE %s IN (%s)' % (hashes['column'], hashes['table'], hashes['column'], ', '.join('?' * len(page))), page).fetchall():
+            hashes['index'].add(entry[0], entry[1])
+
+
+def save_hash_index(hashes, index):
+    if hash_index_persist():
+        index.save(hash_index_location(hashes))
+
+
+STAR_LOG_COLUMNS = ['hash', 'previous_hash', 'height', 'time', 'json']
+
+
+def iterate_chain(system_hash, columns=None):
+    """Walks from a star log to the genesis star log, fetching a page of ancestors per query.
+
+    Pages are fetched in their own transactions, so the walk can be abandoned or interleaved with other queries.
+
+    Args:
+        system_hash (str): Hash of the star log to start from.
+        columns (list): Columns of the star_logs table to yield, every column if None.
+
+    Yields:
+        tuple: The requested columns of the star log then each of its ancestors, ending early if an ancestor is missing.
+    """
+    columns = STAR_LOG_COLUMNS if columns is None else columns
+    for column in columns:
+        if column not in STAR_LOG_COLUMNS:
+            raise ValueError('Unrecognized star log column %s' % column)
+    query = '''WITH RECURSIVE chain(hash, previous_hash, depth) AS (
+            SELECT hash, previous_hash, 0 FROM star_logs WHERE hash=?
+            UNION ALL
+            SELECT star_logs.hash, star_logs.previous_hash, chain.depth + 1 FROM star_logs JOIN chain ON star_logs.hash = chain.previous_hash
+            LIMIT ?
+        ) SELECT chain.previous_hash, %s FROM chain JOIN star_logs ON star_logs.hash = chain.hash ORDER BY chain.depth''' % ', '.join('star_logs.%s' % column for column in columns)
+    page_size = chain_page_size()
+    while system_hash is not None and not util.is_genesis_star_log(system_hash):
+        with transaction() as cursor:
+            page = cursor.execute(query, (system_hash, page_size)).fetchall()
+        for entry in page:
+            yield entry[1:]
+        if len(page) < page_size:
+            return
+        system_hash = page[-1][0]
 
 
 def get_star_log_highest_from_list(system_hashes):
     highest = None
     for current_hash in system_hashes:
-        current_system = get_star_log(current_hash)
+        current_system = get_star_log_header(current_hash)
         if highest is None or highest['height'] < current_system['height']:
             highest = current_system
     return highest['hash']
@@ -304,112 +1056,287 @@ def get_star_logs_share_chain(system_hashes):
     highest = None
     lowest = None
     for current_hash in system_hashes:
-        current_system = get_star_log(current_hash)
+        current_system = get_star_log_header(current_hash)
         if highest is None or highest['height'] < current_system['height']:
             highest = current_system
         if lowest is None or current_system['height'] < lowest['height']:
             lowest = current_system
-    if None in [highest, lowest]:
+    if None in [highest, lowest] or highest['height'] == lowest['height']:
         return False
-    previous_hash = highest['previous_hash']
-    while not util.is_genesis_star_log(previous_hash):
-        if previous_hash == lowest['hash']:
-            return True
-        current_system = get_star_log(previous_hash)
-        if current_system['height'] <= lowest['height']:
-            return False
-        previous_hash = current_system['previous_hash']
-    return False
+    return is_star_log_ancestor(lowest['hash'], highest['hash'])
+
+
+def get_star_log_ancestry(system_hash):
+    """Gets the hashes of a star log and every one of its ancestors.
+
+    Args:
+        system_hash (str): Hash of the star log to start from.
+
+    Returns:
+        set: Hashes of the star logs on the chain ending at the specified star log.
+    """
+    return set(entry[0] for entry in iterate_chain(system_hash, ['hash']))
+
+
+def get_indexed_keys(table, keys, system_hash):
+    """Gets which keys are indexed in the table by star logs on a chain.
+
+    Each star log indexing a key is checked against the chain's ancestor at its height, so the chain is never walked.
+
+    Args:
+        table (str): Either "event_inputs" or "event_outputs".
+        keys (list): Keys to look up.
+        system_hash (str): Hash of the star log the chain ends at.
+
+    Returns:
+        set: The keys indexed by star logs on the chain.
+    """
+    with transaction() as cursor:
+        results = set()
+        ancestors = {}
+        keys = list(set(keys))
+        # Sqlite limits the number of parameters in a single query.
+        for i in range(0, len(keys), 500):
+            page = keys[i:i + 500]
+            query = 'SELECT key, star_log_hash, height FROM %s WHERE key IN (%s)' % (table, ', '.join('?' * len(page)))
+            for key, star_log_hash, height in cursor.execute(query, page).fetchall():
+                if height not in ancestors:
+                    ancestors[height] = get_ancestor_hash(cursor, system_hash, height)
+                if ancestors[height] == star_log_hash:
+                    results.add(key)
+        return results
+
+
+def get_used_keys(keys, system_hash):
+    """Gets which keys have been used as inputs on a chain.
+
+    Args:
+        keys (list): Keys to look up.
+        system_hash (str): Hash of the star log the chain ends at.
+
+    Returns:
+        set: The keys used as inputs.
+    """
+    return get_indexed_keys('event_inputs', keys, system_hash)
+
+
+def get_existing_keys(keys, system_hash):
+    """Gets which keys have been used as either inputs or outputs on a chain.
+
+    Args:
+        keys (list): Keys to look up.
+        system_hash (str): Hash of the star log the chain ends at.
+
+    Returns:
+        set: The keys used as inputs or outputs.
+    """
+    return get_indexed_keys('event_inputs', keys, system_hash) | get_indexed_keys('event_outputs', keys, system_hash)
+
+
+def get_unspent_keys(keys, system_hash):
+    """Gets which keys are ship outputs on a chain that haven't been used as inputs since.
+
+    Args:
+        keys (list): Keys to look up.
+        system_hash (str): Hash of the star log the chain ends at.
+
+    Returns:
+        set: The unspent output keys.
+    """
+    with transaction() as cursor:
+        state_id = get_unspent_state_id(cursor, system_hash)
+        if state_id is None:
+            return set(keys).intersection(get_unspent_rows(cursor, system_hash) or {})
+        results = set()
+        keys = list(set(keys))
+        for i in range(0, len(keys), 500):
+            page = keys[i:i + 500]
+            query = 'SELECT key FROM unspent_outputs WHERE state_id=? AND key IN (%s)' % ', '.join('?' * len(page))
+            results.update(entry[0] for entry in cursor.execute(query, [state_id] + page).fetchall())
+        return results
 
 
 def get_unused_events(from_star_log=None, system_hash=None, fleet_hash=None):
     if from_star_log is None:
         from_star_log = get_star_log_highest(system_hash)['hash']
-    used_events = []
+    with transaction() as cursor:
+        state_id = get_unspent_state_id(cursor, from_star_log)
+        if state_id is None:
+            outputs = (get_unspent_rows(cursor, from_star_log) or {}).values()
+            outputs = [entry for entry in outputs if system_hash in (None, entry[7]) and fleet_hash in (None, entry[6])]
+            outputs.sort(key=lambda entry: (-entry[1], entry[3], entry[4]))
+        else:
+            query = 'SELECT %s FROM unspent_outputs WHERE state_id=?' % UNSPENT_OUTPUT_COLUMNS
+            parameters = [state_id]
+            if system_hash is not None:
+                query += ' AND star_system=?'
+                parameters.append(system_hash)
+            if fleet_hash is not None:
+                query += ' AND fleet_hash=?'
+                parameters.append(fleet_hash)
+            query += ' ORDER BY height DESC, event_index, output_index'
+            outputs = cursor.execute(query, parameters).fetchall()
     results = []
-    while not util.is_genesis_star_log(from_star_log):
-        system = get_star_log(from_star_log)
-        for event in system['events']:
-            if event['type'] not in util.SHIP_EVENT_TYPES:
-                continue
-            for event_input in event['inputs']:
-                used_events.append(event_input['key'])
-            for event_output in event['outputs']:
-                if event_output['type'] in util.SHIP_EVENT_TYPES and event_output['key'] not in used_events:
-                    if system_hash is not None:
-                        if event_output['star_system'] is None:
-                            if from_star_log != system_hash:
-                                continue
-                        elif event_output['star_system'] != system_hash:
-                            continue
-                    if fleet_hash is not None and event_output['fleet_hash'] != fleet_hash:
-                        continue
-                    if event_output['star_system'] is None:
-                        event_output['star_system'] = system['hash']
-                    results.append(event_output)
-        from_star_log = system['previous_hash']
+    for key, _, _, _, output_index, output_type, output_fleet_hash, star_system, count in outputs:
+        results.append({
+            'index': output_index,
+            'type': output_type,
+            'fleet_hash': output_fleet_hash,
+            'key': key,
+            'star_system': star_system,
+            'count': count
+        })
     return results
 
 
 def any_events_exist(events, from_star_log=None):
     if from_star_log is None:
         from_star_log = get_star_log_highest()['hash']
-    while not util.is_genesis_star_log(from_star_log):
-        system = get_star_log(from_star_log)
-        for event in system['events']:
-            for eventEntry in event['inputs'] + event['outputs']:
-                if eventEntry['key'] in events:
-                    return True
-        from_star_log = system['previous_hash']
-    return False
+    return 0 < len(get_existing_keys(events, from_star_log))
 
 
 def any_events_used(events, from_star_log=None):
     if from_star_log is None:
         from_star_log = get_star_log_highest()['hash']
-    while not util.is_genesis_star_log(from_star_log):
-        system = get_star_log(from_star_log)
-        for event in system['events']:
-            for event_entry in event['inputs']:
-                if event_entry['key'] in events:
-                    return True
-        from_star_log = system['previous_hash']
-    return False
+    return 0 < len(get_used_keys(events, from_star_log))
 
 
 def get_fleets(from_star_log=None):
+    """Gets the fleets with outputs on a chain, the most recently active first.
+
+    Args:
+        from_star_log (str): Hash of the star log the chain ends at, the highest star log if None.
+
+    Returns:
+        list: Hashes of the fleets.
+    """
     if from_star_log is None:
         from_star_log = get_star_log_highest()['hash']
-    results = []
-    while not util.is_genesis_star_log(from_star_log):
-        system = get_star_log(from_star_log)
-        for event in system['events']:
-            for event_output in event['outputs']:
-                if event_output['fleet_hash'] not in results:
-                    results.append(event_output['fleet_hash'])
-        from_star_log = system['previous_hash']
-    return results
+    ancestry = get_star_log_ancestry(from_star_log)
+    with transaction() as cursor:
+        height = cursor.execute('SELECT height FROM star_logs WHERE hash=?', (from_star_log,)).fetchone()
+        if height is None:
+            return []
+        # No fleet first seen above the chain can be on it, once every other fleet is found the rest can be skipped.
+        remaining = cursor.execute('SELECT COUNT(*) FROM fleets WHERE first_height <= ?', (height[0],)).fetchone()[0]
+        results = []
+        found = set()
+        for fleet_hash, star_log_hash in cursor.execute('SELECT fleet_hash, star_log_hash FROM fleet_star_logs WHERE height <= ? ORDER BY height DESC, rowid', (height[0],)):
+            if star_log_hash in ancestry and fleet_hash not in found:
+                found.add(fleet_hash)
+                results.append(fleet_hash)
+                if len(results) == remaining:
+                    break
+        return results
+
+
+def get_fleet_activity(cursor, fleet_hash, from_star_log):
+    """Finds the star logs on a chain that gave a fleet outputs, the most recent first.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the current transaction.
+        fleet_hash (str): Hash of the fleet.
+        from_star_log (str): Hash of the star log the chain ends at.
+
+    Yields:
+        tuple: The height, star log hash, system and rowid of each of the fleet's registrations on the chain.
+    """
+    chain_height = cursor.execute('SELECT height FROM star_logs WHERE hash=?', (from_star_log,)).fetchone()
+    if chain_height is None:
+        return
+    ancestors = {}
+    for star_log_hash, height, star_system, rowid in cursor.execute('SELECT star_log_hash, height, star_system, rowid FROM fleet_star_logs WHERE fleet_hash=? AND height <= ? ORDER BY height DESC, rowid', (fleet_hash, chain_height[0])).fetchall():
+        if height not in ancestors:
+            ancestors[height] = get_ancestor_hash(cursor, from_star_log, height)
+        if ancestors[height] == star_log_hash:
+            yield height, star_log_hash, star_system, rowid
+
+
+def get_fleet_systems(fleet_hash, from_star_log=None):
+    """Gets the systems a fleet has been given ships in on a chain.
+
+    Args:
+        fleet_hash (str): Hash of the fleet.
+        from_star_log (str): Hash of the star log the chain ends at, the highest star log if None.
+
+    Returns:
+        list: Hashes of the systems, the most recent first.
+    """
+    if from_star_log is None:
+        from_star_log = get_star_log_highest()['hash']
+    with transaction() as cursor:
+        results = []
+        for _, _, star_system, _ in get_fleet_activity(cursor, fleet_hash, from_star_log):
+            if star_system not in results:
+                results.append(star_system)
+        return results
+
+
+def match_fleet_hash(query, from_star_log=None):
+    """Gets the fleet a fragment is found earliest in, the same as natural_match over get_fleets.
+
+    Only the registered fleets containing the fragment are checked for activity on the chain, the most recently active
+    anywhere first, since a fleet can't have been active on the chain after it was last active anywhere.
+
+    Args:
+        query (str): Fragment of a fleet hash.
+        from_star_log (str): Hash of the star log the chain ends at, the highest star log if None.
+
+    Returns:
+        str: Hash of the fleet, or None if no fleet on the chain contains the fragment.
+    """
+    if from_star_log is None:
+        from_star_log = get_star_log_highest()['hash']
+    index = get_hash_index(fleet_hashes)
+    with transaction() as cursor:
+        for _, matches in groupby(index.find(query), key=lambda match: match[0]):
+            candidates = []
+            matches = [fleet_hash for _, fleet_hash in matches]
+            for i in range(0, len(matches), 500):
+                page = matches[i:i + 500]
+                candidates += cursor.execute('SELECT last_height, fleet_hash FROM fleets WHERE fleet_hash IN (%s)' % ', '.join('?' * len(page)), page).fetchall()
+            best = None
+            for last_height, fleet_hash in sorted(candidates, reverse=True):
+                if best is not None and last_height < best[0]:
+                    break
+                for height, _, _, rowid in get_fleet_activity(cursor, fleet_hash, from_star_log):
+                    if best is None or best[0] < height or (best[0] == height and rowid < best[1]):
+                        best = (height, rowid, fleet_hash)
+                    break
+            # Fleets found at a later position only match if none at this one are on the chain.
+            if best is not None:
+                return best[2]
+        return None
+
+
+def any_verified_signature(fleet_key, signature, event_hash):
+    with transaction() as cursor:
+        return cursor.execute('SELECT 1 FROM verified_signatures WHERE hash=? AND signature=? AND fleet_key=?', (event_hash, signature, fleet_key)).fetchone() is not None
+
+
+def add_verified_signatures(entries, limit):
+    """Persists signatures that have been verified, keeping only the most recently added ones.
+
+    Args:
+        entries (list): The (fleet_key, signature, hash) of each verified signature.
+        limit (int): Maximum number of signatures to keep.
+    """
+    with transaction(write=True) as cursor:
+        cursor.executemany('INSERT OR IGNORE INTO verified_signatures VALUES (?, ?, ?)', entries)
+        cursor.execute('DELETE FROM verified_signatures WHERE rowid <= (SELECT MAX(rowid) FROM verified_signatures) - ?', (limit,))
 
 
 def set_meta_content(meta_content=None):
-    connection, cursor = begin()
-    try:
+    with transaction(write=True) as cursor:
         if not cursor.execute('SELECT * FROM persistent').fetchone():
             cursor.execute('INSERT INTO persistent VALUES (?)', (meta_content,))
-            connection.commit()
             return
         cursor.execute('UPDATE persistent SET meta_content=?', (meta_content,))
-        connection.commit()
-    finally:
-        connection.close()
 
 
 def get_meta_content():
-    connection, cursor = begin()
-    try:
+    with transaction() as cursor:
         entry = cursor.execute('SELECT * FROM persistent').fetchone()
         if entry is None or entry[0] is None:
             return None
         return entry[0]
-    finally:
-        connection.close()
\ No newline at end of file
@@ -0,0 +1,350 @@
+import bisect
+import heapq
+import os
+import re
+import tempfile
+import threading
+
+import numpy
+
+import parameter_util as putil
+
+# Hashes are indexed by every run of this many digits, queries at least this long are answered from the postings.
+GRAM_LENGTH = 4
+HASH_LENGTH = 64
+# Postings pack the position a gram starts at above the rank of the hash it's in, so sorting them orders by position
+# and then by rank. Hashes are ranked in the order they were added, so ties go to the one added first.
+POSITION_SHIFT = 24
+RANK_MASK = (1 << POSITION_SHIFT) - 1
+EMPTY_POSTING = numpy.uint32(0xffffffff)
+# Postings are verified in chunks, since the first match is usually close to the start.
+VERIFY_CHUNK = 4096
+HEX_DIGITS = '0123456789abcdef'
+HEX_PATTERN = re.compile('^[0-9a-f]*$')
+
+DIGIT_VALUES = numpy.zeros(256, dtype=numpy.uint8)
+DIGIT_VALUES[numpy.frombuffer(HEX_DIGITS, dtype=numpy.uint8)] = numpy.arange(16, dtype=numpy.uint8)
+
+
+def is_indexable(value):
+    return len(value) == HASH_LENGTH and is_hex(value)
+
+
+def is_hex(value):
+    return HEX_PATTERN.match(value) is not None
+
+
+def get_digits(hashes):
+    if not hashes:
+        return numpy.zeros((0, HASH_LENGTH), dtype=numpy.uint8)
+    return DIGIT_VALUES[numpy.frombuffer(''.join(hashes), dtype=numpy.uint8)].reshape((len(hashes), HASH_LENGTH))
+
+
+def get_codes(digits, position, length):
+    """Gets the number each row's run of hex digits encodes.
+
+    Args:
+        digits (numpy.array): Digits of each hash, a row per hash.
+        position (int): Position the runs start at.
+        length (int): Number of digits in each run.
+
+    Returns:
+        numpy.array: The number encoded by each row's run.
+    """
+    codes = numpy.zeros(len(digits), dtype=numpy.int64)
+    for column in range(position, position + length):
+        codes = (codes << 4) | digits[:, column]
+    return codes
+
+
+def remove_entry(entries, entry):
+    index = bisect.bisect_left(entries, entry)
+    if index < len(entries) and entries[index] == entry:
+        del entries[index]
+
+
+class HashIndex(object):
+    """Index of the hex digit runs in a set of sha256 hashes, answering which hash a fragment is found earliest in.
+
+    Every hash is added with an order, usually the rowid it's stored at. Matches are the same as
+    parameter_util.natural_match given the hashes in that order. Hashes added after the index is built are searched
+    without it until rebuild is called, and values that aren't sha256 hashes are never indexed.
+
+    Safe to share between threads.
+    """
+
+    def __init__(self, entries=()):
+        self.lock = threading.Lock()
+        self.build(entries)
+
+    def __len__(self):
+        return len(self.orders)
+
+    def build(self, entries):
+        """Indexes the hashes, replacing anything indexed before.
+
+        Args:
+            entries (list): The (hash, order) of each hash, in any order.
+        """
+        self.orders = dict(entries)
+        indexed = sorted((order, str(value)) for value, order in self.orders.items() if is_indexable(value))
+        self.hashes = [value for _, value in indexed]
+        self.hash_orders = [order for order, _ in indexed]
+        self.ranks = dict((value, rank) for rank, value in enumerate(self.hashes))
+        self.others = sorted((order, value) for value, order in self.orders.items() if not is_indexable(value))
+        self.pending = []
+        self.removed = set()
+        self.digits = get_digits(self.hashes)
+        if RANK_MASK < len(self.hashes):
+            raise ValueError('Cannot index more than %s hashes' % RANK_MASK)
+        ranks = numpy.arange(len(self.hashes), dtype=numpy.uint32)
+        positions = range(0, HASH_LENGTH - GRAM_LENGTH + 1)
+        codes = numpy.concatenate([get_codes(self.digits, position, GRAM_LENGTH).astype(numpy.uint16) for position in positions])
+        postings = numpy.concatenate([(numpy.uint32(position) << POSITION_SHIFT) | ranks for position in positions])
+        sorted_postings = []
+        counts = numpy.zeros(16 ** GRAM_LENGTH, dtype=numpy.int64)
+        # Sorted with the gram above each posting, which orders every gram's postings by position and rank. Sorting a
+        # leading digit at a time keeps the sort from taking much more memory than the postings.
+        for leading in range(0, 16):
+            in_leading = (codes >> (4 * (GRAM_LENGTH - 1))) == leading
+            leading_codes = codes[in_leading]
+            keys = (leading_codes.astype(numpy.uint64) << numpy.uint64(32)) | postings[in_leading]
+            keys.sort()
+            sorted_postings.append((keys & numpy.uint64(0xffffffff)).astype(numpy.uint32))
+            counts += numpy.bincount(leading_codes, minlength=16 ** GRAM_LENGTH)
+        self.postings = numpy.concatenate(sorted_postings)
+        self.starts = numpy.concatenate([[0], numpy.cumsum(counts)])
+        self.build_earliest()
+
+    def build_earliest(self):
+        # Queries shorter than a gram only need the earliest posting of each shorter run.
+        self.earliest = [None]
+        for length in range(1, GRAM_LENGTH):
+            earliest = numpy.empty(16 ** length, dtype=numpy.uint32)
+            earliest.fill(EMPTY_POSTING)
+            for position in range(0, HASH_LENGTH - length + 1):
+                if not (earliest == EMPTY_POSTING).any():
+                    break
+                unique_codes, first_ranks = numpy.unique(get_codes(self.digits, position, length), return_index=True)
+                unset = earliest[unique_codes] == EMPTY_POSTING
+                earliest[unique_codes[unset]] = (numpy.uint32(position) << POSITION_SHIFT) | first_ranks[unset].astype(numpy.uint32)
+            self.earliest.append(earliest)
+
+    def get_entries(self):
+        """Gets the (hash, order) of every hash, the same as were added and not removed since."""
+        with self.lock:
+            return self.orders.items()
+
+    def get_hashes(self):
+        with self.lock:
+            return [value for value, _ in sorted(self.orders.items(), key=lambda entry: entry[1])]
+
+    def is_indexed(self, value, order):
+        rank = self.ranks.get(value)
+        return rank is not None and self.hash_orders[rank] == order
+
+    def add(self, value, order):
+        """Adds a hash, or moves it to a new order if it was already added with another.
+
+        Args:
+            value (str): The hash.
+            order (int): Order of the hash, ties between matches go to the lowest.
+        """
+        with self.lock:
+            if self.orders.get(value) == order:
+                return
+            if value in self.orders:
+                self.remove_locked(value)
+            self.orders[value] = order
+            if self.is_indexed(value, order):
+                self.removed.discard(self.ranks[value])
+                return
+            entries = self.pending if is_indexable(value) else self.others
+            bisect.insort(entries, (order, str(value) if entries is self.pending else value))
+
+    def remove(self, value):
+        with self.lock:
+            self.remove_locked(value)
+
+    def remove_locked(self, value):
+        order = self.orders.pop(value, None)
+        if order is None:
+            return
+        if self.is_indexed(value, order):
+            self.removed.add(self.ranks[value])
+            return
+        remove_entry(self.pending, (order, value))
+        remove_entry(self.others, (order, value))
+
+    def is_stale(self):
+        """Checks if enough hashes were added or removed since the index was built that it's worth rebuilding."""
+        return max(1024, len(self.hashes) / 16) < len(self.pending) + len(self.removed)
+
+    def rebuild(self):
+        entries = self.get_entries()
+        with self.lock:
+            self.build(entries)
+
+    def match(self, query):
+        """Gets the hash the query is found earliest in.
+
+        Args:
+            query (str): Fragment of a hash.
+
+        Returns:
+            str: The hash, or None if no hash contains the query.
+        """
+        with self.lock:
+            results = [self.match_indexed(query), self.match_entries(query, self.pending), self.match_entries(query, self.others)]
+        results = [result for result in results if result is not None]
+        return min(results)[2] if results else None
+
+    def match_entries(self, query, entries):
+        value = putil.natural_match(query, [value for _, value in entries])
+        return None if value is None else (value.find(query), self.orders[value], value)
+
+    def get_match(self, posting):
+        rank = int(posting & RANK_MASK)
+        return int(posting >> POSITION_SHIFT), self.hash_orders[rank], self.hashes[rank]
+
+    def match_indexed(self, query):
+        if not self.hashes or not is_hex(query):
+            return None
+        if len(query) < GRAM_LENGTH:
+            posting = EMPTY_POSTING if len(query) == 0 else self.earliest[len(query)][int(query, 16)]
+            if posting != EMPTY_POSTING and int(posting & RANK_MASK) not in self.removed:
+                return self.get_match(posting)
+            # Without the earliest run, every hash is searched instead.
+            return self.match_entries(query, [(None, value) for rank, value in enumerate(self.hashes) if rank not in self.removed])
+        for result in self.iterate_postings(query, self.removed):
+            return result
+        return None
+
+    def iterate_postings(self, query, removed):
+        """Verifies the postings of a query's rarest gram, generating the matches in order of position and rank.
+
+        Args:
+            query (str): Fragment of a hash, at least GRAM_LENGTH digits long.
+            removed (set): Ranks of removed hashes to skip.
+
+        Yields:
+            tuple: The position, order and hash of each match, a hash only at the first position it's found at.
+        """
+        # Any gram of the query finds the same matches, the one with the fewest postings is checked.
+        offset = min(range(0, len(query) - GRAM_LENGTH + 1), key=lambda start: self.count_postings(query[start:start + GRAM_LENGTH]))
+        code = int(query[offset:offset + GRAM_LENGTH], 16)
+        digits = [HEX_DIGITS.index(character) for character in query]
+        found = set()
+        end = self.starts[code + 1]
+        for start in range(self.starts[code], end, VERIFY_CHUNK):
+            postings = self.postings[start:min(start + VERIFY_CHUNK, end)]
+            positions = (postings >> POSITION_SHIFT).astype(numpy.int64) - offset
+            ranks = (postings & RANK_MASK).astype(numpy.int64)
+            matched = (0 <= positions) & (positions + len(query) <= HASH_LENGTH)
+            for column, digit in enumerate(digits):
+                if offset <= column < offset + GRAM_LENGTH:
+                    continue
+                matched &= self.digits[ranks, numpy.clip(positions + column, 0, HASH_LENGTH - 1)] == digit
+            for index in numpy.flatnonzero(matched):
+                rank = int(ranks[index])
+                if rank not in removed and rank not in found:
+                    found.add(rank)
+                    yield int(positions[index]), self.hash_orders[rank], self.hashes[rank]
+
+    def count_postings(self, gram):
+        code = int(gram, 16)
+        return self.starts[code + 1] - self.starts[code]
+
+    def find(self, query):
+        """Finds every hash the query is found in.
+
+        Args:
+            query (str): Fragment of a hash.
+
+        Yields:
+            tuple: The position and hash of each match, ordered the way match picks between them.
+        """
+        with self.lock:
+            # Builds replace the arrays rather than change them, so a copy of the rest is enough to search without the lock.
+            index = HashIndex.__new__(HashIndex)
+            index.__dict__.update(self.__dict__)
+            removed = set(self.removed)
+            unindexed = self.pending + self.others
+        matches = sorted((value.find(query), order, value) for order, value in unindexed if query in value)
+        if not index.hashes or not is_hex(query):
+            indexed = []
+        elif len(query) < GRAM_LENGTH:
+            indexed = sorted((value.find(query), index.hash_orders[rank], value) for rank, value in enumerate(index.hashes) if rank not in removed and query in value)
+        else:
+            indexed = index.iterate_postings(query, removed)
+        for position, _, value in heapq.merge(indexed, matches):
+            yield position, value
+
+    def save(self, path):
+        """Writes the index to a file, rebuilding it first if hashes were added or removed since it was built.
+
+        Args:
+            path (str): Location of the file.
+        """
+        if self.pending or self.removed:
+            self.rebuild()
+        with self.lock:
+            arrays = {
+                'hashes': numpy.array(self.hashes, dtype='S%s' % HASH_LENGTH),
+                'hash_orders': numpy.array(self.hash_orders, dtype=numpy.int64),
+                'others': numpy.array([value.encode('utf-8') for _, value in self.others] or [''], dtype='S')[:len(self.others)],
+                'other_orders': numpy.array([order for order, _ in self.others], dtype=numpy.int64),
+                'postings': self.postings,
+                'starts': self.starts
+            }
+            for length in range(1, GRAM_LENGTH):
+                arrays['earliest_%s' % length] = self.earliest[length]
+        # Every process writes its own temporary file and renames it over the index, so a partially written index is
+        # never loaded and processes saving at once don't write over each other's.
+        try:
+            descriptor, temporary = tempfile.mkstemp(prefix='%s.' % os.path.basename(path), suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+        except OSError:
+            return
+        try:
+            with os.fdopen(descriptor, 'wb') as index_file:
+                numpy.savez(index_file, **arrays)
+            try:
+                os.rename(temporary, path)
+            except OSError:
+                # Renaming over an existing file fails on Windows.
+                os.remove(path)
+                os.rename(temporary, path)
+        except (IOError, OSError):
+            # Another process saved or removed the index in between, whichever index it left is as good as this one.
+            pass
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    @classmethod
+    def load(cls, path):
+        """Reads an index written by save.
+
+        Args:
+            path (str): Location of the file.
+
+        Returns:
+            HashIndex: The index.
+        """
+        arrays = numpy.load(path)
+        index = cls.__new__(cls)
+        index.lock = threading.Lock()
+        index.hashes = arrays['hashes'].tolist()
+        index.hash_orders = arrays['hash_orders'].tolist()
+        index.ranks = dict((value, rank) for rank, value in enumerate(index.hashes))
+        index.others = zip(arrays['other_orders'].tolist(), [value.decode('utf-8') for value in arrays['others'].tolist()])
+        index.orders = dict(zip(index.hashes, index.hash_orders))
+        index.orders.update((value, order) for order, value in index.others)
+        index.pending = []
+        index.removed = set()
+        index.digits = get_digits(index.hashes)
+        index.postings = arrays['postings']
+        index.starts = arrays['starts']
+        index.earliest = [None] + [arrays['earliest_%s' % length] for length in range(1, GRAM_LENGTH)]
+        arrays.close()
+        return index
@@ -3,15 +3,20 @@ from os import getenv, environ
 from sys import stdout, platform
 from traceback import print_exc as print_exception
 from datetime import datetime
+from multiprocessing import Process, freeze_support
+from multiprocessing.pool import ThreadPool
+from threading import Event, Thread
 from time import sleep
 from ete3 import Tree
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives import serialization
 from getch import getch
-from probe_exceptions import CommandException, ProbeTimeoutException
+from probe_exceptions import CommandException, ProbeProcessException, ProbeStaleException, ProbeTimeoutException
 import requests
 import database
+import mining
+import telemetry
 import util
 import validate
 import parameter_util as putil
@@ -24,6 +29,9 @@ import matplotlib.colors as pycolors
 import matplotlib.pyplot as pyplot
 
 AUTO_REBUILD = int(getenv('AUTO_REBUILD', '0')) == 1
+TIP_POLL_INTERVAL = float(getenv('TIP_POLL_INTERVAL', '5'))
+WORK_ADDRESS = getenv('WORK_ADDRESS', 'localhost:6174')
+WORK_AUTHKEY = getenv('WORK_AUTHKEY', None)
 
 # HOST_URL = getenv('HOST_URL', 'http://localhost:5000')
 HOST_URL = getenv('HOST_URL', 'http://api.cryptoverse.io')
@@ -230,6 +238,12 @@ def star_log(params=None):
 
 
 def probe(params=None):
+    if putil.retrieve(params, 'serve-work', True, False):
+        serve_work(params)
+        return
+    if putil.retrieve(params, 'work', True, False):
+        take_work(params)
+        return
     # TODO: Sync first...
     from_genesis = putil.retrieve(params, '-g', True, False)
     post = putil.retrieve(params, '-a', False, True)
@@ -240,96 +254,210 @@ def probe(params=None):
     loop = putil.retrieve(params, '-l', True, False)
     wait = float(putil.retrieve_value(params, '-w', 0.0))
     blind = putil.retrieve(params, '-b', True, False)
+    processes = int(putil.retrieve_value(params, '-j', 1))
+    engine = putil.retrieve_value(params, '-e', None)
     if wait < 0:
         raise CommandException('Cannot use a wait less than zero seconds')
+    if processes < 1:
+        raise CommandException('Cannot probe with less than one process')
+    if engine is not None and engine not in mining.ENGINES:
+        raise CommandException('Unrecognized probing engine %s, try one of %s' % (engine, ', '.join(mining.ENGINES.keys())))
     from_hash = None
     if from_query is not None:
-        from_hash = putil.natural_match(from_query, database.get_star_log_hashes())
+        from_hash = database.match_star_log_hash(from_query)
         if from_hash is None:
             raise CommandException('Unable to find a system hash containing %s' % from_query)
-    if not blind:
-        sync('-s')
-    generated = None
-    started = datetime.now()
-    while generated is None:
-        try:
-            generated = generate_next_star_log(from_hash, from_genesis, allow_duplicate_events, started)
-        except ProbeTimeoutException:
+    # Templates for the next starlog are built, and the last starlog is posted, while probing continues.
+    workers = ThreadPool(2) if loop and post else None
+    next_template = None
+    posting = None
+    previous = None
+    stale = Event()
+    try:
+        while True:
             if not blind:
                 sync('-s')
-    if not silent:
-        print 'Probed new starlog %s' % util.get_system_name(generated['hash'])
-        if verbose:
-            print pretty_json(generated)
-    if not post:
-        return
+            generated = None
+            started = datetime.now()
+            template = None if next_template is None else next_template.get()
+            next_template = None
+            # Templates after the genesis send their reward to it, so none is built ahead while it's being probed.
+            if workers is not None and (from_hash or from_genesis or database.get_star_log_highest() is not None):
+                next_template = workers.apply_async(get_star_log_template, (from_genesis,))
+            while generated is None:
+                stale.clear()
+                try:
+                    generated = generate_next_star_log(from_hash, from_genesis, allow_duplicate_events, started, processes=processes, engine=engine, watch_tip=not blind, template=template, stale=stale)
+                except ProbeTimeoutException:
+                    telemetry.increment('timeout')
+                    if not blind:
+                        sync('-s')
+                except ProbeStaleException:
+                    telemetry.increment('stale')
+                    if not blind:
+                        sync('-s')
+                except ProbeProcessException as exception:
+                    raise CommandException(str(exception))
+                template = None
+            telemetry.set_seconds('find', (datetime.now() - started).total_seconds())
+            if not silent:
+                print 'Probed new starlog %s' % util.get_system_name(generated['hash'])
+                if verbose:
+                    print pretty_json(generated)
+            if posting is not None and not posting.get() and generated['previous_hash'] == previous['hash']:
+                telemetry.increment('stale')
+                if not silent:
+                    print 'Discarding starlog %s, its parent was rejected' % util.get_system_name(generated['hash'])
+                # The parent is removed again in case posting couldn't, so the next starlog isn't probed ontop of it.
+                database.remove_star_log(previous['hash'])
+                posting = None
+                continue
+            telemetry.increment('found')
+            if not post:
+                return
+            # Stored before posting so the next starlog can be probed ontop of it, removed again if rejected.
+            database.add_star_log(generated)
+            if workers is None:
+                post_star_log(generated, silent)
+                return
+            posting = workers.apply_async(post_star_log, (generated, silent, stale))
+            previous = generated
+            if generated['height'] == 0:
+                # Templates ontop of the genesis get it from the server, so it has to be posted first.
+                posting.wait()
+            if 0 < wait:
+                sleep(wait)
+    finally:
+        if workers is not None:
+            workers.close()
+            workers.join()
+
+
+def get_work_address(address):
+    host, _, port = address.rpartition(':')
     try:
+        return host if host else 'localhost', int(port)
+    except ValueError:
+        raise CommandException('Unable to parse "%s" as an address and port' % address)
+
+
+def serve_work(params=None):
+    from_genesis = putil.retrieve(params, '-g', True, False)
+    post = putil.retrieve(params, '-a', False, True)
+    verbose = putil.retrieve(params, '-v', True, False)
+    silent = putil.retrieve(params, '-s', True, False)
+    allow_duplicate_events = putil.retrieve(params, '-d', True, False)
+    from_query = putil.retrieve_value(params, '-f', None)
+    blind = putil.retrieve(params, '-b', True, False)
+    address = get_work_address(putil.retrieve_value(params, '-p', WORK_ADDRESS))
+    from_hash = None
+    if from_query is not None:
+        from_hash = database.match_star_log_hash(from_query)
+        if from_hash is None:
+            raise CommandException('Unable to find a system hash containing %s' % from_query)
+    server = mining.WorkServer(address, WORK_AUTHKEY)
+    server.start()
+    print 'Serving work on %s:%s, press Ctrl+C to stop' % address
+    stale = Event()
+    try:
+        while True:
+            if not blind:
+                sync('-s')
+            stale.clear()
+            started = datetime.now()
+            next_star_log = build_next_star_log(from_hash, from_genesis, allow_duplicate_events)
+            server.publish(next_star_log)
+            watcher_stopped = None
+            if not (blind or from_hash or from_genesis or next_star_log['height'] == 0):
+                watcher_stopped = start_tip_watcher(next_star_log['height'], stale)
+            found = None
+            try:
+                while found is None and not stale.is_set() and (datetime.now() - started).total_seconds() < 180:
+                    found = server.get_solution()
+            finally:
+                server.publish(None)
+                if watcher_stopped is not None:
+                    watcher_stopped.set()
+            if found is None:
+                telemetry.increment('stale' if stale.is_set() else 'timeout')
+                continue
+            telemetry.increment('found')
+            telemetry.set_seconds('find', (datetime.now() - started).total_seconds())
+            next_star_log['nonce'], next_star_log['time'], next_star_log['hash'] = found
+            next_star_log['log_header'] = util.concat_star_log_header(next_star_log)
+            if not silent:
+                print 'Probed new starlog %s' % util.get_system_name(next_star_log['hash'])
+                if verbose:
+                    print pretty_json(next_star_log)
+            if not post:
+                continue
+            database.add_star_log(next_star_log)
+            post_star_log(next_star_log, silent)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+def take_work(params=None):
+    address = get_work_address(putil.retrieve_value(params, '-p', WORK_ADDRESS))
+    processes = int(putil.retrieve_value(params, '-j', 1))
+    engine = putil.retrieve_value(params, '-e', None)
+    if processes < 1:
+        raise CommandException('Cannot probe with less than one process')
+    if engine is not None and engine not in mining.ENGINES:
+        raise CommandException('Unrecognized probing engine %s, try one of %s' % (engine, ', '.join(mining.ENGINES.keys())))
+    print 'Taking work from %s:%s, press Ctrl+C to stop' % address
+    workers = []
+    for _ in range(0, processes):
+        worker = Process(target=mining.work, args=(address, WORK_AUTHKEY, engine))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    try:
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(mining.POLL_SECONDS)
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+    print 'Stopped taking work'
+
+
+def post_star_log(generated, silent=False, rejected=None):
+    result = None
+    try:
+        post_started = datetime.now()
         result = post_request(STAR_LOGS_URL, generated)
-        if result == 200:
-            database.add_star_log(generated)
+        telemetry.set_seconds('post', (datetime.now() - post_started).total_seconds())
+        telemetry.increment('accepted' if result == 200 else 'rejected')
         if not silent:
             prefix, postfix = SUCCESS_COLOR if result == 200 else ERROR_COLOR, DEFAULT_COLOR
             print 'Posted starlog with response %s%s%s' % (prefix, result, postfix)
     except:
         print_exception()
         print 'Something went wrong when trying to post the generated starlog'
-    if loop:
-        if 0 < wait:
-            sleep(wait)
-        probe(params)
-
-
-def generate_next_star_log(from_star_log=None, from_genesis=False, allow_duplicate_events=False, start_time=None, timeout=180):
-    next_star_log = get_genesis()
-    if from_star_log:
-        next_star_log = database.get_star_log(from_star_log)
-    elif not from_genesis:
-        local_highest = database.get_star_log_highest()
-        if local_highest is not None:
-            next_star_log = local_highest
-    is_genesis = util.is_genesis_star_log(next_star_log['hash'])
+    finally:
+        # Anything but an accepted post, including one that raised, leaves the starlog out of the local chain.
+        if result != 200:
+            if rejected is not None:
+                rejected.set()
+            try:
+                database.remove_star_log(generated['hash'])
+            except:
+                print_exception()
+                print 'Something went wrong when trying to remove the unposted starlog'
+    return result == 200
+
+
+def get_star_log_template(is_genesis=False):
     account_info = database.get_account()
-    next_star_log['events'] = []
-
+    events = []
     if not is_genesis:
         event_results = get_request(EVENTS_URL, {'limit': util.eventsMaxLimit()})
         if event_results:
-            unused_events = []
-            for unused_event in database.get_unused_events(from_star_log=next_star_log['hash']):
-                unused_events.append(unused_event['key'])
-            used_inputs = []
-            used_outputs = []
-            events = []
-            for event in event_results:
-                validate.event(event, require_index=False, require_star_system=True, reward_allowed=False)
-                conflict = False
-                current_used_inputs = []
-                for current_input in event['inputs']:
-                    conflict = current_input['key'] in used_inputs + current_used_inputs or current_input['key'] not in unused_events
-                    if conflict:
-                        break
-                    current_used_inputs.append(current_input['key'])
-                if conflict:
-                    continue
-                current_used_outputs = []
-                for current_output in event['outputs']:
-                    output_key = current_output['key']
-                    conflict = output_key in used_inputs + used_outputs + current_used_inputs + current_used_outputs
-                    if conflict:
-                        break
-                    current_used_outputs.append(output_key)
-                if conflict:
-                    continue
-                if not allow_duplicate_events:
-                    if database.any_events_used(current_used_inputs, next_star_log['hash']) or database.any_events_exist(current_used_outputs, next_star_log['hash']):
-                        continue
-                
-                used_inputs += current_used_inputs
-                used_outputs += current_used_outputs
-                event['index'] = len(events)
-                events.append(event)
-            
-            next_star_log['events'] += events
+            validate.events_valid(event_results, require_index=False, require_star_system=True, reward_allowed=False)
+            events += event_results
 
     reward_output = {
         'index': 0,
@@ -341,7 +469,7 @@ def generate_next_star_log(from_star_log=None, from_genesis=False, allow_duplica
     }
 
     reward_event = {
-        'index': len(next_star_log['events']),
+        'index': None,
         'hash': None,
         'type': 'reward',
         'fleet_hash': util.sha256(account_info['public_key']),
@@ -363,6 +491,73 @@ def generate_next_star_log(from_star_log=None, from_genesis=False, allow_duplica
     reward_event['hash'] = util.hash_event(reward_event)
     reward_event['signature'] = util.rsa_sign(account_info['private_key'], reward_event['hash'])
 
+    return {
+        'is_genesis': is_genesis,
+        'events': events,
+        'reward_event': reward_event
+    }
+
+
+def build_next_star_log(from_star_log=None, from_genesis=False, allow_duplicate_events=False, template=None):
+    template_started = datetime.now()
+    next_star_log = get_genesis()
+    if from_star_log:
+        next_star_log = database.get_star_log(from_star_log)
+    elif not from_genesis:
+        local_highest = database.get_star_log_highest()
+        if local_highest is not None:
+            next_star_log = local_highest
+    is_genesis = util.is_genesis_star_log(next_star_log['hash'])
+    if template is None or template['is_genesis'] != is_genesis:
+        template = get_star_log_template(is_genesis)
+    next_star_log['events'] = []
+
+    if template['events']:
+        input_keys = [current_input['key'] for event in template['events'] for current_input in event['inputs']]
+        output_keys = [current_output['key'] for event in template['events'] for current_output in event['outputs']]
+        unused_events = database.get_unspent_keys(input_keys, next_star_log['hash'])
+        used_events = set()
+        existing_events = set()
+        if not allow_duplicate_events:
+            used_events = database.get_used_keys(input_keys, next_star_log['hash'])
+            existing_events = database.get_existing_keys(output_keys, next_star_log['hash'])
+        used_inputs = set()
+        used_outputs = set()
+        events = []
+        for event in template['events']:
+            conflict = False
+            current_used_keys = set()
+            for current_input in event['inputs']:
+                input_key = current_input['key']
+                conflict = input_key in used_inputs or input_key in current_used_keys or input_key not in unused_events
+                if conflict:
+                    break
+                current_used_keys.add(input_key)
+            if conflict:
+                continue
+            current_used_outputs = set()
+            for current_output in event['outputs']:
+                output_key = current_output['key']
+                conflict = output_key in used_inputs or output_key in used_outputs or output_key in current_used_keys or output_key in current_used_outputs
+                if conflict:
+                    break
+                current_used_outputs.add(output_key)
+            if conflict:
+                continue
+            if not allow_duplicate_events:
+                if not used_events.isdisjoint(current_used_keys) or not existing_events.isdisjoint(current_used_outputs):
+                    continue
+
+            used_inputs |= current_used_keys
+            used_outputs |= current_used_outputs
+            event['index'] = len(events)
+            events.append(event)
+
+        next_star_log['events'] += events
+
+    reward_event = template['reward_event']
+    reward_event['index'] = len(next_star_log['events'])
+
     meta = database.get_meta_content()
     next_star_log['meta'] = '' if meta is None else meta
     next_star_log['meta_hash'] = util.sha256(next_star_log['meta'])
@@ -377,55 +572,59 @@ def generate_next_star_log(from_star_log=None, from_genesis=False, allow_duplica
     if not is_genesis and util.is_difficulty_changing(next_star_log['height']):
         # We have to recalculate the difficulty at this height.
         previous_recalculation = database.get_star_log_at_height(next_star_log['previous_hash'], next_star_log['height'] - util.difficultyInterval())
-        previous_star_log = database.get_star_log(next_star_log['previous_hash'])
+        previous_star_log = database.get_star_log_header(next_star_log['previous_hash'])
         next_star_log['difficulty'] = util.calculate_difficulty(previous_recalculation['difficulty'], previous_star_log['time'] - previous_recalculation['time'])
 
-    found = False
-    tries = 0
-    check_interval = 10000000
-    next_check = check_interval
-    curr_started = datetime.now()
-    started = curr_started if start_time is None else start_time
-    last_checkin = curr_started
     # This initial hash hangles the hashing of events and such.
     next_star_log = util.hash_star_log(next_star_log)
-    current_difficulty = util.unpack_bits(next_star_log['difficulty'], True)
-    current_difficulty_leading_zeros = len(current_difficulty) - len(current_difficulty.lstrip('0'))
-    current_nonce = 0
-    log_prefix = util.concat_star_log_header(next_star_log, False)
-    current_hash = None
-
-    while not found:
-        current_hash = util.sha256('%s%s' % (log_prefix, current_nonce))
-        try:
-            validate.difficulty_unpacked(current_difficulty, current_difficulty_leading_zeros, current_hash, False)
-            found = True
-            break
-        except:
-            pass
-        if tries == next_check:
-            next_check = tries + check_interval
-            now = datetime.now()
-            if timeout < (now - curr_started).total_seconds():
-                raise ProbeTimeoutException('Probing timed out')
-            hashes_per_second = tries / (now - last_checkin).total_seconds()
-            elapsed_minutes = (now - started).total_seconds() / 60
-            print '\tProbing at %.0f hashes per second, %.1f minutes elapsed...' % (hashes_per_second, elapsed_minutes)
-        current_nonce += 1
-        if util.MAXIMUM_NONCE <= current_nonce:
-            current_nonce = 0
-            next_star_log['time'] = util.get_time()
-            log_prefix = util.concat_star_log_header(next_star_log, False)
-        tries += 1
-    if found:
-        next_star_log['nonce'] = current_nonce
-        next_star_log['log_header'] = util.concat_star_log_header(next_star_log)
-        next_star_log['hash'] = current_hash
-    else:
+    telemetry.set_seconds('template', (datetime.now() - template_started).total_seconds())
+    return next_star_log
+
+
+def generate_next_star_log(from_star_log=None, from_genesis=False, allow_duplicate_events=False, start_time=None, timeout=180, processes=1, engine=None, watch_tip=False, template=None, stale=None):
+    next_star_log = build_next_star_log(from_star_log, from_genesis, allow_duplicate_events, template)
+    watcher_stopped = None
+    if watch_tip and not (from_star_log or from_genesis or next_star_log['height'] == 0):
+        stale = Event() if stale is None else stale
+        watcher_stopped = start_tip_watcher(next_star_log['height'], stale)
+    try:
+        found = mining.probe_star_log(next_star_log, processes, start_time, timeout, engine, stale)
+    finally:
+        if watcher_stopped is not None:
+            watcher_stopped.set()
+    if found is None:
         raise CommandException('Unable to probe a new starlog')
+    next_star_log['nonce'], next_star_log['time'], next_star_log['hash'] = found
+    next_star_log['log_header'] = util.concat_star_log_header(next_star_log)
     return next_star_log
 
 
+def start_tip_watcher(height, stale):
+    stopped = Event()
+    latest = database.get_star_log_latest()
+    watcher = Thread(target=watch_star_log_tip, args=(height, latest['time'], stale, stopped))
+    watcher.daemon = True
+    watcher.start()
+    return stopped
+
+
+def watch_star_log_tip(height, since_time, stale, stopped):
+    # Any new starlog at the height being probed or above means the parent is no longer the tip.
+    while not stopped.wait(TIP_POLL_INTERVAL):
+        offset = 0
+        while not stopped.is_set():
+            results = get_request(STAR_LOGS_URL, {'since_time': since_time, 'limit': util.starLogsMaxLimit(), 'offset': offset})
+            if not results:
+                break
+            for result in results:
+                if height <= result['height']:
+                    stale.set()
+                    return
+            if len(results) < util.starLogsMaxLimit():
+                break
+            offset += len(results)
+
+
 def sync(params=None):
     silent = putil.retrieve(params, '-s', True, False)
     if putil.retrieve(params, '-f', True, False):
@@ -444,14 +643,15 @@ def sync(params=None):
             last_count = 0
         else:
             last_count = len(results)
+            all_results += results
         offset += last_count
-        all_results += results
 
-    for result in all_results:
-        database.add_star_log(result)
+    ingest_started = datetime.now()
+    added = database.add_star_logs(all_results)
+    ingest_seconds = max((datetime.now() - ingest_started).total_seconds(), 0.001)
 
     if not silent:
-        print 'Syncronized %s starlogs' % len(all_results)
+        print 'Syncronized %s starlogs, adding %s at %.0f per second' % (len(all_results), added, added / ingest_seconds)
 
     
 def render_chain(params=None):
@@ -534,14 +734,14 @@ def list_deployments(params=None):
         from_hash_query = putil.retrieve_value(params, '-f', None)
         if from_hash_query is None:
             raise CommandException('A system hash fragment must be passed with the -f parameter')
-        from_hash = putil.natural_match(from_hash_query, database.get_star_log_hashes())
+        from_hash = database.match_star_log_hash(from_hash_query)
         if from_hash is None:
             raise CommandException('Unable to find a system hash containing %s' % from_hash_query)
     if list_all:
         list_all_deployments(from_hash, verbose)
         return
     hash_query = putil.single_str(params)
-    selected_hash = putil.natural_match(hash_query, database.get_star_log_hashes())
+    selected_hash = database.match_star_log_hash(hash_query)
     if selected_hash is None:
         raise CommandException('Unable to find a system hash containing %s' % hash_query)
     deployments = database.get_unused_events(from_star_log=from_hash, system_hash=selected_hash)
@@ -611,11 +811,11 @@ def attack(params=None):
     abort = putil.retrieve(params, '-a', True, False)
     origin_fragment = params[0]
     enemy_fragment = params[1]
-    origin_hash = putil.natural_match(origin_fragment, database.get_star_log_hashes())
+    origin_hash = database.match_star_log_hash(origin_fragment)
     if origin_hash is None:
         raise CommandException('Unable to find an origin system containing %s' % origin_fragment)
     highest_hash = database.get_star_log_highest(origin_hash)['hash']
-    enemy_hash = putil.natural_match(enemy_fragment, database.get_fleets(highest_hash))
+    enemy_hash = database.match_fleet_hash(enemy_fragment, highest_hash)
     if enemy_hash is None:
         raise CommandException('Unable to find a fleet containing %s' % enemy_fragment)
     enemy_deployments = database.get_unused_events(highest_hash, origin_hash, enemy_hash)
@@ -688,11 +888,10 @@ def jump(params=None):
     destination_fragment = params[1]
     if 2 < len(params) and isinstance(params[2], int):
         count = int(params[2])
-    hashes = database.get_star_log_hashes()
-    origin_hash = putil.natural_match(origin_fragment, hashes)
+    origin_hash = database.match_star_log_hash(origin_fragment)
     if origin_hash is None:
         raise CommandException('Unable to find an origin system containing %s' % origin_fragment)
-    destination_hash = putil.natural_match(destination_fragment, hashes)
+    destination_hash = database.match_star_log_hash(destination_fragment)
     if destination_hash is None:
         raise CommandException('Unable to find a destination system containing %s' % destination_fragment)
     if not database.get_star_logs_share_chain([origin_hash, destination_hash]):
@@ -786,14 +985,13 @@ def render_jump_range(params=None):
     origin_fragment = putil.single_str(params)
     destination_fragment = putil.retrieve_value(params, '-d', None)
 
-    hashes = database.get_star_log_hashes()
-    origin_hash = putil.natural_match(origin_fragment, hashes)
+    origin_hash = database.match_star_log_hash(origin_fragment)
     if origin_hash is None:
         raise CommandException('Unable to find an origin system containing %s' % origin_fragment)
     destination_hash = None
     highest = None
     if destination_fragment is not None:
-        destination_hash = putil.natural_match(destination_fragment, hashes)
+        destination_hash = database.match_star_log_hash(destination_fragment)
         if destination_hash is None:
             raise CommandException('Unable to find a destination system containing %s' % destination_fragment)
         if not database.get_star_logs_share_chain([origin_hash, destination_hash]):
@@ -838,7 +1036,7 @@ def system_position(params=None):
     if not putil.has_single(params):
         raise CommandException('An origin system must be specified')
     origin_fragment = putil.single_str(params)
-    origin_hash = putil.natural_match(origin_fragment, database.get_star_log_hashes())
+    origin_hash = database.match_star_log_hash(origin_fragment)
     if origin_hash is None:
         raise CommandException('Unable to find an origin system containing %s' % origin_fragment)
     print '%s system is at %s' % (util.get_system_name(origin_hash), util.get_cartesian(origin_hash))
@@ -849,11 +1047,10 @@ def system_distance(params=None):
         raise CommandException('An origin and destination system must be specified')
     origin_fragment = params[0]
     destination_fragment = params[1]
-    hashes = database.get_star_log_hashes()
-    origin_hash = putil.natural_match(origin_fragment, hashes)
+    origin_hash = database.match_star_log_hash(origin_fragment)
     if origin_hash is None:
         raise CommandException('Unable to find an origin system containing %s' % origin_fragment)
-    destination_hash = putil.natural_match(destination_fragment, hashes)
+    destination_hash = database.match_star_log_hash(destination_fragment)
     if destination_hash is None:
         raise CommandException('Unable to find a destination system containing %s' % destination_fragment)
     if not database.get_star_logs_share_chain([origin_hash, destination_hash]):
@@ -865,7 +1062,7 @@ def system_average_distances(params=None):
     origin_hash = None
     if putil.has_single(params):
         origin_fragment = params[0]
-        origin_hash = putil.natural_match(origin_fragment, database.get_star_log_hashes())
+        origin_hash = database.match_star_log_hash(origin_fragment)
         if origin_hash is None:
             raise CommandException('Unable to find an origin system containing %s' % origin_fragment)
     total = 0
@@ -906,7 +1103,7 @@ def system_min_max_distance(params=None, calculating_max=True):
     origin_hash = None
     if putil.has_single(params):
         origin_fragment = params[0]
-        origin_hash = putil.natural_match(origin_fragment, database.get_star_log_hashes())
+        origin_hash = database.match_star_log_hash(origin_fragment)
         if origin_hash is None:
             raise CommandException('Unable to find an origin system containing %s' % origin_fragment)
     if origin_hash:
@@ -1186,7 +1383,12 @@ def main():
                 '"-f" probes for a starlog ontop of the best matching system',
                 '"-l" loop and probe again after posting to the server',
                 '"-w" number of seconds to wait before looping to probe again',
-                '"-b" blindly probe for new stars without syncing inbetween'
+                '"-b" blindly probe for new stars without syncing inbetween',
+                '"-j" number of processes to probe with',
+                '"-e" engine to probe with, one of "midstate" (default), "hashlib" or "numpy"',
+                '"serve-work" builds starlogs and serves ranges of nonces to probe workers',
+                '"work" probes ranges of nonces served by "probe serve-work"',
+                '"-p" address to serve or take work on, "%s" by default' % WORK_ADDRESS
             ]
         ),
         'meta': create_command(
@@ -1405,5 +1607,6 @@ def main():
         command_in_session += 1
 
 if __name__ == '__main__':
+    freeze_support()
     main()
     stdout.write('\nExiting...\n')
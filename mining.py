@@ -0,0 +1,539 @@
+import binascii
+import hashlib
+import json
+import multiprocessing
+import struct
+import threading
+from datetime import datetime
+from multiprocessing.connection import Client, Listener
+from Queue import Empty, Queue
+from time import sleep, time
+import numpy
+from probe_exceptions import ProbeProcessException, ProbeStaleException, ProbeTimeoutException
+import telemetry
+import util
+
+CHECK_INTERVAL = 100000
+PROGRESS_INTERVAL = 10000000
+POLL_SECONDS = 1.0
+NONCE_BLOCK = 10000
+NONCE_ENCODINGS = [str(i) for i in range(0, NONCE_BLOCK)]
+NONCE_SUFFIXES = ['%04d' % i for i in range(0, NONCE_BLOCK)]
+DEFAULT_ENGINE = 'midstate'
+NUMPY_BATCH = 16384
+WORK_UNIT = 1000000
+WORK_HEADER_FIELDS = ['version', 'previous_hash', 'difficulty', 'events_hash', 'meta_hash', 'time']
+
+SHA256_INITIAL_STATE = [
+    0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19
+]
+
+SHA256_ROUND_CONSTANTS = [numpy.uint32(constant) for constant in [
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+]]
+
+
+def get_nonce_ranges(process_count):
+    """Splits the nonce space into contiguous, non-overlapping ranges.
+
+    Args:
+        process_count (int): Number of ranges to split the nonce space into.
+
+    Returns:
+        list: A list of (start, end) tuples, with the end of each range being exclusive.
+    """
+    size = util.MAXIMUM_NONCE // process_count
+    results = []
+    for i in range(0, process_count):
+        start = i * size
+        end = util.MAXIMUM_NONCE if i == process_count - 1 else start + size
+        results.append((start, end))
+    return results
+
+
+def hash_nonces_hashlib(log_prefix, nonce_start, nonce_end, target):
+    """Hashes each nonce with the full header, the way star logs are validated.
+
+    Args:
+        log_prefix (str): Header of the star log without its nonce.
+        nonce_start (int): First nonce to try.
+        nonce_end (int): Nonce to stop at, exclusive.
+        target (str): Raw target bytes the digest must be less than, from util.unpack_target.
+
+    Returns:
+        tuple: The (nonce, hash) meeting the difficulty, or None if no nonce in the range does.
+    """
+    is_target_met = util.is_target_met
+    for current_nonce in xrange(nonce_start, nonce_end):
+        current_hash = hashlib.sha256('%s%s' % (log_prefix, current_nonce)).digest()
+        if is_target_met(target, current_hash):
+            return current_nonce, binascii.hexlify(current_hash)
+    return None
+
+
+def hash_nonces_midstate(log_prefix, nonce_start, nonce_end, target):
+    """Hashes the header once and feeds each nonce into a copy of that hash's state.
+
+    Nonces are fed in two parts, the digits above NONCE_BLOCK are hashed once per block of nonces and the remaining
+    digits come from the cached NONCE_SUFFIXES.
+
+    Args:
+        log_prefix (str): Header of the star log without its nonce.
+        nonce_start (int): First nonce to try.
+        nonce_end (int): Nonce to stop at, exclusive.
+        target (str): Raw target bytes the digest must be less than, from util.unpack_target.
+
+    Returns:
+        tuple: The (nonce, hash) meeting the difficulty, or None if no nonce in the range does.
+    """
+    prefix_hash = hashlib.sha256(log_prefix)
+    is_target_met = util.is_target_met
+    current_nonce = nonce_start
+    while current_nonce < nonce_end:
+        high, low = divmod(current_nonce, NONCE_BLOCK)
+        block_start = high * NONCE_BLOCK
+        block_end = min(block_start + NONCE_BLOCK, nonce_end) - block_start
+        if high == 0:
+            block_hash = prefix_hash
+            encodings = NONCE_ENCODINGS
+        else:
+            block_hash = prefix_hash.copy()
+            block_hash.update(str(high))
+            encodings = NONCE_SUFFIXES
+        copy_block_hash = block_hash.copy
+        for current_low in xrange(low, block_end):
+            current_hash = copy_block_hash()
+            current_hash.update(encodings[current_low])
+            current_hash = current_hash.digest()
+            if is_target_met(target, current_hash):
+                return block_start + current_low, binascii.hexlify(current_hash)
+        current_nonce = block_start + block_end
+    return None
+
+
+def rotate_right(words, count):
+    return (words >> count) | (words << (32 - count))
+
+
+def compress_sha256(state, words):
+    """Runs the SHA-256 compression function over arrays of states and message words.
+
+    Every argument is a numpy uint32 array, arrays of a single element are broadcast against the others so words that
+    are the same for every message are only calculated once.
+
+    Args:
+        state (list): The eight words of the state being compressed into.
+        words (list): The sixteen words of the message block.
+
+    Returns:
+        list: The eight words of the resulting state.
+    """
+    schedule = list(words)
+    for i in range(16, 64):
+        previous_15 = schedule[i - 15]
+        previous_2 = schedule[i - 2]
+        sigma_0 = rotate_right(previous_15, 7) ^ rotate_right(previous_15, 18) ^ (previous_15 >> 3)
+        sigma_1 = rotate_right(previous_2, 17) ^ rotate_right(previous_2, 19) ^ (previous_2 >> 10)
+        schedule.append(schedule[i - 16] + sigma_0 + schedule[i - 7] + sigma_1)
+    a, b, c, d, e, f, g, h = state
+    for i in range(0, 64):
+        sum_1 = rotate_right(e, 6) ^ rotate_right(e, 11) ^ rotate_right(e, 25)
+        choice = (e & f) ^ (~e & g)
+        temp_1 = h + sum_1 + choice + SHA256_ROUND_CONSTANTS[i] + schedule[i]
+        sum_0 = rotate_right(a, 2) ^ rotate_right(a, 13) ^ rotate_right(a, 22)
+        majority = (a & b) ^ (a & c) ^ (b & c)
+        h, g, f, e, d, c, b, a = g, f, e, d + temp_1, c, b, a, temp_1 + sum_0 + majority
+    return [initial + final for initial, final in zip(state, [a, b, c, d, e, f, g, h])]
+
+
+def get_block_words(block):
+    return [numpy.array([word], dtype=numpy.uint32) for word in struct.unpack('>16I', block)]
+
+
+def hash_nonces_numpy(log_prefix, nonce_start, nonce_end, target):
+    """Hashes batches of nonces at once with a SHA-256 implemented over numpy arrays.
+
+    The header's complete blocks are compressed once, then every nonce in a batch with the same number of digits shares
+    the remaining message except for the words its digits fall in.
+
+    Args:
+        log_prefix (str): Header of the star log without its nonce.
+        nonce_start (int): First nonce to try.
+        nonce_end (int): Nonce to stop at, exclusive.
+        target (str): Raw target bytes the digest must be less than, from util.unpack_target.
+
+    Returns:
+        tuple: The (nonce, hash) meeting the difficulty, or None if no nonce in the range does.
+    """
+    prefix_blocks = len(log_prefix) // 64
+    midstate = [numpy.array([word], dtype=numpy.uint32) for word in SHA256_INITIAL_STATE]
+    for i in range(0, prefix_blocks):
+        midstate = compress_sha256(midstate, get_block_words(log_prefix[i * 64:(i + 1) * 64]))
+    remainder = log_prefix[prefix_blocks * 64:]
+    first_target_word = struct.unpack('>I', target[:4])[0]
+
+    current_nonce = nonce_start
+    while current_nonce < nonce_end:
+        digit_count = len(str(current_nonce))
+        batch_end = min(current_nonce + NUMPY_BATCH, nonce_end, pow(10, digit_count))
+        message_length = len(log_prefix) + digit_count
+        padding_length = 64 - ((len(remainder) + digit_count + 9) % 64)
+        if padding_length == 64:
+            padding_length = 0
+        tail = '%s%s%s%s' % (remainder, '0' * digit_count, '\x80' + ('\x00' * padding_length), struct.pack('>Q', message_length * 8))
+        digits_start = len(remainder)
+        digits_end = digits_start + digit_count
+
+        nonces = numpy.arange(current_nonce, batch_end, dtype=numpy.int64)
+        tail_bytes = numpy.empty((len(nonces), len(tail)), dtype=numpy.uint8)
+        tail_bytes[:] = numpy.frombuffer(tail, dtype=numpy.uint8)
+        for digit in range(0, digit_count):
+            place = pow(10, digit_count - digit - 1)
+            tail_bytes[:, digits_start + digit] = (nonces // place) % 10 + 48
+        tail_words = tail_bytes.view('>u4').astype(numpy.uint32)
+
+        state = midstate
+        for block_start in range(0, len(tail), 64):
+            words = []
+            for word_index in range(block_start // 4, (block_start + 64) // 4):
+                if word_index * 4 + 4 <= digits_start or digits_end <= word_index * 4:
+                    words.append(tail_words[:1, word_index])
+                else:
+                    words.append(tail_words[:, word_index])
+            state = compress_sha256(state, words)
+
+        # Only a first word at or below the target's can meet it, those few candidates are confirmed with hashlib.
+        for candidate in numpy.flatnonzero(state[0] <= first_target_word):
+            candidate_nonce = current_nonce + int(candidate)
+            candidate_hash = hashlib.sha256('%s%s' % (log_prefix, candidate_nonce)).digest()
+            if util.is_target_met(target, candidate_hash):
+                return candidate_nonce, binascii.hexlify(candidate_hash)
+        current_nonce = batch_end
+    return None
+
+
+ENGINES = {
+    'hashlib': hash_nonces_hashlib,
+    'midstate': hash_nonces_midstate,
+    'numpy': hash_nonces_numpy
+}
+
+
+def get_engine(name=None):
+    """Gets the function used to hash ranges of nonces.
+
+    Args:
+        name (str): Name of the engine, or None for the default.
+
+    Returns:
+        function: The engine's hashing function.
+    """
+    engine = ENGINES.get(DEFAULT_ENGINE if name is None else name, None)
+    if engine is None:
+        raise ValueError('Unrecognized probing engine %s' % name)
+    return engine
+
+
+def search_nonces(star_log, nonce_start, nonce_end, check, engine=None):
+    """Searches a range of nonces for a hash meeting the star log's difficulty.
+
+    When the range is exhausted the star log's time is updated and the range is searched again.
+
+    Args:
+        star_log (dict): StarLog with every header field except the nonce calculated.
+        nonce_start (int): First nonce to try.
+        nonce_end (int): Nonce to stop at, exclusive.
+        check (function): Called with the number of tries every CHECK_INTERVAL hashes, the search stops if it returns False.
+        engine (str): Name of the engine to hash with, or None for the default.
+
+    Returns:
+        tuple: The (nonce, time, hash) meeting the difficulty, or None if stopped by the check.
+    """
+    hash_nonces = get_engine(engine)
+    target = util.unpack_target(star_log['difficulty'])
+    current_time = star_log['time']
+    log_prefix = util.concat_star_log_header(star_log, False)
+    current_nonce = nonce_start
+    tries = 0
+
+    while True:
+        chunk_end = min(current_nonce + CHECK_INTERVAL, nonce_end)
+        result = hash_nonces(log_prefix, current_nonce, chunk_end, target)
+        if result is not None:
+            return result[0], current_time, result[1]
+        tries += chunk_end - current_nonce
+        if not check(tries):
+            return None
+        current_nonce = chunk_end
+        if nonce_end <= current_nonce:
+            current_nonce = nonce_start
+            current_time = util.get_time()
+            log_prefix = util.concat_star_log_header(dict(star_log, time=current_time), False)
+
+
+def search_nonces_worker(star_log, nonce_start, nonce_end, worker_index, found, results, progress, engine=None):
+    """Entry point of mining processes, reports tries to the shared progress and solutions to the results queue."""
+    def check(tries):
+        progress[worker_index] = tries
+        return not found.is_set()
+    try:
+        result = search_nonces(star_log, nonce_start, nonce_end, check, engine)
+        if result is not None:
+            results.put(result)
+            found.set()
+    except KeyboardInterrupt:
+        pass
+
+
+def print_progress(tries, curr_started, started):
+    now = datetime.now()
+    hashes_per_second = tries / max((now - curr_started).total_seconds(), 0.001)
+    elapsed_minutes = (now - started).total_seconds() / 60
+    print '\tProbing at %.0f hashes per second, %.1f minutes elapsed...' % (hashes_per_second, elapsed_minutes)
+
+
+def probe_star_log(star_log, processes=1, start_time=None, timeout=180, engine=None, cancel=None):
+    """Finds a nonce for the star log, spreading the nonce space across the specified number of processes.
+
+    Args:
+        star_log (dict): StarLog with every header field except the nonce calculated.
+        processes (int): Number of processes to probe with.
+        start_time (datetime): When probing for this star log first began, used for reporting.
+        timeout (int): Seconds to probe for before giving up.
+        engine (str): Name of the engine to hash with, or None for the default.
+        cancel (threading.Event): Probing stops with a ProbeStaleException once this is set.
+
+    Returns:
+        tuple: The (nonce, time, hash) meeting the star log's difficulty.
+    """
+    curr_started = datetime.now()
+    started = curr_started if start_time is None else start_time
+    if processes <= 1:
+        progress = {'next': PROGRESS_INTERVAL}
+        def check(tries):
+            now = datetime.now()
+            if timeout < (now - curr_started).total_seconds():
+                raise ProbeTimeoutException('Probing timed out')
+            if cancel is not None and cancel.is_set():
+                raise ProbeStaleException('Probing was cancelled')
+            telemetry.set_hashes_per_second([tries / max((now - curr_started).total_seconds(), 0.001)])
+            if progress['next'] <= tries:
+                progress['next'] = tries + PROGRESS_INTERVAL
+                print_progress(tries, curr_started, started)
+            return True
+        return search_nonces(star_log, 0, util.MAXIMUM_NONCE, check, engine)
+
+    found = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    progress = multiprocessing.Array('L', processes, lock=False)
+    workers = []
+    for worker_index, (nonce_start, nonce_end) in enumerate(get_nonce_ranges(processes)):
+        worker = multiprocessing.Process(target=search_nonces_worker, args=(star_log, nonce_start, nonce_end, worker_index, found, results, progress, engine))
+        worker.daemon = True
+        workers.append(worker)
+    try:
+        for worker in workers:
+            worker.start()
+        next_progress = PROGRESS_INTERVAL
+        while True:
+            try:
+                return results.get(timeout=POLL_SECONDS)
+            except Empty:
+                pass
+            if timeout < (datetime.now() - curr_started).total_seconds():
+                raise ProbeTimeoutException('Probing timed out')
+            if cancel is not None and cancel.is_set():
+                raise ProbeStaleException('Probing was cancelled')
+            elapsed = max((datetime.now() - curr_started).total_seconds(), 0.001)
+            telemetry.set_hashes_per_second([worker_tries / elapsed for worker_tries in progress])
+            tries = sum(progress)
+            if next_progress <= tries:
+                next_progress = tries + PROGRESS_INTERVAL
+                print_progress(tries, curr_started, started)
+            if not any(worker.is_alive() for worker in workers):
+                try:
+                    return results.get(timeout=POLL_SECONDS)
+                except Empty:
+                    raise ProbeProcessException('All probing processes exited without a result, with exit codes %s' % ', '.join(str(worker.exitcode) for worker in workers))
+    finally:
+        found.set()
+        for worker in workers:
+            worker.join(POLL_SECONDS)
+            if worker.is_alive():
+                worker.terminate()
+
+
+class WorkServer(object):
+    """Hands out disjoint ranges of a star log's time and nonce space to workers connecting over a socket.
+
+    Messages are json, each worker request reports the result of its last unit of work and receives the next one.
+    """
+
+    def __init__(self, address, authkey=None, unit_size=WORK_UNIT):
+        self.listener = Listener(address, authkey=authkey)
+        self.unit_size = unit_size
+        self.lock = threading.Lock()
+        self.solutions = Queue()
+        self.template = None
+        self.template_id = 0
+        self.target = None
+        self.unit_time = 0
+        self.unit_nonce = 0
+        self.worker_rates = {}
+        self.closed = False
+
+    def start(self):
+        accepter = threading.Thread(target=self.accept)
+        accepter.daemon = True
+        accepter.start()
+
+    def close(self):
+        self.closed = True
+        self.listener.close()
+
+    def accept(self):
+        worker_index = 0
+        while not self.closed:
+            try:
+                connection = self.listener.accept()
+            except Exception:
+                if self.closed:
+                    return
+                continue
+            handler = threading.Thread(target=self.handle, args=(connection, worker_index))
+            handler.daemon = True
+            handler.start()
+            worker_index += 1
+
+    def publish(self, star_log):
+        """Replaces the star log being worked on, any work on the previous one is stale.
+
+        Args:
+            star_log (dict): StarLog with every header field except the nonce calculated, or None to withhold work.
+
+        Returns:
+            int: Id of the published template.
+        """
+        with self.lock:
+            self.template_id += 1
+            self.template = None if star_log is None else dict((field, star_log[field]) for field in WORK_HEADER_FIELDS)
+            self.target = None if star_log is None else util.unpack_target(star_log['difficulty'])
+            self.unit_time = 0
+            self.unit_nonce = 0
+            return self.template_id
+
+    def allocate(self):
+        with self.lock:
+            if self.template is None:
+                return {'wait': POLL_SECONDS}
+            now = util.get_time()
+            if self.unit_time < now:
+                self.unit_time = now
+                self.unit_nonce = 0
+            if util.MAXIMUM_NONCE <= self.unit_nonce:
+                # Every nonce at this time was handed out, the next second starts a fresh range.
+                return {'wait': POLL_SECONDS}
+            nonce_start = self.unit_nonce
+            self.unit_nonce = min(nonce_start + self.unit_size, util.MAXIMUM_NONCE)
+            return {
+                'template_id': self.template_id,
+                'header': dict(self.template, time=self.unit_time),
+                'nonce_start': nonce_start,
+                'nonce_end': self.unit_nonce
+            }
+
+    def submit(self, template_id, solution):
+        nonce, solution_time, solution_hash = solution
+        with self.lock:
+            if template_id != self.template_id or self.template is None:
+                telemetry.increment('stale_submissions')
+                return
+            header = dict(self.template, time=solution_time, nonce=nonce)
+            target = self.target
+        digest = hashlib.sha256(str(util.concat_star_log_header(header))).digest()
+        if binascii.hexlify(digest) != solution_hash or not util.is_target_met(target, digest):
+            return
+        self.solutions.put((template_id, nonce, solution_time, solution_hash))
+
+    def handle(self, connection, worker_index):
+        last_request = time()
+        try:
+            while not self.closed:
+                request = json.loads(connection.recv_bytes())
+                if request.get('solution') is not None:
+                    self.submit(request['template_id'], request['solution'])
+                now = time()
+                # Every connection is handled on its own thread, so the rates are only read and written under the lock.
+                with self.lock:
+                    self.worker_rates[worker_index] = request.get('tries', 0) / max(now - last_request, 0.001)
+                    telemetry.set_hashes_per_second([self.worker_rates[index] for index in sorted(self.worker_rates.keys())])
+                last_request = now
+                connection.send_bytes(json.dumps(self.allocate()))
+        except (EOFError, IOError):
+            pass
+        finally:
+            with self.lock:
+                self.worker_rates.pop(worker_index, None)
+            connection.close()
+
+    def get_solution(self, timeout=POLL_SECONDS):
+        """Waits for a solution to the current template.
+
+        Returns:
+            tuple: The (nonce, time, hash) of the solution, or None if there was none before the timeout.
+        """
+        try:
+            template_id, nonce, solution_time, solution_hash = self.solutions.get(timeout=timeout)
+        except Empty:
+            return None
+        if template_id != self.template_id:
+            return None
+        return nonce, solution_time, solution_hash
+
+
+def work(address, authkey=None, engine=None):
+    """Requests units of work from a WorkServer and reports solutions back until the server disconnects.
+
+    Args:
+        address (tuple): The (host, port) of the server.
+        authkey (str): Key shared with the server, or None if it doesn't require one.
+        engine (str): Name of the engine to hash with, or None for the default.
+    """
+    hash_nonces = get_engine(engine)
+    connection = Client(address, authkey=authkey)
+    request = {'template_id': None, 'solution': None, 'tries': 0}
+    try:
+        while True:
+            connection.send_bytes(json.dumps(request))
+            unit = json.loads(connection.recv_bytes())
+            request = {'template_id': None, 'solution': None, 'tries': 0}
+            if 'wait' in unit:
+                sleep(unit['wait'])
+                continue
+            header = unit['header']
+            log_prefix = str(util.concat_star_log_header(header, False))
+            target = util.unpack_target(header['difficulty'])
+            request['template_id'] = unit['template_id']
+            current_nonce = unit['nonce_start']
+            while current_nonce < unit['nonce_end']:
+                chunk_end = min(current_nonce + CHECK_INTERVAL, unit['nonce_end'])
+                result = hash_nonces(log_prefix, current_nonce, chunk_end, target)
+                if result is not None:
+                    request['solution'] = [result[0], header['time'], result[1]]
+                    request['tries'] += result[0] - current_nonce + 1
+                    break
+                request['tries'] += chunk_end - current_nonce
+                current_nonce = chunk_end
+    except (EOFError, IOError):
+        pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        connection.close()
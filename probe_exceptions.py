@@ -4,3 +4,15 @@ class CommandException(Exception):
 
 class ProbeTimeoutException(Exception):
     pass
+
+
+class ProbeStaleException(Exception):
+    pass
+
+
+class ProbeProcessException(RuntimeError):
+    """Raised when every probing process exits without finding a nonce."""
+
+
+class StarLogIncompatibleException(ValueError):
+    """Raised when a star log can't be stored compactly without changing it."""
@@ -0,0 +1,143 @@
+import json
+import os
+import threading
+import time
+
+TELEMETRY_FILE = os.getenv('TELEMETRY_FILE', None)
+TELEMETRY_INTERVAL = float(os.getenv('TELEMETRY_INTERVAL', '5'))
+
+METRICS = [
+    ('hashes_per_second', 'gauge', 'Hashes per second of each probing worker.'),
+    ('find_seconds', 'gauge', 'Seconds taken to find the last probed starlog.'),
+    ('template_seconds', 'gauge', 'Seconds taken to build the last starlog template.'),
+    ('post_seconds', 'gauge', 'Seconds taken by the last starlog post.'),
+    ('found_total', 'counter', 'Starlogs found by probing and kept, not counting those discarded as stale.'),
+    ('accepted_total', 'counter', 'Posted starlogs accepted by the server.'),
+    ('rejected_total', 'counter', 'Posted starlogs rejected by the server.'),
+    ('stale_total', 'counter', 'Probes abandoned or discarded because their parent was no longer the tip.'),
+    ('timeout_total', 'counter', 'Probes that timed out without finding a starlog.'),
+    ('stale_submissions_total', 'counter', 'Solutions submitted by work clients for a template that was already replaced.'),
+    ('stale_rate', 'gauge', 'Ratio of stale probes to all finished probes.')
+]
+
+lock = threading.Lock()
+write_lock = threading.Lock()
+state = {
+    'hashes_per_second': {},
+    'find_seconds': 0.0,
+    'template_seconds': 0.0,
+    'post_seconds': 0.0,
+    'found_total': 0,
+    'accepted_total': 0,
+    'rejected_total': 0,
+    'stale_total': 0,
+    'timeout_total': 0,
+    'stale_submissions_total': 0
+}
+last_written = [0.0]
+
+
+def is_enabled():
+    return TELEMETRY_FILE is not None
+
+
+def set_hashes_per_second(worker_rates):
+    """Replaces the hash rates of probing workers.
+
+    Args:
+        worker_rates (list): Hashes per second of each worker, indexed by worker.
+    """
+    with lock:
+        state['hashes_per_second'] = dict(enumerate(worker_rates))
+    flush()
+
+
+def set_seconds(name, seconds):
+    """Records the duration of the last find, template or post.
+
+    Args:
+        name (str): One of "find", "template" or "post".
+        seconds (float): The duration in seconds.
+    """
+    with lock:
+        state['%s_seconds' % name] = seconds
+    flush()
+
+
+def increment(name, count=1):
+    """Increments one of the found, accepted, rejected, stale, timeout or stale submissions counters.
+
+    Every finished probe is counted as exactly one of found, stale or timeout. Stale submissions aren't probes, and
+    aren't counted in the stale rate.
+
+    Args:
+        name (str): One of "found", "accepted", "rejected", "stale", "timeout" or "stale_submissions".
+        count (int): Amount to increment by.
+    """
+    with lock:
+        state['%s_total' % name] += count
+    flush()
+
+
+def get_snapshot():
+    """Gets a copy of every metric, including the calculated stale rate.
+
+    Returns:
+        dict: Metric names and their values.
+    """
+    with lock:
+        snapshot = dict(state)
+        snapshot['hashes_per_second'] = dict(state['hashes_per_second'])
+    finished = snapshot['found_total'] + snapshot['stale_total'] + snapshot['timeout_total']
+    snapshot['stale_rate'] = 0.0 if finished == 0 else snapshot['stale_total'] / float(finished)
+    return snapshot
+
+
+def format_json(snapshot):
+    snapshot = dict(snapshot)
+    snapshot['hashes_per_second'] = dict((str(worker), rate) for worker, rate in snapshot['hashes_per_second'].items())
+    snapshot['time'] = time.time()
+    return json.dumps(snapshot, sort_keys=True, indent=4, separators=(',', ': '))
+
+
+def format_prometheus(snapshot):
+    lines = []
+    for name, metric_type, description in METRICS:
+        metric = 'probe_%s' % name
+        lines.append('# HELP %s %s' % (metric, description))
+        lines.append('# TYPE %s %s' % (metric, metric_type))
+        value = snapshot[name]
+        if isinstance(value, dict):
+            for worker in sorted(value.keys()):
+                lines.append('%s{worker="%s"} %s' % (metric, worker, value[worker]))
+        else:
+            lines.append('%s %s' % (metric, value))
+    return '\n'.join(lines) + '\n'
+
+
+def flush(force=False):
+    """Rewrites the telemetry file if TELEMETRY_INTERVAL seconds have passed since it was last written.
+
+    Files ending in ".prom" are written in the Prometheus text format, anything else is written as json.
+
+    Args:
+        force (bool): Write even if the interval has not passed.
+    """
+    if not is_enabled():
+        return
+    with write_lock:
+        now = time.time()
+        if not force and now - last_written[0] < TELEMETRY_INTERVAL:
+            return
+        last_written[0] = now
+        snapshot = get_snapshot()
+        contents = format_prometheus(snapshot) if TELEMETRY_FILE.endswith('.prom') else format_json(snapshot)
+        # Written to a temporary file and renamed, so scrapers never read a partial file.
+        temporary = '%s.tmp' % TELEMETRY_FILE
+        with open(temporary, 'w') as telemetry_file:
+            telemetry_file.write(contents)
+        try:
+            os.rename(temporary, TELEMETRY_FILE)
+        except OSError:
+            os.remove(TELEMETRY_FILE)
+            os.rename(temporary, TELEMETRY_FILE)
@@ -0,0 +1,170 @@
+import base64
+import copy
+import os
+import shutil
+import tempfile
+import unittest
+
+import compact
+import database
+import util
+from probe_exceptions import StarLogIncompatibleException
+
+
+def build_star_log(index, previous_hash='0' * 64, height=0):
+    """Builds a star log with every field a compact record stores, filled in the way probing fills them in.
+
+    Args:
+        index (int): Makes the hashes of each star log built different.
+        previous_hash (str): Hash of the parent star log.
+        height (int): Height of the star log.
+
+    Returns:
+        dict: Json data for the star log.
+    """
+    fleet_key = unicode(base64.b64encode(util.sha256('fleet key %s' % index).decode('hex') * 8))
+    star_log = {
+        'hash': unicode(util.sha256('star log %s' % index)),
+        'previous_hash': unicode(previous_hash),
+        'events_hash': unicode(util.sha256('events %s' % index)),
+        'meta_hash': unicode(util.sha256('meta %s' % index)),
+        'version': 0,
+        'difficulty': 486604799,
+        'nonce': 123456789 + index,
+        'time': 1500000000 + index,
+        'height': height,
+        'meta': u'meta \xe9 %s' % index,
+        'events': [{
+            'hash': unicode(util.sha256('reward %s' % index)),
+            'fleet_hash': unicode(util.sha256(fleet_key)),
+            'fleet_key': fleet_key,
+            'signature': unicode(util.sha256('signature %s' % index) * 4),
+            'type': u'reward',
+            'index': 0,
+            'inputs': [],
+            'outputs': [{
+                'index': 0,
+                'type': u'reward',
+                'fleet_hash': unicode(util.sha256(fleet_key)),
+                'key': unicode(util.sha256('reward key %s' % index)),
+                'star_system': None,
+                'count': 10
+            }]
+        }, {
+            'hash': unicode(util.sha256('jump %s' % index)),
+            'fleet_hash': unicode(util.sha256(fleet_key)),
+            'fleet_key': fleet_key,
+            'signature': unicode(util.sha256('jump signature %s' % index) * 4),
+            'type': u'jump',
+            'index': 1,
+            'inputs': [{'index': 0, 'key': unicode(util.sha256('input %s' % index))}],
+            'outputs': [{
+                'index': 0,
+                'type': u'jump',
+                'fleet_hash': unicode(util.sha256(fleet_key)),
+                'key': unicode(util.sha256('jump key %s' % index)),
+                'star_system': unicode(previous_hash),
+                'count': 3
+            }]
+        }]
+    }
+    star_log['log_header'] = unicode(util.concat_star_log_header(star_log))
+    return star_log
+
+
+class CompactTest(unittest.TestCase):
+    """Checks compact records decode to the star log that was encoded, and that anything they can't store exactly is
+    refused and stored as json instead.
+    """
+
+    def test_round_trip(self):
+        star_log = build_star_log(1, util.sha256('parent'), 7)
+        record = compact.encode_star_log(star_log)
+        self.assertTrue(compact.is_compact(record))
+        self.assertEqual(star_log, compact.decode_star_log(record))
+        self.assertEqual(star_log, compact.decode_star_log(buffer(record)))
+
+    def test_round_trip_without_log_header(self):
+        star_log = build_star_log(2)
+        del star_log['log_header']
+        self.assertEqual(star_log, compact.decode_star_log(compact.encode_star_log(star_log)))
+
+    def test_round_trip_unpacked_text(self):
+        # Text that isn't hex or base64 encoding back to itself is stored as utf-8.
+        star_log = build_star_log(3)
+        star_log['events'][0]['fleet_key'] = u'not base64 \u2603'
+        star_log['events'][1]['signature'] = u'ABCDEF'
+        self.assertEqual(star_log, compact.decode_star_log(compact.encode_star_log(star_log)))
+
+    def test_decode_without_events(self):
+        star_log = build_star_log(4)
+        header = compact.decode_star_log(compact.encode_star_log(star_log), False)
+        del star_log['events']
+        self.assertEqual(star_log, header)
+
+    def test_incompatible(self):
+        changes = [
+            lambda star_log: star_log.update(extra=1),
+            lambda star_log: star_log.update(hash=star_log['hash'].upper()),
+            lambda star_log: star_log.update(previous_hash='not a hash'),
+            lambda star_log: star_log.update(nonce=True),
+            lambda star_log: star_log.update(version=2 ** 40),
+            lambda star_log: star_log.update(time=1.5),
+            lambda star_log: star_log.update(log_header='stale'),
+            lambda star_log: star_log['events'][0].update(type='unrecognized'),
+            lambda star_log: star_log['events'][1]['inputs'][0].update(extra=None),
+            lambda star_log: star_log['events'][1]['outputs'][0].update(count=2 ** 64)
+        ]
+        for change in changes:
+            star_log = build_star_log(5)
+            change(star_log)
+            self.assertRaises(StarLogIncompatibleException, compact.encode_star_log, star_log)
+
+    def test_json_records(self):
+        self.assertFalse(compact.is_compact(database.encode_star_log_record(build_star_log(6), 'json')))
+        self.assertFalse(compact.is_compact('{"hash": "0"}'))
+
+
+class CompactDatabaseTest(unittest.TestCase):
+    """Checks star logs are read back the same whichever format they were stored or converted in."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.previous_location = database.database_location
+        database.database_location = os.path.join(self.directory, 'test.db')
+        database.initialize(True)
+        self.star_logs = [build_star_log(0)]
+        for index in range(1, 20):
+            self.star_logs.append(build_star_log(index, self.star_logs[-1]['hash'], index))
+        # One star log a compact record can't store exactly, which stays json.
+        self.star_logs[5]['extra'] = u'extra'
+
+    def tearDown(self):
+        database.close()
+        database.database_location = self.previous_location
+        shutil.rmtree(self.directory)
+
+    def assert_stored(self):
+        database.star_logs.clear()
+        for star_log in self.star_logs:
+            self.assertEqual(star_log, database.get_star_log(star_log['hash']))
+
+    def test_incompatible_fallback(self):
+        self.assertTrue(compact.is_compact(database.encode_star_log_record(self.star_logs[4], 'compact')))
+        record = database.encode_star_log_record(self.star_logs[5], 'compact')
+        self.assertFalse(compact.is_compact(record))
+        self.assertEqual(self.star_logs[5], database.decode_star_log_record(record))
+
+    def test_convert(self):
+        database.add_star_logs(copy.deepcopy(self.star_logs))
+        self.assert_stored()
+        self.assertEqual(len(self.star_logs) - 1, database.convert_star_logs('compact'))
+        self.assert_stored()
+        self.assertEqual(0, database.convert_star_logs('compact'))
+        self.assertEqual(len(self.star_logs) - 1, database.convert_star_logs('json'))
+        self.assert_stored()
+        self.assertRaises(ValueError, database.convert_star_logs, 'unknown')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,275 @@
+import copy
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+# Small enough that checkpoints, paging and the cache all come into play on a short chain.
+os.environ['UNSPENT_CHECKPOINT_INTERVAL'] = '8'
+os.environ['CHAIN_PAGE_SIZE'] = '16'
+
+import database
+import parameter_util as putil
+import util
+
+FLEETS = [util.sha256('fleet %s' % i) for i in range(0, 6)]
+
+
+def build_chain(count, seed, forks=0.25):
+    """Builds a chain of star logs with forks, each spending some of the outputs unspent on its own chain.
+
+    Only the fields the database indexes are filled in, the star logs aren't valid otherwise.
+
+    Args:
+        count (int): Number of star logs, including the genesis.
+        seed (int): Seed for the random choices, so every run builds the same chain.
+        forks (float): Chance of a star log extending one of the last few star logs instead of the last.
+
+    Returns:
+        list: The star logs, each after its parent.
+    """
+    rnd = random.Random(seed)
+    star_logs = []
+    unspent = {}
+
+    def reward(star_log, index):
+        return {
+            'hash': util.sha256('reward %s' % star_log['hash']),
+            'index': index,
+            'type': 'reward',
+            'fleet_hash': rnd.choice(FLEETS),
+            'fleet_key': 'key',
+            'signature': 'signature',
+            'inputs': [],
+            'outputs': [{
+                'index': 0,
+                'type': 'reward',
+                'fleet_hash': rnd.choice(FLEETS),
+                'key': util.sha256('reward output %s' % star_log['hash']),
+                'star_system': rnd.choice([None, star_logs[0]['hash'] if star_logs else None]),
+                'count': 10
+            }]
+        }
+
+    for height_index in range(0, count):
+        parent = None
+        if star_logs:
+            parent = rnd.choice(star_logs[-3:]) if rnd.random() < forks else star_logs[-1]
+        star_log = {
+            'hash': util.sha256('star log %s %s' % (seed, height_index)),
+            'previous_hash': '0' * 64 if parent is None else parent['hash'],
+            'height': 0 if parent is None else parent['height'] + 1,
+            'time': 1000 + height_index,
+            'events': []
+        }
+        available = [] if parent is None else list(unspent[parent['hash']])
+        rnd.shuffle(available)
+        for event_index in range(0, rnd.randint(0, 2)):
+            if not available:
+                break
+            spent = available.pop()
+            event_type = rnd.choice(['jump', 'transfer'])
+            star_log['events'].append({
+                'hash': util.sha256('event %s %s' % (star_log['hash'], event_index)),
+                'index': event_index,
+                'type': event_type,
+                'fleet_hash': spent['fleet_hash'],
+                'fleet_key': 'key',
+                'signature': 'signature',
+                'inputs': [{'index': 0, 'key': spent['key']}],
+                'outputs': [{
+                    'index': 0,
+                    'type': event_type,
+                    'fleet_hash': rnd.choice(FLEETS),
+                    'key': util.sha256('output %s %s' % (star_log['hash'], event_index)),
+                    'star_system': rnd.choice([None, star_log['previous_hash'], star_logs[0]['hash']]),
+                    'count': 3
+                }]
+            })
+        star_log['events'].append(reward(star_log, len(star_log['events'])))
+        spent_keys = set(event_input['key'] for event in star_log['events'] for event_input in event['inputs'])
+        inherited = [] if parent is None else [output for output in unspent[parent['hash']] if output['key'] not in spent_keys]
+        unspent[star_log['hash']] = inherited + [output for event in star_log['events'] for output in event['outputs']]
+        star_logs.append(star_log)
+    return star_logs
+
+
+class ChainWalk(object):
+    """Answers chain queries by walking every star log from the tip, the way the database did before its derived
+    tables.
+
+    Args:
+        stored (list): Star logs stored in the database, in the order they were first added.
+    """
+
+    def __init__(self, stored):
+        self.star_logs = dict((star_log['hash'], star_log) for star_log in stored)
+        self.order = dict((star_log['hash'], index) for index, star_log in enumerate(stored))
+
+    def walk(self, system_hash):
+        while system_hash in self.star_logs:
+            yield self.star_logs[system_hash]
+            system_hash = self.star_logs[system_hash]['previous_hash']
+
+    def get_ancestry(self, system_hash):
+        return set(star_log['hash'] for star_log in self.walk(system_hash))
+
+    def get_at_height(self, system_hash, height):
+        for star_log in self.walk(system_hash):
+            if star_log['height'] == height:
+                return star_log['hash']
+        return None
+
+    def get_highest(self, system_hash=None):
+        candidates = [star_log for star_log in self.star_logs.values() if system_hash is None or system_hash in self.get_ancestry(star_log['hash'])]
+        return min(candidates, key=lambda star_log: (-star_log['height'], self.order[star_log['hash']]))['hash']
+
+    def get_unused_events(self, from_star_log, system_hash=None, fleet_hash=None):
+        used = set()
+        results = []
+        for star_log in self.walk(from_star_log):
+            for event in star_log['events']:
+                if event['type'] not in util.SHIP_EVENT_TYPES:
+                    continue
+                for event_input in event['inputs']:
+                    used.add(event_input['key'])
+                for event_output in event['outputs']:
+                    if event_output['type'] not in util.SHIP_EVENT_TYPES or event_output['key'] in used:
+                        continue
+                    star_system = star_log['hash'] if event_output['star_system'] is None else event_output['star_system']
+                    if system_hash not in (None, star_system) or fleet_hash not in (None, event_output['fleet_hash']):
+                        continue
+                    results.append(dict(event_output, star_system=star_system))
+        return results
+
+    def get_fleets(self, from_star_log):
+        results = []
+        for star_log in self.walk(from_star_log):
+            for event in star_log['events']:
+                for event_output in event['outputs']:
+                    if event_output['fleet_hash'] not in results:
+                        results.append(event_output['fleet_hash'])
+        return results
+
+    def get_fleet_systems(self, fleet_hash, from_star_log):
+        results = []
+        for star_log in self.walk(from_star_log):
+            for event in star_log['events']:
+                for event_output in event['outputs']:
+                    star_system = star_log['hash'] if event_output['star_system'] is None else event_output['star_system']
+                    if event_output['fleet_hash'] == fleet_hash and star_system not in results:
+                        results.append(star_system)
+        return results
+
+
+class DerivedTablesTest(unittest.TestCase):
+    """Checks the tables derived from the star logs answer the same as walking the chain, through out of order adds,
+    removals, migrations and rebuilds.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.previous_location = database.database_location
+        database.database_location = os.path.join(self.directory, 'test.db')
+        database.initialize(True)
+        self.chain = build_chain(120, 7)
+        # Children are added before their parents, and in separate batches, to leave orphans between them.
+        self.stored = copy.deepcopy(self.chain)
+        random.Random(7).shuffle(self.stored)
+        for start in range(0, len(self.stored), 40):
+            database.add_star_logs(copy.deepcopy(self.stored[start:start + 40]))
+
+    def tearDown(self):
+        database.close()
+        database.database_location = self.previous_location
+        shutil.rmtree(self.directory)
+
+    def get_tips(self):
+        parents = set(star_log['previous_hash'] for star_log in self.stored)
+        return [star_log['hash'] for star_log in self.stored if star_log['hash'] not in parents]
+
+    def get_samples(self):
+        return self.get_tips() + [star_log['hash'] for star_log in self.stored[::9]]
+
+    def remove_tips(self, count):
+        for system_hash in self.get_tips()[:count]:
+            database.remove_star_log(system_hash)
+            self.stored = [star_log for star_log in self.stored if star_log['hash'] != system_hash]
+
+    def rerun_derived_migrations(self):
+        with database.transaction(write=True) as cursor:
+            cursor.execute('PRAGMA user_version = %s' % database.MIGRATIONS.index(database.create_event_tables))
+            database.migrate(cursor)
+
+    def rebuild(self):
+        database.initialize(True)
+        database.add_star_logs(copy.deepcopy(self.stored))
+
+    def assert_matches_walk(self):
+        walk = ChainWalk(self.stored)
+        systems = [None, self.chain[0]['hash']] + [star_log['hash'] for star_log in self.stored[::17]]
+        self.assertEqual(walk.get_highest(), database.get_star_log_highest()['hash'])
+        for system_hash in self.get_samples():
+            self.assertEqual(walk.get_highest(system_hash), database.get_star_log_highest(system_hash)['hash'])
+            self.assertEqual(walk.get_ancestry(system_hash), database.get_star_log_ancestry(system_hash))
+            height = walk.star_logs[system_hash]['height']
+            for ancestor_height in range(0, height + 1, 5):
+                ancestor_hash = walk.get_at_height(system_hash, ancestor_height)
+                self.assertEqual(ancestor_hash, database.get_star_log_at_height(system_hash, ancestor_height)['hash'])
+                self.assertTrue(database.is_star_log_ancestor(ancestor_hash, system_hash))
+            for star_system in systems:
+                for fleet_hash in [None, FLEETS[1]]:
+                    self.assertEqual(walk.get_unused_events(system_hash, star_system, fleet_hash), database.get_unused_events(system_hash, star_system, fleet_hash))
+            fleets = walk.get_fleets(system_hash)
+            self.assertEqual(fleets, database.get_fleets(system_hash))
+            for fleet_hash in FLEETS:
+                self.assertEqual(walk.get_fleet_systems(fleet_hash, system_hash), database.get_fleet_systems(fleet_hash, system_hash))
+            for query in ['0', 'a', 'f1', '3c', 'b0e', '', 'zz'] + [fleet_hash[5:9] for fleet_hash in FLEETS]:
+                self.assertEqual(putil.natural_match(query, fleets), database.match_fleet_hash(query, system_hash))
+
+    def test_added_out_of_order(self):
+        self.assert_matches_walk()
+
+    def test_removed(self):
+        self.remove_tips(8)
+        self.assert_matches_walk()
+
+    def test_removed_and_added_again(self):
+        removed = [star_log for star_log in self.stored if star_log['hash'] in self.get_tips()[:8]]
+        self.remove_tips(8)
+        database.add_star_logs(copy.deepcopy(removed))
+        self.stored += removed
+        self.assert_matches_walk()
+
+    def test_tied_forks(self):
+        parent = database.get_star_log(database.get_star_log_highest()['hash'])
+        children = []
+        for child_index in range(0, 3):
+            child = dict(parent, previous_hash=parent['hash'], height=parent['height'] + 1, time=parent['time'] + 1, events=[])
+            child['hash'] = util.sha256('tied %s' % child_index)
+            children.append(child)
+        # Added last to first, then one is removed and added again, so the tips table holds them in neither order.
+        for child in reversed(children):
+            database.add_star_logs([copy.deepcopy(child)])
+            self.stored.append(child)
+        database.remove_star_log(children[1]['hash'])
+        database.add_star_logs([copy.deepcopy(children[1])])
+        self.stored = [star_log for star_log in self.stored if star_log['hash'] != children[1]['hash']] + [children[1]]
+        self.assertEqual(children[2]['hash'], database.get_star_log_highest()['hash'])
+        self.assertEqual(children[2]['hash'], database.get_star_log_highest(parent['hash'])['hash'])
+        self.assert_matches_walk()
+
+    def test_migrated(self):
+        self.remove_tips(4)
+        self.rerun_derived_migrations()
+        self.assert_matches_walk()
+
+    def test_rebuilt(self):
+        self.remove_tips(4)
+        self.rebuild()
+        self.assert_matches_walk()
+
+
+if __name__ == '__main__':
+    unittest.main()
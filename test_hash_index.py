@@ -0,0 +1,92 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import hash_index
+import parameter_util as putil
+import util
+
+
+class HashIndexTest(unittest.TestCase):
+    """Checks the index matches the same hash as natural_match over the hashes in order, through adds, removals,
+    rebuilds and saves.
+    """
+
+    def setUp(self):
+        self.random = random.Random(3)
+        self.directory = tempfile.mkdtemp()
+        self.orders = dict((util.sha256('hash %s' % index), self.random.randint(0, 10 ** 6)) for index in range(0, 2000))
+        # Hashes sharing a prefix, so queries find several at the same position and the order breaks the tie.
+        for index in range(0, 50):
+            self.orders['0000' + util.sha256('shared %s' % index)[4:]] = self.random.randint(0, 10 ** 6)
+        self.orders[u'not a hash'] = 7
+        self.index = hash_index.HashIndex(self.orders.items())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_ordered(self):
+        return [value for value, _ in sorted(self.orders.items(), key=lambda entry: entry[1])]
+
+    def get_queries(self):
+        ordered = self.get_ordered()
+        queries = ['', '0', 'a', 'f1', '3c0', '0000', '00000', 'ffff', 'a hash', 'zz']
+        for _ in range(0, 40):
+            value = self.random.choice(ordered)
+            length = self.random.choice([1, 2, 3, 4, 5, 8, 64])
+            start = self.random.randint(0, max(0, len(value) - length))
+            queries.append(value[start:start + length])
+        return queries
+
+    def assert_matches_natural_match(self):
+        ordered = self.get_ordered()
+        for query in self.get_queries():
+            self.assertEqual(putil.natural_match(query, ordered), self.index.match(query))
+            expected = sorted((value.find(query), self.orders[value], value) for value in ordered if query in value)
+            self.assertEqual([(position, value) for position, _, value in expected], list(self.index.find(query)))
+
+    def change(self, count):
+        for value in self.random.sample(sorted(self.orders), count):
+            self.index.remove(value)
+            del self.orders[value]
+        for index in range(0, count):
+            value = util.sha256('added %s %s' % (count, index))
+            self.orders[value] = self.random.randint(0, 10 ** 6)
+            self.index.add(value, self.orders[value])
+        # Added again with a new order, the way a star log removed and stored again gets a new rowid.
+        value = self.random.choice(sorted(self.orders))
+        self.orders[value] = 10 ** 6 + count
+        self.index.add(value, self.orders[value])
+
+    def test_built(self):
+        self.assert_matches_natural_match()
+        self.assertEqual(len(self.orders), len(self.index))
+
+    def test_changed(self):
+        self.change(150)
+        self.assert_matches_natural_match()
+        self.assertEqual(sorted(self.orders.items()), sorted(self.index.get_entries()))
+        self.index.rebuild()
+        self.assert_matches_natural_match()
+
+    def test_saved(self):
+        self.change(50)
+        path = os.path.join(self.directory, 'index.hashes')
+        self.index.save(path)
+        self.assertEqual([], [name for name in os.listdir(self.directory) if name != 'index.hashes'])
+        self.index = hash_index.HashIndex.load(path)
+        self.assert_matches_natural_match()
+        self.change(20)
+        self.assert_matches_natural_match()
+
+    def test_save_lost_race(self):
+        # Another process removing the directory while the index is saved doesn't fail the save.
+        path = os.path.join(self.directory, 'missing', 'index.hashes')
+        self.index.save(path)
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import binascii
+import hashlib
+import unittest
+
+import mining
+
+# Met by about one digest in sixteen, so every range has plenty of solutions to compare.
+EASY_TARGET = '\x10' + '\x00' * 31
+# Headers either side of the 55 and 64 byte lengths where the padding needs another block.
+PREFIXES = ['', 'a' * 50, 'b' * 55, 'c' * 60, 'd' * 64, 'e' * 119, 'f' * 129]
+# Ranges crossing the nonce blocks and the nonces gaining a digit.
+RANGES = [(0, 300), (9900, 10100), (99950, 100050), (1234500, 1234700)]
+
+
+def find_all(hash_nonces, log_prefix, nonce_start, nonce_end, target):
+    """Finds every nonce in a range meeting the target, resuming after each one an engine returns.
+
+    Returns:
+        list: The (nonce, hash) of each solution, in order.
+    """
+    results = []
+    while nonce_start < nonce_end:
+        result = hash_nonces(log_prefix, nonce_start, nonce_end, target)
+        if result is None:
+            break
+        results.append(result)
+        nonce_start = result[0] + 1
+    return results
+
+
+class EngineTest(unittest.TestCase):
+    """Checks each probing engine finds the same nonces and digests as hashing every full header with hashlib."""
+
+    def assert_matches_hashlib(self, engine):
+        for log_prefix in PREFIXES:
+            for nonce_start, nonce_end in RANGES:
+                expected = find_all(mining.hash_nonces_hashlib, log_prefix, nonce_start, nonce_end, EASY_TARGET)
+                self.assertTrue(expected)
+                self.assertEqual(expected, find_all(mining.get_engine(engine), log_prefix, nonce_start, nonce_end, EASY_TARGET))
+
+    def test_hashlib(self):
+        log_prefix = 'header'
+        nonce, digest = mining.hash_nonces_hashlib(log_prefix, 0, 1000, EASY_TARGET)
+        self.assertEqual(hashlib.sha256('%s%s' % (log_prefix, nonce)).hexdigest(), digest)
+        self.assertTrue(binascii.unhexlify(digest) < EASY_TARGET)
+        self.assertIsNone(mining.hash_nonces_hashlib(log_prefix, 0, 1000, '\x00' * 32))
+
+    def test_midstate(self):
+        self.assert_matches_hashlib('midstate')
+
+    def test_numpy(self):
+        self.assert_matches_hashlib('numpy')
+
+    def test_numpy_batches(self):
+        # Solutions are found in the later of several batches, and a batch ending early at the range's end.
+        log_prefix = 'g' * 70
+        nonce_end = 3 * mining.NUMPY_BATCH + 100
+        nonce_start = nonce_end - mining.NUMPY_BATCH - 200
+        target = '\x01' + '\x00' * 31
+        expected = find_all(mining.hash_nonces_hashlib, log_prefix, nonce_start, nonce_end, target)
+        self.assertTrue(expected)
+        self.assertEqual(expected, find_all(mining.hash_nonces_numpy, log_prefix, nonce_start, nonce_end, target))
+
+    def test_unmet_target(self):
+        for engine in ['midstate', 'numpy']:
+            self.assertIsNone(mining.get_engine(engine)('header', 9990, 10010, '\x00' * 32))
+
+    def test_unrecognized_engine(self):
+        self.assertRaises(ValueError, mining.get_engine, 'unknown')
+
+
+if __name__ == '__main__':
+    unittest.main()
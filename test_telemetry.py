@@ -0,0 +1,102 @@
+import copy
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import telemetry
+
+
+class TelemetryTest(unittest.TestCase):
+    """Checks the metrics written to the telemetry file in both formats, and how often it's rewritten."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.previous = telemetry.TELEMETRY_FILE, telemetry.TELEMETRY_INTERVAL, copy.deepcopy(telemetry.state), telemetry.last_written[0]
+        telemetry.TELEMETRY_FILE = None
+        telemetry.TELEMETRY_INTERVAL = 3600
+        telemetry.last_written[0] = 0.0
+        for name in telemetry.state:
+            telemetry.state[name] = {} if name == 'hashes_per_second' else 0
+
+    def tearDown(self):
+        telemetry.TELEMETRY_FILE, telemetry.TELEMETRY_INTERVAL, state, telemetry.last_written[0] = self.previous
+        telemetry.state.clear()
+        telemetry.state.update(state)
+        shutil.rmtree(self.directory)
+
+    def record(self):
+        telemetry.set_hashes_per_second([1000.0, 2500.5])
+        telemetry.set_seconds('find', 12.5)
+        telemetry.set_seconds('post', 0.25)
+        telemetry.increment('found', 3)
+        telemetry.increment('accepted', 2)
+        telemetry.increment('rejected')
+        telemetry.increment('stale')
+        telemetry.increment('timeout', 4)
+        telemetry.increment('stale_submissions', 5)
+
+    def use_file(self, name):
+        telemetry.TELEMETRY_FILE = os.path.join(self.directory, name)
+        return telemetry.TELEMETRY_FILE
+
+    def read(self, path):
+        with open(path) as telemetry_file:
+            return telemetry_file.read()
+
+    def test_snapshot(self):
+        self.record()
+        snapshot = telemetry.get_snapshot()
+        self.assertEqual({0: 1000.0, 1: 2500.5}, snapshot['hashes_per_second'])
+        self.assertEqual((3, 2, 1, 1, 4, 5), tuple(snapshot['%s_total' % name] for name in ['found', 'accepted', 'rejected', 'stale', 'timeout', 'stale_submissions']))
+        # Stale submissions aren't probes, only the stale, found and timed out probes count towards the rate.
+        self.assertEqual(1 / 8.0, snapshot['stale_rate'])
+        self.assertEqual(0.0, telemetry.get_snapshot()['template_seconds'])
+
+    def test_no_probes(self):
+        self.assertEqual(0.0, telemetry.get_snapshot()['stale_rate'])
+
+    def test_json(self):
+        path = self.use_file('telemetry.json')
+        self.record()
+        telemetry.flush(True)
+        written = json.loads(self.read(path))
+        self.assertEqual({'0': 1000.0, '1': 2500.5}, written['hashes_per_second'])
+        self.assertEqual(12.5, written['find_seconds'])
+        self.assertEqual(5, written['stale_submissions_total'])
+        self.assertEqual(1 / 8.0, written['stale_rate'])
+        self.assertIn('time', written)
+        self.assertEqual(['telemetry.json'], os.listdir(self.directory))
+
+    def test_prometheus(self):
+        path = self.use_file('telemetry.prom')
+        self.record()
+        telemetry.flush(True)
+        lines = self.read(path).splitlines()
+        for name, metric_type, description in telemetry.METRICS:
+            self.assertIn('# HELP probe_%s %s' % (name, description), lines)
+            self.assertIn('# TYPE probe_%s %s' % (name, metric_type), lines)
+        self.assertIn('probe_hashes_per_second{worker="0"} 1000.0', lines)
+        self.assertIn('probe_hashes_per_second{worker="1"} 2500.5', lines)
+        self.assertIn('probe_found_total 3', lines)
+        self.assertIn('probe_stale_rate 0.125', lines)
+
+    def test_interval(self):
+        path = self.use_file('telemetry.json')
+        telemetry.increment('found')
+        self.assertEqual(1, json.loads(self.read(path))['found_total'])
+        # Within the interval only a forced flush rewrites the file.
+        telemetry.increment('found')
+        self.assertEqual(1, json.loads(self.read(path))['found_total'])
+        telemetry.flush(True)
+        self.assertEqual(2, json.loads(self.read(path))['found_total'])
+
+    def test_disabled(self):
+        self.record()
+        telemetry.flush(True)
+        self.assertEqual([], os.listdir(self.directory))
+
+
+if __name__ == '__main__':
+    unittest.main()
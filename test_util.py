@@ -0,0 +1,70 @@
+import unittest
+
+import util
+import validate
+from test_validate import PRIVATE_KEY, PUBLIC_KEY
+
+
+class KeyCacheTest(unittest.TestCase):
+    """Checks parsed RSA keys are reused, and that fleet keys never evict the account's private key."""
+
+    def setUp(self):
+        self.previous_caches = util.private_keys, util.public_keys
+        util.private_keys = util.LruCache(8)
+        util.public_keys = util.LruCache(4)
+
+    def tearDown(self):
+        util.private_keys, util.public_keys = self.previous_caches
+
+    def test_public_key_reused(self):
+        public_key = util.expand_rsa_public_key(PUBLIC_KEY)
+        parsed = util.load_public_key(public_key)
+        self.assertIs(parsed, util.load_public_key(public_key))
+        statistics = util.get_key_cache_statistics()['public']
+        self.assertEqual((1, 1), (statistics['hits'], statistics['misses']))
+
+    def test_signatures_verify(self):
+        # Signing and verifying with cached keys gives the same results as with freshly parsed ones.
+        for _ in range(0, 2):
+            signature = util.rsa_sign(PRIVATE_KEY, 'message')
+            util.load_public_key(util.expand_rsa_public_key(PUBLIC_KEY))
+            validate.rsa(util.expand_rsa_public_key(PUBLIC_KEY), signature, 'message')
+        self.assertEqual(1, util.get_key_cache_statistics()['private']['misses'])
+        self.assertEqual(1, util.get_key_cache_statistics()['public']['misses'])
+        self.assertRaises(Exception, validate.rsa, util.expand_rsa_public_key(PUBLIC_KEY), signature, 'other message')
+
+    def test_private_key_not_evicted(self):
+        util.rsa_sign(PRIVATE_KEY, 'message')
+        # More fleet keys than the public cache holds, only the oldest are evicted and only from the public cache.
+        for index in range(0, 6):
+            util.public_keys.put('fleet key %s' % index, object())
+        self.assertEqual(4, len(util.public_keys))
+        self.assertIsNone(util.public_keys.get('fleet key 0'))
+        self.assertIsNotNone(util.private_keys.get(PRIVATE_KEY))
+
+
+class LruCacheTest(unittest.TestCase):
+    """Checks the cache evicts its least recently used entries by size."""
+
+    def test_evicts_least_recently_used(self):
+        cache = util.LruCache(3)
+        for key in ['a', 'b', 'c']:
+            cache.put(key, key.upper())
+        self.assertEqual('A', cache.get('a'))
+        cache.put('d', 'D')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(['A', 'C', 'D'], [cache.get(key) for key in ['a', 'c', 'd']])
+
+    def test_sized_entries(self):
+        cache = util.LruCache(10)
+        cache.put('a', 'A', 4)
+        cache.put('b', 'B', 4)
+        cache.put('c', 'C', 4)
+        self.assertEqual((2, 8), (len(cache), cache.get_statistics()['size']))
+        # Too large for the whole cache, it isn't cached and evicts nothing.
+        cache.put('d', 'D', 11)
+        self.assertEqual([None, 'B', 'C', None], [cache.get(key) for key in ['a', 'b', 'c', 'd']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,220 @@
+import copy
+import os
+import shutil
+import tempfile
+import unittest
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import database
+import util
+import validate
+
+
+def generate_keys():
+    """Generates a private key and the shrunk public key events carry as their fleet key, the way accounts do."""
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    private_serialized = private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+    public_serialized = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    return private_serialized, ''.join(public_serialized.splitlines()[1:-1])
+
+
+PRIVATE_KEY, PUBLIC_KEY = generate_keys()
+
+
+def build_event(index):
+    """Builds a signed reward event.
+
+    Args:
+        index (int): Makes the output key of each event built different.
+
+    Returns:
+        dict: Json data for the event.
+    """
+    event = {
+        'index': 0,
+        'hash': None,
+        'type': 'reward',
+        'fleet_hash': util.sha256(PUBLIC_KEY),
+        'fleet_key': PUBLIC_KEY,
+        'inputs': [],
+        'outputs': [{
+            'index': 0,
+            'type': 'reward',
+            'fleet_hash': util.sha256(PUBLIC_KEY),
+            'key': util.sha256('output %s' % index),
+            'star_system': None,
+            'count': 10
+        }],
+        'signature': None
+    }
+    event['hash'] = util.hash_event(event)
+    event['signature'] = util.rsa_sign(PRIVATE_KEY, event['hash'])
+    return event
+
+
+EVENTS = [build_event(index) for index in range(0, 12)]
+
+
+class BatchTestCase(unittest.TestCase):
+    """Validates batches of events, restoring the validation settings and stopping the pool afterwards."""
+
+    def setUp(self):
+        self.previous_settings = validate.VALIDATION_PROCESSES, validate.VALIDATION_BATCH_MINIMUM
+        validate.verified_signatures.clear()
+
+    def tearDown(self):
+        validate.VALIDATION_PROCESSES, validate.VALIDATION_BATCH_MINIMUM = self.previous_settings
+        if validate.validation_pool[0] is not None:
+            validate.validation_pool[0].terminate()
+            validate.validation_pool[0].join()
+            validate.validation_pool[0] = None
+        validate.verified_signatures.clear()
+
+    def use_pool(self, pooled):
+        validate.VALIDATION_PROCESSES = 2 if pooled else 1
+        validate.VALIDATION_BATCH_MINIMUM = 4
+
+    def get_mixed_events(self):
+        """Gets valid events with some invalid ones among them, and the exception expected for each invalid one."""
+        events = copy.deepcopy(EVENTS)
+        events[2]['signature'] = events[3]['signature']
+        events[5]['outputs'][0]['count'] = 11
+        events[8]['type'] = 'jump'
+        del events[10]['fleet_key']
+        return events, {2: 'Invalid signature', 5: 'provided hash does not match the calculated one', 8: 'provided hash does not match the calculated one', 10: "'fleet_key'"}
+
+    def assert_verdicts(self, events, expected):
+        verdicts = validate.event_batch(events, reward_allowed=True)
+        self.assertEqual(len(events), len(verdicts))
+        for index, verdict in enumerate(verdicts):
+            if index in expected:
+                self.assertIsInstance(verdict, Exception)
+                self.assertEqual(expected[index], str(verdict))
+            else:
+                self.assertIsNone(verdict)
+
+
+class ValidationTest(BatchTestCase):
+    """Checks events are judged the same whether they're validated in this process or across the pool."""
+
+    def test_in_process(self):
+        self.use_pool(False)
+        self.assert_verdicts(*self.get_mixed_events())
+        self.assertIsNone(validate.validation_pool[0])
+
+    def test_pool(self):
+        self.use_pool(True)
+        self.assert_verdicts(*self.get_mixed_events())
+        self.assertIsNotNone(validate.validation_pool[0])
+
+    def test_small_batch_stays_in_process(self):
+        self.use_pool(True)
+        self.assert_verdicts(copy.deepcopy(EVENTS[:3]), {})
+        self.assertIsNone(validate.validation_pool[0])
+
+    def test_events_valid_raises_first(self):
+        for pooled in [False, True]:
+            self.use_pool(pooled)
+            events, _ = self.get_mixed_events()
+            with self.assertRaises(Exception) as context:
+                validate.events_valid(events)
+            self.assertEqual('Invalid signature', str(context.exception))
+            validate.events_valid(copy.deepcopy(EVENTS))
+
+    def test_rewards_forbidden(self):
+        self.use_pool(False)
+        verdicts = validate.event_batch(copy.deepcopy(EVENTS[:2]), reward_allowed=False)
+        self.assertEqual(['event of type reward forbidden'] * 2, [str(verdict) for verdict in verdicts])
+
+
+class SignatureCacheTest(BatchTestCase):
+    """Checks signatures are only verified once, and are persisted a batch at a time when SIGNATURE_CACHE_PERSIST is
+    set.
+    """
+
+    def setUp(self):
+        super(SignatureCacheTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.previous_location = database.database_location
+        database.database_location = os.path.join(self.directory, 'test.db')
+        database.initialize(True)
+        self.previous_persisted = validate.signatures_persisted[0]
+        self.previous_rsa = validate.rsa
+        self.previous_add = database.add_verified_signatures
+        self.verified = []
+        self.persisted = []
+
+        def rsa(public_key, signature, message):
+            self.verified.append(message)
+            self.previous_rsa(public_key, signature, message)
+
+        def add_verified_signatures(entries, limit):
+            self.persisted.append(list(entries))
+            self.previous_add(entries, limit)
+
+        validate.rsa = rsa
+        database.add_verified_signatures = add_verified_signatures
+
+    def tearDown(self):
+        validate.rsa = self.previous_rsa
+        database.add_verified_signatures = self.previous_add
+        validate.signatures_persisted[0] = self.previous_persisted
+        database.close()
+        database.database_location = self.previous_location
+        shutil.rmtree(self.directory)
+        super(SignatureCacheTest, self).tearDown()
+
+    def test_verified_once(self):
+        self.use_pool(False)
+        events, expected = self.get_mixed_events()
+        self.assert_verdicts(events, expected)
+        self.assertEqual(len(events) - 3, len(self.verified))
+        # Only the invalid signature is verified again, the rest come from the cache.
+        del self.verified[:]
+        self.assert_verdicts(events, expected)
+        self.assertEqual([events[2]['hash']], self.verified)
+        self.assertEqual([], self.persisted)
+
+    def test_cached_skip_pool(self):
+        self.use_pool(True)
+        self.assert_verdicts(copy.deepcopy(EVENTS), {})
+        validate.validation_pool[0].terminate()
+        validate.validation_pool[0].join()
+        validate.validation_pool[0] = None
+        self.assert_verdicts(copy.deepcopy(EVENTS), {})
+        self.assertIsNone(validate.validation_pool[0])
+
+    def test_persisted_per_batch(self):
+        validate.signatures_persisted[0] = True
+        for pooled in [False, True]:
+            self.use_pool(pooled)
+            validate.verified_signatures.clear()
+            with database.transaction(write=True) as cursor:
+                cursor.execute('DELETE FROM verified_signatures')
+            del self.persisted[:]
+            events, expected = self.get_mixed_events()
+            self.assert_verdicts(events, expected)
+            valid = [(event['fleet_key'], event['signature'], event['hash']) for index, event in enumerate(events) if index not in expected]
+            self.assertEqual(1, len(self.persisted))
+            self.assertEqual(sorted(valid), sorted(self.persisted[0]))
+        # Signatures persisted by an earlier process are found without verifying them, only those of the events that
+        # were invalid in the batch are verified.
+        self.use_pool(False)
+        validate.verified_signatures.clear()
+        del self.verified[:]
+        self.assert_verdicts(copy.deepcopy(EVENTS), {})
+        self.assertEqual([EVENTS[index]['hash'] for index in sorted(expected)], self.verified)
+
+
+if __name__ == '__main__':
+    unittest.main()
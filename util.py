@@ -4,11 +4,13 @@ import binascii
 import time
 import math
 import uuid
+import threading
+from collections import OrderedDict
 import numpy
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding
-from cryptography.hazmat.primitives.serialization import load_pem_private_key
+from cryptography.hazmat.primitives.serialization import load_pem_private_key, load_pem_public_key
 
 def difficultyFudge():
     return int(os.getenv('DIFFICULTY_FUDGE', '0'))
@@ -38,6 +40,8 @@ def eventsMaxLimit():
     return int(os.getenv('EVENTS_MAX_LIMIT', '10'))
 def chainsMaxLimit():
     return int(os.getenv('CHAINS_MAX_LIMIT', '10'))
+def keyCacheSize():
+    return int(os.getenv('KEY_CACHE_SIZE', '1024'))
 
 MAXIMUM_NONCE = 2147483647
 MAXIMUM_TARGET = '00000000ffffffffffffffffffffffffffffffffffffffffffffffffffffffff'
@@ -255,7 +259,7 @@ def rsa_sign(private_key, message):
     Returns:
         str: Hex signature of the message, with its leading 0x stripped.
     """
-    private_rsa = load_pem_private_key(bytes(private_key), password=None, backend=default_backend())
+    private_rsa = load_private_key(private_key)
     hashed = sha256(message)
     signature = private_rsa.sign(
         hashed,
@@ -268,6 +272,45 @@ def rsa_sign(private_key, message):
     return binascii.hexlify(bytearray(signature))
 
 
+def load_private_key(private_key):
+    """Parses an Rsa private key, reusing the parsed key if it was loaded recently.
+
+    Args:
+        private_key (str): Rsa private key with BEGIN and END sections.
+
+    Returns:
+        RSAPrivateKey: The parsed key.
+    """
+    parsed = private_keys.get(private_key)
+    if parsed is None:
+        parsed = load_pem_private_key(bytes(private_key), password=None, backend=default_backend())
+        private_keys.put(private_key, parsed)
+    return parsed
+
+
+def load_public_key(public_key):
+    """Parses an Rsa public key, reusing the parsed key if it was loaded recently.
+
+    Args:
+        public_key (str): Rsa public key with BEGIN and END sections.
+
+    Returns:
+        RSAPublicKey: The parsed key.
+    """
+    parsed = public_keys.get(public_key)
+    if parsed is None:
+        parsed = load_pem_public_key(bytes(public_key), backend=default_backend())
+        public_keys.put(public_key, parsed)
+    return parsed
+
+
+def get_key_cache_statistics():
+    return {
+        'private': private_keys.get_statistics(),
+        'public': public_keys.get_statistics()
+    }
+
+
 def hash_star_log(star_log):
     """Hashed value of the provided star log's header.
 
@@ -310,6 +353,31 @@ def hash_event(event):
     return sha256(concat_event(event))
 
 
+def copy_star_log(star_log):
+    """Copies a star log deep enough that changing the copy's fields, events, inputs or outputs leaves the original
+    untouched.
+
+    Args:
+        star_log (dict): Json data for the star log to be copied.
+
+    Returns:
+        dict: The copied star log.
+    """
+    result = dict(star_log)
+    if 'events' in star_log:
+        result['events'] = [copy_event(event) for event in star_log['events']]
+    return result
+
+
+def copy_event(event):
+    result = dict(event)
+    if 'inputs' in event:
+        result['inputs'] = [dict(event_input) for event_input in event['inputs']]
+    if 'outputs' in event:
+        result['outputs'] = [dict(event_output) for event_output in event['outputs']]
+    return result
+
+
 def unpack_bits(difficulty, strip=False):
     """Unpacks int difficulty into a target hex.
 
@@ -353,6 +421,32 @@ def unpack_bits(difficulty, strip=False):
     return base256.rstrip('0') if strip else base256
 
 
+def unpack_target(difficulty):
+    """Unpacks int difficulty into the raw bytes of its target.
+
+    Args:
+        difficulty (int): Packed int representation of a difficulty.
+
+    Returns:
+        str: The 32 byte target, a raw Sha256 digest meets it if the digest is less than it.
+    """
+    # Malformed difficulties can unpack to fewer digits, which are compared as if padded with trailing zeros.
+    return binascii.unhexlify(unpack_bits(difficulty, True).ljust(64, '0'))
+
+
+def is_target_met(target, digest):
+    """Checks if a raw Sha256 digest meets an unpacked target.
+
+    Args:
+        target (str): Raw target bytes from unpack_target.
+        digest (str): Raw Sha256 digest to check.
+
+    Returns:
+        bool: True if the digest is less than the target.
+    """
+    return digest < target
+
+
 def get_fleets(events_json):
     """Gets all fleets with their keys.
 
@@ -578,3 +672,95 @@ def get_time():
         int: The number of seconds since the UTC epoch started.
     """
     return int(time.time())
+
+
+class LruCache(object):
+    """Bounded mapping that evicts its least recently used entries, counting hits and misses.
+
+    Safe to share between threads. Capacity is in whatever unit entries are sized with when they're put, so a cache of
+    equally sized entries holds capacity entries.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """Gets the value of a key, marking it as the most recently used.
+
+        Args:
+            key: Key to look up.
+            default: Returned if the key isn't cached.
+
+        Returns:
+            The cached value, or the default on a miss.
+        """
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            entry = self.entries.pop(key)
+            self.entries[key] = entry
+            return entry[0]
+
+    def put(self, key, value, size=1):
+        """Caches a value, evicting the least recently used entries until the cache fits within its capacity.
+
+        Args:
+            key: Key to cache the value with.
+            value: Value to cache.
+            size (int): Size of the value, in the same unit as the capacity.
+        """
+        with self.lock:
+            self.pop_entry(key)
+            # A value larger than the whole cache would only evict everything else before being evicted itself.
+            if self.capacity < size:
+                return
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.capacity < self.size:
+                self.size -= self.entries.popitem(last=False)[1][1]
+
+    def pop_entry(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def remove(self, key):
+        with self.lock:
+            self.pop_entry(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def get_statistics(self):
+        """Gets the size and hit rate of the cache.
+
+        Returns:
+            dict: The entries, size, capacity, hits, misses and hit rate.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'size': self.size,
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': 0.0 if lookups == 0 else self.hits / float(lookups)
+            }
+
+
+# Account keys are cached apart from fleet keys, so seeing many fleets never evicts the key being signed with.
+private_keys = LruCache(8)
+public_keys = LruCache(keyCacheSize())
@@ -1,12 +1,25 @@
 import re
 import binascii
+import multiprocessing
+import os
 from cryptography.exceptions import InvalidSignature
-from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding
-from cryptography.hazmat.primitives.serialization import load_pem_public_key
+import database
 import util
 
+VALIDATION_PROCESSES = int(os.getenv('VALIDATION_PROCESSES', '0'))
+# Batches smaller than this are validated in this process, since sending them to the pool costs more than it saves.
+VALIDATION_BATCH_MINIMUM = int(os.getenv('VALIDATION_BATCH_MINIMUM', '32'))
+
+SIGNATURE_CACHE_SIZE = int(os.getenv('SIGNATURE_CACHE_SIZE', '65536'))
+SIGNATURE_CACHE_PERSIST = int(os.getenv('SIGNATURE_CACHE_PERSIST', '0')) == 1
+
+validation_pool = [None]
+verified_signatures = util.LruCache(SIGNATURE_CACHE_SIZE)
+# Pool processes leave persisting to the process that started them, so only one process writes to the database.
+signatures_persisted = [SIGNATURE_CACHE_PERSIST]
+
 
 def byte_size(limit, target):
     if limit < len(target):
@@ -31,7 +44,7 @@ def rsa(public_key, signature, message):
         message (str): Message that was signed, unhashed.
     """
     try:
-        public_rsa = load_pem_public_key(bytes(public_key), backend=default_backend())
+        public_rsa = util.load_public_key(public_key)
         hashed = util.sha256(message)
         public_rsa.verify(
             binascii.unhexlify(signature),
@@ -102,11 +115,11 @@ def events(events_json):
     Args:
         events_json (dict): Events json.
     """
+    events_valid(events_json)
     remaining_ship_rewards = util.shipReward()
     input_keys = []
     output_keys = []
     for current_event in events_json:
-        event(current_event)
         if current_event['type'] == 'reward':
             if len(current_event['inputs']) != 0:
                 raise Exception('reward events cannot have inputs')
@@ -215,7 +228,134 @@ def event(event_json, require_index=True, require_star_system=False, reward_allo
 
     field_is_sha256(event_json['fleet_hash'], 'fleet_hash')
     sha256(event_json['fleet_hash'], event_json['fleet_key'], 'fleet_key')
+    event_signature(event_json)
+
+
+def event_signature(event_json):
+    """Verifies the RSA signature of the event's hash, skipping signatures that have already been verified.
+
+    Newly verified signatures are only cached in this process, event_batch persists them once the batch is validated.
+
+    Args:
+        event_json (dict): Event to verify, its hash should already be verified.
+    """
+    signature_key = (event_json['fleet_key'], event_json['signature'], event_json['hash'])
+    if is_signature_verified(signature_key):
+        return
     rsa(util.expand_rsa_public_key(event_json['fleet_key']), event_json['signature'], event_json['hash'])
+    verified_signatures.put(signature_key, True)
+
+
+def is_signature_verified(signature_key):
+    """Checks if a signature is in the verified signature cache, or persisted if SIGNATURE_CACHE_PERSIST is set.
+
+    Args:
+        signature_key (tuple): The (fleet_key, signature, hash) of the signature.
+
+    Returns:
+        bool: True if the signature has been verified before.
+    """
+    if verified_signatures.get(signature_key, False):
+        return True
+    if signatures_persisted[0] and database.any_verified_signature(*signature_key):
+        verified_signatures.put(signature_key, True)
+        return True
+    return False
+
+
+def add_verified_signatures(signature_keys):
+    for signature_key in signature_keys:
+        verified_signatures.put(signature_key, True)
+    if signatures_persisted[0] and signature_keys:
+        database.add_verified_signatures(signature_keys, SIGNATURE_CACHE_SIZE)
+
+
+def get_signature_cache_statistics():
+    return verified_signatures.get_statistics()
+
+
+def get_validation_processes():
+    return multiprocessing.cpu_count() if VALIDATION_PROCESSES <= 0 else VALIDATION_PROCESSES
+
+
+def get_validation_pool():
+    """Gets the pool events are validated with, starting it the first time it's needed.
+
+    Returns:
+        multiprocessing.Pool: The pool, or None if validation should stay in this process.
+    """
+    processes = get_validation_processes()
+    if processes <= 1:
+        return None
+    if validation_pool[0] is None:
+        validation_pool[0] = multiprocessing.Pool(processes, initialize_validation_process)
+    return validation_pool[0]
+
+
+def initialize_validation_process():
+    signatures_persisted[0] = False
+
+
+def event_verdict(arguments):
+    """Validates an event, returning the exception instead of raising it so it can be sent back from a pool."""
+    try:
+        event(*arguments)
+        return None
+    except Exception as exception:
+        return exception
+
+
+def event_batch(events_json, require_index=True, require_star_system=False, reward_allowed=True):
+    """Verifies the fields of each event, spreading the events across a pool of processes.
+
+    Signatures verified by the batch are persisted together once it's done, if SIGNATURE_CACHE_PERSIST is set.
+
+    Args:
+        events_json (list): Events to validate.
+        require_index (bool): Verifies an integer index is included if True.
+        require_star_system (bool): Verifies that every output specifies a star system if True.
+        reward_allowed (bool): Allows events of type reward if True.
+
+    Returns:
+        list: None for each valid event, or the exception raised validating it, in the same order as the events.
+    """
+    arguments = [(current_event, require_index, require_star_system, reward_allowed) for current_event in events_json]
+    verdicts = [None] * len(arguments)
+    uncached = []
+    for index, current_event in enumerate(events_json):
+        signature_key = (current_event.get('fleet_key'), current_event.get('signature'), current_event.get('hash'))
+        # Events with verified signatures are cheap enough to check here, the rest go to the pool if there are enough.
+        if all(isinstance(field, basestring) for field in signature_key) and is_signature_verified(signature_key):
+            verdicts[index] = event_verdict(arguments[index])
+        else:
+            uncached.append(index)
+    pool = None if len(uncached) < VALIDATION_BATCH_MINIMUM else get_validation_pool()
+    if pool is None:
+        uncached_verdicts = [event_verdict(arguments[index]) for index in uncached]
+    else:
+        chunk_size = max(1, len(uncached) // (get_validation_processes() * 4))
+        uncached_verdicts = pool.map(event_verdict, [arguments[index] for index in uncached], chunk_size)
+    verified = []
+    for index, verdict in zip(uncached, uncached_verdicts):
+        verdicts[index] = verdict
+        if verdict is None:
+            verified.append((events_json[index]['fleet_key'], events_json[index]['signature'], events_json[index]['hash']))
+    add_verified_signatures(verified)
+    return verdicts
+
+
+def events_valid(events_json, require_index=True, require_star_system=False, reward_allowed=True):
+    """Verifies the fields of each event in a pool of processes, raising the exception of the first invalid one.
+
+    Args:
+        events_json (list): Events to validate.
+        require_index (bool): Verifies an integer index is included if True.
+        require_star_system (bool): Verifies that every output specifies a star system if True.
+        reward_allowed (bool): Allows events of type reward if True.
+    """
+    for verdict in event_batch(events_json, require_index, require_star_system, reward_allowed):
+        if verdict is not None:
+            raise verdict
 
 
 def event_input(input_json):
@@ -281,27 +421,9 @@ def difficulty(packed, sha, validate_params=True):
             raise Exception('difficulty is not an int')
         field_is_sha256(sha, 'difficulty target')
 
-    mask = util.unpack_bits(packed, True)
-    leading_zeros = len(mask) - len(mask.lstrip('0'))
-    difficulty_unpacked(mask, leading_zeros, sha, validate_params)
-
-
-def difficulty_unpacked(unpacked_stripped, leading_zeros, sha, validate_params=True):
-    """Takes the unpacked form of difficulty and verifies that the hash is less than it.
-
-    Args:
-        unpacked_stripped (str): Unpacked target difficulty the provided SHA256 hash must meet.
-        sha (str): Hex target to test, stripped of its leading 0x.
-    """
-    if validate_params:
-        field_is_sha256(sha, 'difficulty target')
-
     try:
-        for i in range(0, leading_zeros):
-            if sha[i] != '0':
-                raise Exception('Hash is greater than packed target')
-        significant = sha[:len(unpacked_stripped)]
-        if int(unpacked_stripped, 16) <= int(significant, 16):
-            raise Exception('Hash is greater than packed target')
-    except:
+        digest = binascii.unhexlify(sha)
+    except TypeError:
         raise Exception('Unable to cast to int from hexidecimal')
+    if not util.is_target_met(util.unpack_target(packed), digest):
+        raise Exception('Hash is greater than packed target')